@@ -0,0 +1,303 @@
+import random
+from collections.abc import MutableMapping
+from typing import Iterator, Optional
+
+
+class _Node:
+    __slots__ = ('cell_index', 'num', 'priority', 'size', 'shift', 'left', 'right', 'parent')
+
+    def __init__(self, cell_index: str, num: int, priority: float):
+        self.cell_index = cell_index
+        # the actual number is num plus the pending shifts of all ancestors
+        self.num = num
+        self.priority = priority
+        self.size = 1
+        # pending shift of both subtrees, not applied to this node
+        self.shift = 0
+        self.left = self.right = self.parent = None
+
+
+def _size(node: Optional[_Node]) -> int:
+    return node.size if node is not None else 0
+
+
+class CellOrder:
+    def __init__(self, seed: int = 0):
+        self._root = None
+        self._nodes = {}
+        self._random = random.Random(seed)
+        self._candidates = []
+        self._full_scan = False
+        self.version = 0
+        self.nums = CellNumMapping(self)
+
+    def __len__(self) -> int:
+        return _size(self._root)
+
+    def __iter__(self) -> Iterator[tuple[str, int]]:
+        stack, node, offset = [], self._root, 0
+        while stack or node is not None:
+            while node is not None:
+                stack.append((node, offset))
+                offset += node.shift
+                node = node.left
+            node, offset = stack.pop()
+            yield node.cell_index, node.num + offset
+            offset += node.shift
+            node = node.right
+
+    def __contains__(self, item: tuple[str, int]) -> bool:
+        cell_index, num = item
+        node = self._nodes.get(cell_index)
+        return node is not None and self._get_num(node) == num
+
+    def __getitem__(self, position: int) -> tuple[str, int]:
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError("cell position out of range")
+
+        node, offset = self._root, 0
+        while True:
+            left_size = _size(node.left)
+            if position == left_size:
+                return node.cell_index, node.num + offset
+            offset += node.shift
+            if position < left_size:
+                node = node.left
+            else:
+                position -= left_size + 1
+                node = node.right
+
+    def has_cell(self, cell_index: str) -> bool:
+        return cell_index in self._nodes
+
+    def get_num(self, cell_index: str) -> int:
+        return self._get_num(self._nodes[cell_index])
+
+    def position(self, cell_index: str) -> int:
+        return self._rank(self._nodes[cell_index])
+
+    def clear(self) -> None:
+        self._root = None
+        self._nodes = {}
+        self._candidates = []
+        self._full_scan = False
+        self.version += 1
+
+    def insert(self, cell_index: str, num: int) -> None:
+        if cell_index in self._nodes:
+            self.remove(cell_index)
+        self.nums.detached.pop(cell_index, None)
+
+        node = _Node(cell_index, num, self._random.random())
+        self._nodes[cell_index] = node
+        # equal numbers keep insertion order, the new cell goes after them
+        left, right = self._split_by_num(self._root, num, inclusive=True)
+        self._set_root(self._merge(self._merge(left, node), right))
+        self._add_candidate(node)
+        self.version += 1
+
+    def remove(self, cell_index: str) -> None:
+        node = self._nodes.pop(cell_index)
+        left, rest = self._split_by_rank(self._root, self._rank(node))
+        _, right = self._split_by_rank(rest, 1)
+        self._set_root(self._merge(left, right))
+        if node in self._candidates:
+            self._full_scan = True
+        self.version += 1
+
+    def shift(self, num: int, delta: int, inclusive: bool = True) -> None:
+        # moves all cells numbered from num (or after num) by delta
+        left, right = self._split_by_num(self._root, num, inclusive=not inclusive)
+        if right is not None:
+            right.num += delta
+            right.shift += delta
+            if delta < 0:
+                self._add_candidate(self._first(right))
+            self.version += 1
+        self._set_root(self._merge(left, right))
+
+    def delete_duplicates(self) -> list[str]:
+        if self._full_scan:
+            duplicates, previous_num = [], None
+            for cell_index, num in self:
+                if num == previous_num:
+                    duplicates.append(cell_index)
+                previous_num = num
+        else:
+            duplicates, seen_nums = [], set()
+            for node in self._candidates:
+                if self._nodes.get(node.cell_index) is node:
+                    # several candidates can share a number, the group is collected once
+                    num = self._get_num(node)
+                    if num not in seen_nums:
+                        seen_nums.add(num)
+                        duplicates += self._get_group_duplicates(node)
+
+        for cell_index in duplicates:
+            if cell_index in self._nodes:
+                self.remove(cell_index)
+
+        self._candidates = []
+        self._full_scan = False
+        return duplicates
+
+    def _get_group_duplicates(self, node: _Node) -> list[str]:
+        num = self._get_num(node)
+        start = self._count_before(num, inclusive=False)
+        end = self._count_before(num, inclusive=True)
+        # the first cell with a number wins, the rest of the group is dropped
+        return [self[position][0] for position in range(start + 1, end)]
+
+    def _add_candidate(self, node: _Node) -> None:
+        self._candidates.append(node)
+        if len(self._candidates) > len(self._nodes):
+            self._candidates = []
+            self._full_scan = True
+
+    def _count_before(self, num: int, inclusive: bool) -> int:
+        node, offset, count = self._root, 0, 0
+        while node is not None:
+            node_num = node.num + offset
+            if node_num < num or (inclusive and node_num == num):
+                count += _size(node.left) + 1
+                offset += node.shift
+                node = node.right
+            else:
+                offset += node.shift
+                node = node.left
+        return count
+
+    def _get_num(self, node: _Node) -> int:
+        num, parent = node.num, node.parent
+        while parent is not None:
+            num += parent.shift
+            parent = parent.parent
+        return num
+
+    def _rank(self, node: _Node) -> int:
+        rank = _size(node.left)
+        while node.parent is not None:
+            if node is node.parent.right:
+                rank += _size(node.parent.left) + 1
+            node = node.parent
+        return rank
+
+    @staticmethod
+    def _first(node: _Node) -> _Node:
+        while node.left is not None:
+            node = node.left
+        return node
+
+    def _set_root(self, root: Optional[_Node]) -> None:
+        self._root = root
+        if root is not None:
+            root.parent = None
+
+    @staticmethod
+    def _push(node: _Node) -> None:
+        if node.shift:
+            for child in (node.left, node.right):
+                if child is not None:
+                    child.num += node.shift
+                    child.shift += node.shift
+            node.shift = 0
+
+    @staticmethod
+    def _update(node: _Node) -> None:
+        node.size = 1 + _size(node.left) + _size(node.right)
+        if node.left is not None:
+            node.left.parent = node
+        if node.right is not None:
+            node.right.parent = node
+
+    def _split_by_num(self, node: Optional[_Node], num: int, inclusive: bool):
+        if node is None:
+            return None, None
+        self._push(node)
+        if node.num < num or (inclusive and node.num == num):
+            left, right = self._split_by_num(node.right, num, inclusive)
+            node.right = left
+            self._update(node)
+            if right is not None:
+                right.parent = None
+            return node, right
+
+        left, right = self._split_by_num(node.left, num, inclusive)
+        node.left = right
+        self._update(node)
+        if left is not None:
+            left.parent = None
+        return left, node
+
+    def _split_by_rank(self, node: Optional[_Node], rank: int):
+        if node is None:
+            return None, None
+        self._push(node)
+        if _size(node.left) < rank:
+            left, right = self._split_by_rank(node.right, rank - _size(node.left) - 1)
+            node.right = left
+            self._update(node)
+            if right is not None:
+                right.parent = None
+            return node, right
+
+        left, right = self._split_by_rank(node.left, rank)
+        node.left = right
+        self._update(node)
+        if left is not None:
+            left.parent = None
+        return left, node
+
+    def _merge(self, left: Optional[_Node], right: Optional[_Node]) -> Optional[_Node]:
+        if left is None or right is None:
+            return left if right is None else right
+        if left.priority > right.priority:
+            self._push(left)
+            left.right = self._merge(left.right, right)
+            self._update(left)
+            return left
+
+        self._push(right)
+        right.left = self._merge(left, right.left)
+        self._update(right)
+        return right
+
+
+class CellNumMapping(MutableMapping):
+    # cell numbers of ordered cells come from the order itself, cells that are
+    # not ordered (e.g. dropped by a save) keep their last known number here
+    def __init__(self, order: CellOrder):
+        self.order = order
+        self.detached = {}
+
+    def __getitem__(self, cell_index: str) -> int:
+        if self.order.has_cell(cell_index):
+            return self.order.get_num(cell_index)
+        return self.detached[cell_index]
+
+    def __setitem__(self, cell_index: str, num: int) -> None:
+        if self.order.has_cell(cell_index):
+            self.order.insert(cell_index, num)
+        else:
+            self.detached[cell_index] = num
+
+    def __delitem__(self, cell_index: str) -> None:
+        if self.order.has_cell(cell_index):
+            self.order.remove(cell_index)
+        else:
+            del self.detached[cell_index]
+
+    def __contains__(self, cell_index) -> bool:
+        return self.order.has_cell(cell_index) or cell_index in self.detached
+
+    def __iter__(self) -> Iterator[str]:
+        yield from (cell_index for cell_index, _ in self.order)
+        yield from self.detached
+
+    def __len__(self) -> int:
+        return len(self.order) + len(self.detached)
+
+    def detach_all(self) -> None:
+        self.detached.update({cell_index: num for cell_index, num in self.order})
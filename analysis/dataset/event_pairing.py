@@ -0,0 +1,108 @@
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+
+@dataclass
+class QueueMatches:
+    # positions of matched openers and closers, in the order the closers arrive
+    openers: np.ndarray
+    closers: np.ndarray
+    # start of every matched pair: the opener time, or the previous finish if the opener waited in the queue
+    starts: np.ndarray
+    # closers that matched nothing, repeated if they arrived at an empty queue
+    unexpected: np.ndarray
+    # openers left in the queue, in queue order
+    unfinished: np.ndarray
+
+
+def get_truthy_mask(labels) -> np.ndarray:
+    return np.fromiter(map(bool, labels), dtype=bool, count=len(labels))
+
+
+def pair_last_openers(
+        is_opener: np.ndarray, is_closer: np.ndarray, opener_valid: Optional[np.ndarray] = None
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # a closer takes the latest opener seen since the previous closer, other closers stay unmatched
+    is_opener, is_closer = np.asarray(is_opener, dtype=bool), np.asarray(is_closer, dtype=bool)
+    positions = np.arange(len(is_opener))
+
+    last_opener = np.maximum.accumulate(np.where(is_opener, positions, -1))
+    last_closer = np.maximum.accumulate(np.where(is_closer, positions, -1))
+    previous_closer = np.concatenate(([-1], last_closer[:-1]))
+
+    closers = np.flatnonzero(is_closer)
+    openers = last_opener[closers]
+    matched = openers > previous_closer[closers]
+    if opener_valid is not None:
+        matched &= np.asarray(opener_valid, dtype=bool)[openers]
+
+    return openers[matched], closers[matched], closers[~matched]
+
+
+def _grouped_cumulative_min(values: np.ndarray, groups: np.ndarray) -> np.ndarray:
+    # shifting every next group below the previous ones restarts the running minimum at group borders
+    shift = 2 * (np.abs(values).max(initial=0) + 1)
+    return np.minimum.accumulate(values - groups * shift) + groups * shift
+
+
+def match_queue(is_opener: np.ndarray, is_closer: np.ndarray, keys: np.ndarray, times: np.ndarray) -> QueueMatches:
+    is_opener, is_closer = np.asarray(is_opener, dtype=bool), np.asarray(is_closer, dtype=bool)
+    times = np.asarray(times)
+    n = len(is_opener)
+    if n == 0:
+        empty = np.array([], dtype=np.int64)
+        return QueueMatches(empty, empty, times[:0], empty, empty)
+
+    positions = np.arange(n)
+    steps = is_opener.astype(np.int64) - is_closer
+
+    # every key is a stack: a closer pops the latest opener of its key, a closer of an empty stack is unmatched
+    key_codes = pd.factorize(np.asarray(keys), use_na_sentinel=False)[0]
+    order = np.argsort(key_codes, kind='stable')
+    key_sorted, steps_sorted = key_codes[order], steps[order]
+    group_start = np.ones(n, dtype=bool)
+    group_start[1:] = key_sorted[1:] != key_sorted[:-1]
+    group = np.cumsum(group_start) - 1
+
+    walk = np.cumsum(steps_sorted)
+    walk -= (walk - steps_sorted)[group_start][group]
+    # the stack depth is the walk reflected at zero, closers that would go below it do not pop anything
+    floor = np.minimum(_grouped_cumulative_min(walk, group), 0)
+    depth = walk - floor
+    depth_before = np.concatenate(([0], depth[:-1]))
+    depth_before[group_start] = 0
+
+    depth_before_events = np.empty(n, dtype=np.int64)
+    depth_before_events[order] = depth_before
+    depth_events = np.empty(n, dtype=np.int64)
+    depth_events[order] = depth
+    matched_closer = is_closer & (depth_before_events > 0)
+
+    # on every level of a stack pushes and pops alternate, so a pop pairs with the element right before it
+    levels = np.where(is_opener, depth_events, depth_before_events)
+    candidates = np.flatnonzero(is_opener | matched_closer)
+    candidates = candidates[np.lexsort((candidates, levels[candidates], key_codes[candidates]))]
+    is_pop = matched_closer[candidates]
+    closers = candidates[1:][is_pop[1:]]
+    openers = candidates[:-1][is_pop[1:]]
+    closer_order = np.argsort(closers, kind='stable')
+    closers, openers = closers[closer_order], openers[closer_order]
+
+    # the queue spans all keys, its start time moves with executions at an empty queue and with every finish
+    queue_size = np.cumsum(is_opener.astype(np.int64) - matched_closer)
+    empty_before = np.concatenate(([True], queue_size[:-1] == 0))
+    moves_start = (is_opener & empty_before) | matched_closer
+    last_move = np.maximum.accumulate(np.where(moves_start, positions, -1))
+    previous_move = np.concatenate(([-1], last_move[:-1]))
+    starts = np.maximum(times[openers], times[previous_move[closers]])
+
+    unmatched_closers = np.flatnonzero(is_closer & ~matched_closer)
+    unexpected = np.repeat(unmatched_closers, 1 + empty_before[unmatched_closers])
+    is_finished = np.zeros(n, dtype=bool)
+    is_finished[openers] = True
+    unfinished = np.flatnonzero(is_opener & ~is_finished)
+
+    return QueueMatches(openers, closers, starts, unexpected, unfinished)
@@ -0,0 +1,220 @@
+import copy
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Iterator, Optional
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from analysis.dataset.loaders import concat_logs
+from analysis.dataset.notebook_state import NotebookState, Cell, delete_duplicates
+
+STATE_COLUMNS = ['state_num', 'cell_index', 'cell_num', 'cell_source']
+
+
+@dataclass
+class StateDelta:
+    # visible (cell_index, cell_num) pairs, the same tuple object as in the previous state if nothing moved
+    order: tuple
+    # cell sources written by the action, usually a single cell
+    sources: dict = field(default_factory=dict)
+
+
+class KernelEvolution:
+    def __init__(self, kernel_id: str, kernel_df: pd.DataFrame, filter_state: bool = True, checkpoint_every: int = 64):
+        self.kernel_id = kernel_id
+        self.filter_state = filter_state
+        self.checkpoint_every = checkpoint_every
+
+        self.log_df = kernel_df.iloc[:0]
+        self.deltas = [StateDelta(order=())]
+        self.checkpoints = {0: {}}
+        self.state = NotebookState()
+        self._order_key = None
+
+        self.extend(kernel_df)
+
+    def __len__(self) -> int:
+        return len(self.deltas)
+
+    def extend(self, kernel_df: pd.DataFrame) -> None:
+        for log_row in kernel_df.to_dict('records'):
+            self.state.update_state(log_row)
+            if self.filter_state:
+                self.state = delete_duplicates(self.state)
+            self.deltas.append(self._get_delta(log_row))
+
+            if self.state.state_num % self.checkpoint_every == 0:
+                self.checkpoints[self.state.state_num] = dict(self.state.index_source_mapping)
+
+        self.log_df = concat_logs(self.log_df, kernel_df) if len(self.log_df) else kernel_df
+
+    def _get_delta(self, log_row: dict) -> StateDelta:
+        previous_order = self.deltas[-1].order
+        # cells only become visible when their source appears, so an unchanged order and source count mean the same cells
+        order_key = (self.state.index_order.version, len(self.state.index_source_mapping))
+        if order_key == self._order_key:
+            order = previous_order
+        else:
+            order = tuple((c.cell_index, c.cell_num) for c in self.state.cells)
+            if order == previous_order:
+                order = previous_order
+        self._order_key = order_key
+
+        if log_row['event'] == "save_notebook":
+            sources = dict(self.state.index_source_mapping)
+        elif log_row['event'] != "error":
+            sources = {log_row['cell_index']: log_row['cell_source']}
+        else:
+            sources = {}
+
+        return StateDelta(order=order, sources=sources)
+
+    def get_sources(self, state_num: int) -> dict:
+        checkpoint = max(n for n in self.checkpoints if n <= state_num)
+        sources = dict(self.checkpoints[checkpoint])
+        for delta in self.deltas[checkpoint + 1:state_num + 1]:
+            sources.update(delta.sources)
+        return sources
+
+    def get_cells(self, state_num: int) -> list[Cell]:
+        sources = self.get_sources(state_num)
+        return [Cell(idx, num, sources[idx]) for idx, num in self.deltas[state_num].order]
+
+    def get_state_dataframe(self, state_num: int) -> pd.DataFrame:
+        return self._to_dataframe(range(state_num, state_num + 1))
+
+    def to_dataframe(self, start: int = 1) -> pd.DataFrame:
+        return self._to_dataframe(range(max(start, 1), len(self.deltas)))
+
+    def _to_dataframe(self, state_nums: range) -> pd.DataFrame:
+        sources = self.get_sources(state_nums.start - 1) if state_nums.start > 0 else {}
+        counts, cell_index, cell_num, cell_source = [], [], [], []
+
+        for state_num in state_nums:
+            delta = self.deltas[state_num]
+            sources.update(delta.sources)
+            counts.append(len(delta.order))
+            for idx, num in delta.order:
+                cell_index.append(idx)
+                cell_num.append(num)
+                cell_source.append(sources[idx])
+
+        return build_states_dataframe(
+            self.kernel_id, self.log_df, state_nums, counts, cell_index, cell_num, cell_source
+        )
+
+
+class KernelReplay:
+    def __init__(self, kernel_id: str, kernel_df: pd.DataFrame, filter_state: bool = True, checkpoint_every: int = 64):
+        self.kernel_id = kernel_id
+        self.log_df = kernel_df
+        self.filter_state = filter_state
+        self.checkpoint_every = checkpoint_every
+        self.checkpoints = {0: NotebookState()}
+
+    def __len__(self) -> int:
+        return len(self.log_df) + 1
+
+    def get_state(self, state_num: int) -> NotebookState:
+        if not 0 <= state_num <= len(self.log_df):
+            raise IndexError(f"kernel {self.kernel_id} has no state {state_num}")
+
+        checkpoint = max(n for n in self.checkpoints if n <= state_num)
+        state = copy.deepcopy(self.checkpoints[checkpoint])
+        for log_row in self.log_df.iloc[checkpoint:state_num].to_dict('records'):
+            state.update_state(log_row)
+            if self.filter_state:
+                state = delete_duplicates(state)
+            if state.state_num % self.checkpoint_every == 0 and state.state_num not in self.checkpoints:
+                self.checkpoints[state.state_num] = copy.deepcopy(state)
+        return state
+
+    def get_state_dataframe(self, state_num: int) -> pd.DataFrame:
+        cells = self.get_state(state_num).cells
+        return build_states_dataframe(
+            self.kernel_id, self.log_df, range(state_num, state_num + 1), [len(cells)],
+            [c.cell_index for c in cells], [c.cell_num for c in cells], [c.cell_source for c in cells]
+        )
+
+
+def build_states_dataframe(
+        kernel_id: str, log_df: pd.DataFrame, state_nums: range,
+        counts: list, cell_index: list, cell_num: list, cell_source: list
+) -> pd.DataFrame:
+    counts = np.asarray(counts, dtype=int)
+    rows = np.repeat(np.asarray(state_nums, dtype=int), counts)
+    # every state repeats the log row of the action that produced it, indexed by position inside the state
+    df = log_df.iloc[rows - 1].drop(columns=STATE_COLUMNS, errors='ignore')
+    df.insert(0, 'state_num', rows)
+    df.insert(1, 'cell_index', cell_index)
+    df.insert(2, 'cell_num', cell_num)
+    df.insert(3, 'cell_source', cell_source)
+    df.index = np.arange(len(df)) - np.repeat(np.cumsum(counts) - counts, counts)
+    df['kernel_id'] = kernel_id
+
+    return df
+
+
+def _build_kernel_evolution(args: tuple) -> KernelEvolution:
+    kernel_id, kernel_df, kwargs = args
+    return KernelEvolution(kernel_id, kernel_df, **kwargs)
+
+
+class NotebookEvolution:
+    def __init__(self, kernels: dict[str, KernelEvolution], kernel_kwargs: Optional[dict] = None):
+        self.kernels = kernels
+        self.kernel_kwargs = kernel_kwargs or {}
+
+    @classmethod
+    def from_dataframe(
+            cls, df: pd.DataFrame, progress: bool = True, n_jobs: int = 1, chunksize: int = 1, **kwargs
+    ) -> "NotebookEvolution":
+        # groups come in the order of the first appearance of every kernel, the same as df.kernel_id.unique()
+        partitions = [
+            (kernel_id, kernel_df, kwargs)
+            for kernel_id, kernel_df in df.groupby('kernel_id', sort=False, observed=True)
+        ]
+
+        if n_jobs == 1:
+            kernels = map(_build_kernel_evolution, partitions)
+            executor = None
+        else:
+            executor = ProcessPoolExecutor(max_workers=None if n_jobs == -1 else n_jobs)
+            kernels = executor.map(_build_kernel_evolution, partitions, chunksize=chunksize)
+
+        try:
+            kernels = tqdm(kernels, total=len(partitions)) if progress else kernels
+            return cls({kernel.kernel_id: kernel for kernel in kernels}, kwargs)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    def __getitem__(self, kernel_id: str) -> KernelEvolution:
+        return self.kernels[kernel_id]
+
+    def __iter__(self) -> Iterator[KernelEvolution]:
+        return iter(self.kernels.values())
+
+    def __len__(self) -> int:
+        return len(self.kernels)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        return pd.concat([kernel.to_dataframe() for kernel in self])
+
+    def update(self, df: pd.DataFrame, new_rows: pd.DataFrame) -> dict[str, int]:
+        # returns the number of states every changed kernel kept, 0 for kernels replayed from scratch
+        kept_states = {}
+        for kernel_id, kernel_rows in new_rows.groupby('kernel_id', sort=False, observed=True):
+            kernel = self.kernels.get(kernel_id)
+            if kernel is not None and kernel_rows.time.min() >= kernel.log_df.time.max():
+                kept_states[kernel_id] = len(kernel)
+                kernel.extend(kernel_rows)
+            else:
+                kept_states[kernel_id] = 0
+                kernel_df = df[df.kernel_id == kernel_id]
+                self.kernels[kernel_id] = KernelEvolution(kernel_id, kernel_df, **self.kernel_kwargs)
+
+        self.kernels = {kernel_id: self.kernels[kernel_id] for kernel_id in df.kernel_id.unique() if kernel_id in self.kernels}
+        return kept_states
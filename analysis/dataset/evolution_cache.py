@@ -0,0 +1,112 @@
+import base64
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+CACHE_VERSION = 2
+DTYPES_METADATA_KEY = b'june_dtypes'
+CATEGORICALS_METADATA_KEY = b'june_categoricals'
+
+
+def get_fingerprint(df: pd.DataFrame, filter_state: bool = True) -> str:
+    digest = hashlib.sha256()
+    digest.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    digest.update(json.dumps({
+        'columns': [str(c) for c in df.columns],
+        'filter_state': filter_state,
+        'version': CACHE_VERSION,
+    }).encode())
+    return digest.hexdigest()[:16]
+
+
+def get_cache_path(cache_dir: str | os.PathLike, fingerprint: str) -> Path:
+    return Path(cache_dir) / f"evolution_{fingerprint}.parquet"
+
+
+def _is_string_column(column: pd.Series) -> bool:
+    return column.dtype == object and pd.api.types.infer_dtype(column, skipna=True) in ('string', 'empty')
+
+
+def _has_string_categories(dtype: pd.CategoricalDtype) -> bool:
+    return pd.api.types.infer_dtype(dtype.categories, skipna=True) in ('string', 'empty')
+
+
+def _dump_categories(dtype: pd.CategoricalDtype) -> str:
+    sink = pa.BufferOutputStream()
+    table = pa.table({'categories': pa.array(dtype.categories)})
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return base64.b64encode(sink.getvalue().to_pybytes()).decode()
+
+
+def _load_categories(dump: str) -> pd.Index:
+    table = pa.ipc.open_stream(base64.b64decode(dump)).read_all()
+    return pd.Index(table.column('categories').to_pandas()).rename(None)
+
+
+def write_evolution_cache(df: pd.DataFrame, path: str | os.PathLike) -> None:
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    # sources and ids repeat in every state, so they are stored once in the dictionary of a categorical column
+    encoded = df.copy(deep=False)
+    categoricals = {}
+    for column in df.columns:
+        if _is_string_column(df[column]):
+            encoded[column] = df[column].astype('category')
+        if not isinstance(encoded[column].dtype, pd.CategoricalDtype):
+            continue
+        dtype = encoded[column].dtype
+        categoricals[column] = {'ordered': bool(dtype.ordered), 'categories': None}
+        if not _has_string_categories(dtype):
+            # parquet keeps only string dictionaries, other categories are written next to the dtypes and the
+            # column keeps the codes
+            categoricals[column]['categories'] = _dump_categories(dtype)
+            encoded[column] = encoded[column].cat.codes
+
+    table = pa.Table.from_pandas(encoded, preserve_index=True)
+    dtypes = json.dumps({column: str(dtype) for column, dtype in df.dtypes.items()})
+    categoricals = json.dumps(categoricals)
+    table = table.replace_schema_metadata({
+        **table.schema.metadata, DTYPES_METADATA_KEY: dtypes.encode(), CATEGORICALS_METADATA_KEY: categoricals.encode()
+    })
+
+    tmp_path = path.with_suffix('.tmp')
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def read_evolution_cache(path: str | os.PathLike) -> pd.DataFrame:
+    metadata = pq.read_schema(path).metadata
+    dtypes = json.loads(metadata[DTYPES_METADATA_KEY])
+    categoricals = json.loads(metadata[CATEGORICALS_METADATA_KEY])
+    # reading the string columns as dictionaries keeps them categorical, with their unused categories, even when
+    # the pandas metadata of the file is lost
+    dictionaries = [column for column, categorical in categoricals.items() if categorical['categories'] is None]
+    table = pq.read_table(path, memory_map=True, read_dictionary=dictionaries)
+    df = table.to_pandas()
+
+    for column, categorical in categoricals.items():
+        if categorical['categories'] is not None:
+            dtype = pd.CategoricalDtype(_load_categories(categorical['categories']), categorical['ordered'])
+            df[column] = pd.Categorical.from_codes(df[column].to_numpy(), dtype=dtype)
+        elif not isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype('category')
+        if df[column].cat.ordered != categorical['ordered']:
+            df[column] = df[column].cat.as_ordered() if categorical['ordered'] else df[column].cat.as_unordered()
+
+    for column, dtype in dtypes.items():
+        if column in categoricals and dtype == 'object':
+            # taking from the categories keeps a single string object per distinct value, code -1 takes None
+            categories = np.append(np.asarray(df[column].cat.categories, dtype=object), None)
+            df[column] = categories.take(df[column].cat.codes.values)
+        elif column not in categoricals and str(df[column].dtype) != dtype:
+            df[column] = df[column].astype(dtype)
+
+    return df
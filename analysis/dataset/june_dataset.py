@@ -1,23 +1,129 @@
-import json
-from ast import literal_eval
-from collections import deque
-from copy import deepcopy
-from dataclasses import dataclass, asdict
-from datetime import datetime
-from enum import StrEnum
+import os
+from typing import Optional
 
 import numpy as np
 import pandas as pd
-from tqdm import tqdm
+
+from analysis.dataset.evolution import NotebookEvolution, KernelEvolution, KernelReplay
+from analysis.dataset.event_pairing import pair_last_openers, get_truthy_mask
+from analysis.dataset.evolution_cache import (
+    get_fingerprint, get_cache_path, read_evolution_cache, write_evolution_cache
+)
+from analysis.dataset.loaders import (
+    LOG_COLUMNS, DEFAULT_CHUNK_SIZE, iter_sqlite_chunks, iter_parquet_chunks, prepare_logs, to_local_time, concat_logs,
+    get_output_types
+)
+from analysis.dataset.notebook_state import Cell, ActionName, NotebookState, delete_duplicates
 
 
 class JuNEDataset:
     def __init__(self, df):
         self.df_june = df
+        self.prepared = False
+        self.evolution = None
         self.df_states = None
+        self.state_index = None
+        self.kernel_rows = None
+        self.action_positions = None
+        self.replays = {}
+        self.metrics_cache = {}
+        self.prepare_rows = self._preprocess_dataframe_columns
+
+    @classmethod
+    def from_sqlite(
+            cls, database_path: str | os.PathLike, columns: Optional[list[str]] = None,
+            kernel_ids: Optional[list[str]] = None, start=None, end=None, chunksize: int = DEFAULT_CHUNK_SIZE
+    ) -> "JuNEDataset":
+        return cls._from_chunks(iter_sqlite_chunks(database_path, columns, kernel_ids, start, end, chunksize))
+
+    @classmethod
+    def from_parquet(
+            cls, path: str | os.PathLike, columns: Optional[list[str]] = None,
+            kernel_ids: Optional[list[str]] = None, start=None, end=None, chunksize: int = DEFAULT_CHUNK_SIZE
+    ) -> "JuNEDataset":
+        return cls._from_chunks(iter_parquet_chunks(path, columns, kernel_ids, start, end, chunksize))
+
+    @classmethod
+    def _from_chunks(cls, chunks) -> "JuNEDataset":
+        chunks = list(chunks)
+        df = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(columns=list(LOG_COLUMNS))
+        dataset = cls(prepare_logs(df))
+        dataset.prepared = True
+        dataset.prepare_rows = prepare_logs
+        return dataset
 
     def prepare_dataset(self):
-        self.df_june = self._preprocess_dataframe_columns(self.df_june)
+        if self.prepared:
+            return
+        self.df_june = self.prepare_rows(self.df_june)
+        self.prepared = True
+        self.kernel_rows = None
+        self.action_positions = None
+
+    def append(self, new_rows: pd.DataFrame) -> set[str]:
+        if self.prepared:
+            new_rows = self.prepare_rows(new_rows)
+        if not len(new_rows):
+            return set()
+
+        old_index = self.df_june.index
+        if pd.api.types.is_integer_dtype(old_index) and new_rows.index.isin(old_index).any():
+            new_rows = new_rows.set_axis(np.arange(len(new_rows)) + old_index.max() + 1)
+
+        is_sorted = not self.prepared or not len(self.df_june) or new_rows.time.min() >= self.df_june.time.max()
+        self.df_june = concat_logs(self.df_june, new_rows)
+        if not is_sorted:
+            self.df_june = self.df_june.sort_values('time', kind='stable')
+
+        changed = set(new_rows.kernel_id.unique())
+        self.state_index = None
+        self.kernel_rows = None
+        self.action_positions = None
+        self.replays = {key: replay for key, replay in self.replays.items() if key[0] not in changed}
+        for entry in self.metrics_cache.values():
+            entry['changed'] |= changed
+
+        evolution = self.evolution
+        if evolution is None and self.df_states is not None:
+            # the states were read from the disk cache, changed kernels are replayed from scratch
+            evolution = NotebookEvolution({})
+        if evolution is not None:
+            kept_states = evolution.update(self.df_june, new_rows)
+            if self.df_states is not None:
+                self.df_states = self._update_states_dataframe(evolution, kept_states)
+
+        return changed
+
+    def _update_states_dataframe(self, evolution: NotebookEvolution, kept_states: dict[str, int]) -> pd.DataFrame:
+        kernel_ranges = StateIndex(self.df_states).kernel_ranges
+        frames = []
+        for kernel_id in self.df_june.kernel_id.unique():
+            kept = kept_states.get(kernel_id)
+            if kernel_id in kernel_ranges and kept != 0:
+                frames.append(self.df_states.iloc[slice(*kernel_ranges[kernel_id])])
+            if kept is not None:
+                frames.append(evolution[kernel_id].to_dataframe(start=kept))
+
+        df_states = pd.concat(frames)
+        for column in df_states.columns.intersection(self.df_june.columns):
+            if isinstance(self.df_states[column].dtype, pd.CategoricalDtype):
+                df_states[column] = df_states[column].astype(self.df_june[column].dtype)
+        return df_states
+
+    def calculate_metrics(self, metrics, key: Optional[str] = None) -> pd.DataFrame:
+        key = key or type(metrics).__name__
+        if key not in self.metrics_cache:
+            self.metrics_cache[key] = {
+                'metrics': metrics, 'result': metrics.calculate_metrics(self.df_june), 'changed': set()
+            }
+
+        entry = self.metrics_cache[key]
+        if entry['changed']:
+            changed = entry['changed']
+            update = entry['metrics'].calculate_metrics(self.df_june[self.df_june.kernel_id.isin(changed)])
+            entry['result'] = replace_kernels(entry['result'], update, changed)
+            entry['changed'] = set()
+        return entry['result']
 
     @property
     def df(self):
@@ -31,8 +137,7 @@ class JuNEDataset:
 
         df = df.fillna(np.NaN).replace(np.NaN, None).iloc[:]
 
-        df['time'] = pd.to_datetime(df['time'])
-        df['time'] = df.time.apply(lambda x: datetime.fromtimestamp(datetime.timestamp(x)))
+        df['time'] = to_local_time(df['time'])
         df = df.sort_values(by=['time']).replace({np.nan: None})
 
         df['task'] = 'task2'
@@ -45,260 +150,154 @@ class JuNEDataset:
 
         return df
 
-    def to_evolution_dataframe(self, **kwargs) -> pd.DataFrame:
+    def to_evolution(self, **kwargs) -> NotebookEvolution:
+        if self.evolution is None:
+            self.evolution = NotebookEvolution.from_dataframe(self.df_june, **kwargs)
+        return self.evolution
+
+    def to_evolution_dataframe(self, cache_dir: Optional[str | os.PathLike] = None, **kwargs) -> pd.DataFrame:
         if self.df_states is not None:
             return self.df_states
 
-        kernel_dataframes = [
-            self.get_kernel_states(kernel_id, **kwargs)
-            for kernel_id in tqdm(self.df_june.kernel_id.unique())
-        ]
-        merged_df = pd.concat(kernel_dataframes)
-        self.df_states = merged_df
-        return merged_df
-
-    def get_kernel_states(self, kernel_id: str, filter_state: bool = True) -> pd.DataFrame:
-        kernel_df = self.df_june.groupby('kernel_id').get_group(kernel_id)
+        cache_path = None
+        if cache_dir is not None:
+            fingerprint = get_fingerprint(self.df_june, filter_state=kwargs.get('filter_state', True))
+            cache_path = get_cache_path(cache_dir, fingerprint)
+            if cache_path.exists():
+                self.df_states = read_evolution_cache(cache_path)
+                return self.df_states
 
-        state, state_tmp = NotebookState(), NotebookState()
-        states = [state_tmp.to_dataframe()]
+        self.df_states = self.to_evolution(**kwargs).to_dataframe()
+        if cache_path is not None:
+            write_evolution_cache(self.df_states, cache_path)
+        return self.df_states
 
-        for state_num, log_row in kernel_df.iterrows():
-            action_id = log_row.action_id
-            state_tmp = deepcopy(state)
-            state_tmp.update_state(log_row)
-            if filter_state:
-                state_tmp = delete_duplicates(state_tmp)
-
-            df = state_tmp.to_dataframe()
-            df['action_id'] = action_id
-            df['event'] = log_row.event
-
-            states.append(df)
-            state = state_tmp
-
-        state_df = pd.concat(states)
-        state_df['kernel_id'] = kernel_id
+    def get_kernel_states(self, kernel_id: str, filter_state: bool = True) -> pd.DataFrame:
+        kernel_df = self.df_june[self.df_june.kernel_id == kernel_id]
+        return KernelEvolution(kernel_id, kernel_df, filter_state=filter_state).to_dataframe()
 
-        return state_df
+    def get_state_index(self) -> "StateIndex":
+        if self.state_index is None:
+            self.state_index = StateIndex(self.to_evolution_dataframe())
+        return self.state_index
 
     def get_notebook_state_by_id(self, action_id: int) -> pd.DataFrame:
         df = self.to_evolution_dataframe()
-        row = df.iloc[action_id]
-        state_num = row.state_num
-        kernel_id = row.kernel_id
-        return (
-            df.groupby('kernel_id').get_group(kernel_id).
-            groupby("state_num").get_group(state_num)
-        )
+        return df.iloc[self.get_state_index().get_row_range(action_id)]
+
+    def get_state_rows(self, kernel_id: str, state_num: int) -> pd.DataFrame:
+        df = self.to_evolution_dataframe()
+        return df.iloc[self.get_state_index().get_state_range(kernel_id, state_num)]
+
+    def get_kernel_rows(self) -> dict[str, np.ndarray]:
+        if self.kernel_rows is None:
+            self.kernel_rows = self.df_june.groupby('kernel_id', sort=False, observed=True).indices
+        return self.kernel_rows
+
+    def get_action_positions(self) -> dict[int, int]:
+        if self.action_positions is None:
+            # the first row of every action id
+            action_ids, positions = np.unique(self.df_june.action_id.to_numpy(), return_index=True)
+            self.action_positions = dict(zip(action_ids.tolist(), positions.tolist()))
+        return self.action_positions
+
+    def get_kernel_state(self, kernel_id: str, state_num: int, filter_state: bool = True) -> pd.DataFrame:
+        if self.evolution is not None and self.evolution[kernel_id].filter_state == filter_state:
+            return self.evolution[kernel_id].get_state_dataframe(state_num)
+
+        if (kernel_id, filter_state) not in self.replays:
+            kernel_df = self.df_june.iloc[self.get_kernel_rows()[kernel_id]]
+            self.replays[(kernel_id, filter_state)] = KernelReplay(kernel_id, kernel_df, filter_state=filter_state)
+        return self.replays[(kernel_id, filter_state)].get_state_dataframe(state_num)
+
+    def get_state_by_action_id(self, action_id: int, filter_state: bool = True) -> pd.DataFrame:
+        position = self.get_action_positions().get(action_id)
+        if position is None:
+            raise KeyError(f"No action with id {action_id}")
+        kernel_id = self.df_june.kernel_id.iat[position]
+        state_num = np.searchsorted(self.get_kernel_rows()[kernel_id], position) + 1
+        return self.get_kernel_state(kernel_id, state_num, filter_state)
+
+    def get_states_at(self, timestamp, filter_state: bool = True) -> pd.DataFrame:
+        timestamp = np.datetime64(pd.Timestamp(timestamp))
+        times = self.df_june.time.values
+        frames = []
+        for kernel_id, rows in self.get_kernel_rows().items():
+            # logs are sorted by time, so the state at the timestamp follows the last action before it
+            state_num = np.searchsorted(times[rows], timestamp, side='right')
+            if state_num:
+                frames.append(self.get_kernel_state(kernel_id, state_num, filter_state))
+        return pd.concat(frames) if frames else pd.DataFrame()
 
     @staticmethod
     def match_executions(cell_df):
+        cell_df['result'] = get_output_types(cell_df)
+
+        event = cell_df.event.to_numpy()
+        executions, finishes, _ = pair_last_openers(
+            event == 'execute', event == 'finished_execute', get_truthy_mask(cell_df.index)
+        )
 
-        looking_for_finish = False
-        found = {
-            'executions': [],
-            'unexecuted': [],
-            'hagning_finish': []
-        }
-
-        cell_df['result'] = cell_df.cell_output.apply(
-            lambda x: '' if (x is None) | (x == '[]') else '' + literal_eval(x)[0]['output_type'])
-
-        for i, row in cell_df.iterrows():
-            if row.event == 'execute':
-                looking_for_finish = i
-            if row.event == 'finished_execute':
-                if looking_for_finish:
-                    found['executions'].append(tuple([looking_for_finish, i]))
-                    looking_for_finish = None
-                else:
-                    found['hagning_finish'].append(i)
-
-        cell_df['execution_time'] = None
-        cell_df['execution_result'] = 'ok'
-        for execution in found['executions']:
-            cell_df.loc[execution[0], 'execution_time'] = cell_df.loc[execution[1], 'time']
-            cell_df.loc[execution[0], 'execution_result'] = cell_df.loc[execution[1], 'result']
+        execution_time = np.full(len(cell_df), None, dtype=object)
+        execution_time[executions] = list(cell_df.time.iloc[finishes])
+        execution_result = np.full(len(cell_df), 'ok', dtype=object)
+        execution_result[executions] = cell_df.result.to_numpy()[finishes]
+        cell_df['execution_time'] = pd.Series(execution_time, index=cell_df.index, dtype=object)
+        cell_df['execution_result'] = execution_result
 
         return cell_df
 
     @staticmethod
     def match_edits(cell_df: pd.DataFrame) -> pd.DataFrame:
-
-        edit_state = None
-        found = {
-            'edited': [],
-            'unedited': [],
-            'uncreated': [],
-        }
-
-        for i, row in cell_df.iterrows():
-            if (row.event == 'finished_execute') or (row.event == 'create'):
-                edit_state = i
-            if row.event == 'execute':
-                if edit_state:
-                    found['edited'].append(tuple([edit_state, i]))
-                    edit_state = None
-                else:
-                    found['uncreated'].append(i)
-
-        cell_df['edited_time'] = None
-        for edited in found['edited']:
-            cell_df.loc[edited[0], 'edited_time'] = cell_df.loc[edited[1], 'time']
-
-        return cell_df
-
-
-@dataclass
-class Cell:
-    cell_index: str
-    cell_num: int
-    cell_source: str = None
-
-
-class ActionName(StrEnum):
-    EXECUTE = "execute"
-    RENDERED = "rendered"
-    CREATE = "create"
-    DELETE = "delete"
-    SAVE = "save_notebook"
-
-
-class NotebookState:
-    def __init__(self):
-        self.actions_mapping = {
-            ActionName.EXECUTE: self.execute_cell,
-            ActionName.RENDERED: self.execute_cell,
-            ActionName.CREATE: self.create_cell,
-            ActionName.DELETE: self.delete_cell,
-        }
-        self.index_order = deque()
-        self.index_num_mapping = {}
-        self.index_source_mapping = {}
-        self.log = dict()
-        self.state_num = 0
-
-    def display_notebook(self, cell_separator: str = "[CELL_SEPARATOR]") -> None:
-        for cell in self.cells:
-            print(f"[CELL INDEX {cell.cell_index}]\n", cell.cell_source)
-            print(cell_separator)
-
-    @property
-    def cells(self):
-        return [
-            Cell(idx, self.index_num_mapping[idx], self.index_source_mapping[idx])
-            for (idx, num) in self.index_order if
-            idx in self.index_source_mapping.keys()
-        ]
-
-    def to_dataframe(self) -> pd.DataFrame:
-        cells_dictionaries = [asdict(c) for c in self.cells]
-        df = pd.DataFrame(cells_dictionaries)
-        df['state_num'] = self.state_num
-
-        for key, value in self.log.items():
-            if key not in list(df):
-                df[key] = value
-        return df
-
-    def create_cell(self, cell: Cell) -> None:
-        current_index, current_num = cell.cell_index, cell.cell_num
-        if current_index in self.index_num_mapping:
-            return
-
-        self.index_num_mapping[current_index] = current_num + 1
-        for i, (index_i, num_i) in enumerate(self.index_order):
-            if num_i >= current_num + 1:
-                self.index_num_mapping[index_i] += 1
-                self.index_order[i] = (index_i, num_i + 1)
-
-        self.index_order.append((current_index, current_num + 1))
-        self.index_order = sorted(self.index_order, key=lambda x: x[1])
-
-    def delete_cell(self, cell: Cell) -> None:
-        current_index = cell.cell_index
-        current_num = (
-            self.index_num_mapping[current_index]
-            if current_index in self.index_num_mapping else cell.cell_num
+        event = cell_df.event.to_numpy()
+        edits, executions, _ = pair_last_openers(
+            (event == 'finished_execute') | (event == 'create'), event == 'execute', get_truthy_mask(cell_df.index)
         )
-        if current_index in self.index_num_mapping:
-            list_index_to_remove = None
-            for i, (index_i, num_i) in enumerate(self.index_order):
-                if index_i == current_index:
-                    list_index_to_remove = i
-                    if current_num is None:
-                        current_num = num_i
-                    break
-
-            del self.index_num_mapping[current_index]
-            del self.index_order[list_index_to_remove]
-
-        if current_num is None:
-            return
-
-        for i, (index_i, num_i) in enumerate(self.index_order):
-            if num_i > current_num:
-                self.index_num_mapping[index_i] -= 1
-                self.index_order[i] = (index_i, num_i - 1)
 
-    def execute_cell(self, cell: Cell) -> None:
-        current_index, current_num = cell.cell_index, cell.cell_num
-        if (((current_index, current_num) in self.index_order)
-                and (current_index in self.index_num_mapping)):
-            return
-
-        list_indices_to_delete = []
-        for i, (index_i, num_i) in enumerate(self.index_order):
-            if (index_i == current_index) and (num_i != current_num):
-                list_indices_to_delete.append(i)
-
-        for i in list_indices_to_delete:
-            del self.index_order[i]
-
-        self.index_num_mapping[current_index] = current_num
-        self.index_order.append((current_index, current_num))
-        self.index_order = sorted(self.index_order, key=lambda x: x[1])
-
-    def initialize_indices(self, cells_json: str) -> None:
-        self.index_order = deque()
-        for num, cell_dict in enumerate(json.loads(cells_json)):
-            cell_index = cell_dict['id']
-            self.index_source_mapping[cell_index] = cell_dict['source']
-            self.index_num_mapping[cell_index] = num
-            self.index_order.append((cell_index, num))
-
-    def update_state(self, log: pd.Series) -> None:
-        action, cell_index, cell_num, cell_source = log.event, log.cell_index, log.cell_num, log.cell_source
-        cell_num = int(cell_num) if cell_num is not None else cell_num
-        self.log = log.to_dict()
-        self.state_num += 1
-        if action == "save_notebook":
-            self.initialize_indices(cell_source)
-            return
-
-        if action != "error":
-            self.index_source_mapping[cell_index] = cell_source
-
-        cell = Cell(cell_index=cell_index, cell_num=cell_num)
-
-        if action in self.actions_mapping:
-            self.actions_mapping[action](cell)
+        edited_time = np.full(len(cell_df), None, dtype=object)
+        edited_time[edits] = list(cell_df.time.iloc[executions])
+        cell_df['edited_time'] = pd.Series(edited_time, index=cell_df.index, dtype=object)
 
+        return cell_df
 
-def delete_duplicates(state: NotebookState) -> NotebookState:
-    list_index_to_delete = []
-    for i, (index_i, num_i) in enumerate(state.index_order):
-        for j, (index_j, num_j) in enumerate(state.index_order):
-            if j <= i:
-                continue
-            if num_i == num_j and index_i != index_j:
-                list_index_to_delete.append(j)
-                if index_j in state.index_num_mapping:
-                    del state.index_num_mapping[index_j]
 
-    state.index_order = [
-        p for i, p in enumerate(state.index_order)
-        if i not in set(list_index_to_delete)
-    ]
-    return state
+class StateIndex:
+    def __init__(self, df_states: pd.DataFrame):
+        kernel_codes, kernel_ids = pd.factorize(df_states.kernel_id)
+        state_nums = df_states.state_num.values
+        # rows of one state are contiguous in the evolution dataframe
+        changes = np.ones(len(df_states), dtype=bool)
+        changes[1:] = (kernel_codes[1:] != kernel_codes[:-1]) | (state_nums[1:] != state_nums[:-1])
+
+        self.starts = np.flatnonzero(changes)
+        kernel_starts = np.flatnonzero(np.diff(kernel_codes, prepend=-1) != 0)
+        self.kernel_ranges = dict(zip(
+            kernel_ids[kernel_codes[kernel_starts]],
+            zip(kernel_starts.tolist(), np.append(kernel_starts[1:], len(df_states)).tolist())
+        ))
+        self.ends = np.append(self.starts[1:], len(df_states))
+        self.ranges = dict(zip(
+            zip(kernel_ids[kernel_codes[self.starts]], state_nums[self.starts].tolist()),
+            zip(self.starts.tolist(), self.ends.tolist())
+        ))
+
+    def get_row_range(self, position: int) -> slice:
+        length = self.ends[-1] if len(self.ends) else 0
+        if not -length <= position < length:
+            raise IndexError("single positional indexer is out-of-bounds")
+        position = position + length if position < 0 else position
+        state = np.searchsorted(self.starts, position, side='right') - 1
+        return slice(self.starts[state], self.ends[state])
+
+    def get_state_range(self, kernel_id: str, state_num: int) -> slice:
+        start, end = self.ranges.get((kernel_id, state_num), (0, 0))
+        return slice(start, end)
+
+
+def replace_kernels(result: pd.DataFrame, update: pd.DataFrame, kernel_ids: set[str]) -> pd.DataFrame:
+    if 'kernel_id' in result.columns:
+        return pd.concat([result[~result.kernel_id.isin(kernel_ids)], update])
+
+    # metrics aggregated per kernel keep the kernels sorted, as groupby does
+    kept = result[~result.index.get_level_values('kernel_id').isin(kernel_ids)]
+    return pd.concat([kept, update]).sort_index()
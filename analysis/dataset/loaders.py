@@ -0,0 +1,248 @@
+import os
+import sqlite3
+from contextlib import closing
+from typing import Iterable, Iterator, Mapping, Optional
+
+import numpy as np
+import pandas as pd
+from dateutil.tz import tzlocal
+
+from analysis.metrics.utils.outputs import summarize_output
+
+LOG_COLUMNS = (
+    'action_id', 'time', 'session_id', 'kernel_id', 'notebook_name', 'event', 'cell_index', 'cell_num',
+    'cell_type', 'cell_source', 'cell_output', 'user_id', 'cell_label', 'task', 'expert',
+)
+CATEGORICAL_COLUMNS = ('event', 'kernel_id', 'notebook_name')
+DEFAULT_CHUNK_SIZE = 100_000
+SQLITE_DTYPES = {
+    'action_id': 'int64', 'cell_num': 'Int64', 'timestamp': 'Int64', 'output_count': 'Int64', 'output_bytes': 'Int64'
+}
+# the epoch milliseconds of the time strings, the same as the timestamp backfill of the server
+SQLITE_TIME_MS = "CAST(ROUND((julianday(user_logs.time) - 2440587.5) * 86400000) AS INTEGER)"
+
+
+def to_local_time(time: pd.Series) -> pd.Series:
+    # the same as datetime.fromtimestamp(datetime.timestamp(x)): aware times become naive local ones
+    if pd.api.types.is_numeric_dtype(time):
+        time = pd.to_datetime(time, unit='ms', utc=True)
+    else:
+        # the precision of the fractional seconds differs between the rows
+        time = pd.to_datetime(time, format='ISO8601')
+    if time.dt.tz is not None:
+        time = time.dt.tz_convert(tzlocal()).dt.tz_localize(None)
+    return time.astype('datetime64[ns]')
+
+
+def to_epoch_ms(value) -> Optional[int]:
+    if value is None:
+        return None
+    timestamp = pd.Timestamp(value)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.tz_localize(tzlocal())
+    return timestamp.value // 1_000_000
+
+
+def parse_epoch_ms(time: pd.Series) -> np.ndarray:
+    # time strings as the server parses them, the ones without a zone are UTC, NaN when missing or unparsable
+    parsed = pd.to_datetime(pd.Series(time), utc=True, format='ISO8601', errors='coerce')
+    return ((parsed - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(milliseconds=1)).to_numpy(dtype='float64')
+
+
+def get_time_mask(time: pd.Series, start=None, end=None) -> np.ndarray:
+    time_ms = parse_epoch_ms(time)
+    mask = np.ones(len(time), dtype=bool)
+    if start is not None:
+        mask &= time_ms >= to_epoch_ms(start)
+    if end is not None:
+        mask &= time_ms < to_epoch_ms(end)
+    return mask
+
+
+def prepare_logs(df: pd.DataFrame) -> pd.DataFrame:
+    df = df.rename(columns={'id': 'action_id'})
+    if 'timestamp' in df.columns:
+        time = to_local_time(df.pop('timestamp'))
+        if 'time' in df.columns and time.isna().any():
+            # rows written before the timestamp column existed only have the time string
+            time = time.fillna(to_local_time(df['time']))
+        df['time'] = time
+    elif 'time' in df.columns:
+        df['time'] = to_local_time(df['time'])
+
+    df = df.drop(columns=[c for c in ('ip_address', 'seq_num') if c in df.columns])
+    if 'time' in df.columns:
+        df = df.sort_values('time', kind='stable')
+
+    if 'task' not in df.columns and 'notebook_name' in df.columns:
+        df['task'] = np.where(df.notebook_name.str.contains('task1', na=False), 'task1', 'task2')
+    if 'expert' not in df.columns and 'user_id' in df.columns:
+        df['expert'] = df.user_id.str.contains('expert', na=False)
+    elif 'expert' in df.columns:
+        df['expert'] = df.expert.fillna(False).astype(bool)
+    if 'cell_num' in df.columns:
+        df['cell_num'] = df.cell_num.astype('Int64')
+    df['cell_label'] = df.cell_label.fillna("") if 'cell_label' in df.columns else ""
+
+    for column in CATEGORICAL_COLUMNS:
+        if column in df.columns:
+            df[column] = df[column].astype('category')
+
+    return df
+
+
+def get_output_types(df: pd.DataFrame) -> np.ndarray:
+    # the type of the first output, '' for events without outputs
+    output_types = np.full(len(df), '', dtype=object)
+    unknown = np.ones(len(df), dtype=bool)
+    if 'output_type' in df.columns:
+        known = df.output_type.notna().to_numpy()
+        output_types[known] = df.output_type.to_numpy()[known]
+        unknown &= ~known
+        if 'output_count' in df.columns:
+            unknown &= df.output_count.isna().to_numpy()
+    if 'cell_output' in df.columns:
+        # outputs logged before the summary columns existed are scanned, not parsed
+        outputs = df.cell_output.to_numpy()
+        for i in np.flatnonzero(unknown):
+            if isinstance(outputs[i], str):
+                output_types[i] = summarize_output(outputs[i])['output_type'] or ''
+    return output_types
+
+
+def get_output_type(event: Mapping) -> str:
+    # the same as get_output_types for a single event
+    if 'output_type' in event:
+        if pd.notna(event['output_type']):
+            return event['output_type']
+        if pd.notna(event.get('output_count')):
+            return ''
+    output = event.get('cell_output')
+    return (summarize_output(output)['output_type'] or '') if isinstance(output, str) else ''
+
+
+def concat_logs(df: pd.DataFrame, new_rows: pd.DataFrame) -> pd.DataFrame:
+    # categoricals are concatenated as categoricals only when both sides share the categories
+    new_rows = new_rows.copy(deep=False)
+    df = df.copy(deep=False)
+    for column in df.columns.intersection(new_rows.columns):
+        if isinstance(df[column].dtype, pd.CategoricalDtype):
+            categories = df[column].cat.categories.union(pd.Index(new_rows[column].dropna().unique()))
+            dtype = pd.CategoricalDtype(categories)
+            df[column], new_rows[column] = df[column].astype(dtype), new_rows[column].astype(dtype)
+    return pd.concat([df, new_rows])
+
+
+def _get_sqlite_query(
+        connection: sqlite3.Connection, columns: Optional[Iterable[str]],
+        kernel_ids: Optional[Iterable[str]], start, end
+) -> tuple[str, list, list[str]]:
+    table_columns = [row[1] for row in connection.execute("PRAGMA table_info(user_logs)")]
+    has_blobs = 'cell_source_hash' in table_columns
+    expressions = {'action_id': "user_logs.id"}
+    expressions.update({c: f"user_logs.{c}" for c in table_columns if c != 'id' and not c.endswith('_hash')})
+    if has_blobs:
+        # texts written after deduplication live in log_blobs
+        expressions['cell_source'] = "coalesce(source_blobs.content, user_logs.cell_source)"
+        expressions['cell_output'] = "coalesce(output_blobs.content, user_logs.cell_output)"
+
+    if columns is not None:
+        columns = set(columns) | {'action_id'}
+        if 'time' in columns and 'timestamp' in expressions:
+            columns.add('timestamp')
+        expressions = {name: e for name, e in expressions.items() if name in columns}
+
+    query = "SELECT " + ", ".join(f"{e} AS {name}" for name, e in expressions.items()) + " FROM user_logs"
+    if has_blobs:
+        query += (
+            " LEFT JOIN log_blobs AS source_blobs ON user_logs.cell_source_hash = source_blobs.hash"
+            " LEFT JOIN log_blobs AS output_blobs ON user_logs.cell_output_hash = output_blobs.hash"
+        )
+
+    conditions, params = [], []
+    if kernel_ids is not None:
+        kernel_ids = list(kernel_ids)
+        conditions.append(f"user_logs.kernel_id IN ({', '.join('?' * len(kernel_ids))})")
+        params += kernel_ids
+    # databases from before the timestamp column have only the time strings, they are compared as times too, and
+    # so are the rows that migrate_db has not backfilled yet
+    time_expression = SQLITE_TIME_MS
+    if 'timestamp' in table_columns:
+        time_expression = f"coalesce(user_logs.timestamp, {SQLITE_TIME_MS})"
+    for value, operator in ((start, '>='), (end, '<')):
+        if value is not None:
+            conditions.append(f"{time_expression} {operator} ?")
+            params.append(to_epoch_ms(value))
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+
+    return query + " ORDER BY user_logs.id", params, list(expressions)
+
+
+def iter_sqlite_chunks(
+        database_path: str | os.PathLike, columns: Optional[Iterable[str]] = None,
+        kernel_ids: Optional[Iterable[str]] = None, start=None, end=None, chunksize: int = DEFAULT_CHUNK_SIZE
+) -> Iterator[pd.DataFrame]:
+    with closing(sqlite3.connect(database_path)) as connection:
+        query, params, names = _get_sqlite_query(connection, columns, kernel_ids, start, end)
+        yield from pd.read_sql_query(
+            query, connection, params=params, chunksize=chunksize,
+            dtype={name: dtype for name, dtype in SQLITE_DTYPES.items() if name in names}
+        )
+
+
+def iter_parquet_chunks(
+        path: str | os.PathLike, columns: Optional[Iterable[str]] = None,
+        kernel_ids: Optional[Iterable[str]] = None, start=None, end=None, chunksize: int = DEFAULT_CHUNK_SIZE
+) -> Iterator[pd.DataFrame]:
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(path, format='parquet')
+    names = dataset.schema.names
+    id_column = 'id' if 'id' in names else 'action_id'
+    # time strings in different formats do not compare as strings, they are parsed after reading, for all the rows
+    # or only for the ones exported before their timestamp was backfilled
+    filter_time = start is not None or end is not None
+    has_timestamp = 'timestamp' in names
+    drop_time = False
+
+    if columns is not None:
+        columns = set(columns) | {'action_id'}
+        if filter_time and 'time' not in columns:
+            columns.add('time')
+            drop_time = True
+        if 'time' in columns and has_timestamp:
+            columns.add('timestamp')
+        columns = [c for c in names if c in columns or (c == 'id' and 'action_id' in columns)]
+
+    conditions = []
+    if kernel_ids is not None:
+        conditions.append(pc.field('kernel_id').isin(list(kernel_ids)))
+    if filter_time and has_timestamp:
+        for value, operator in ((start, '__ge__'), (end, '__lt__')):
+            if value is not None:
+                timestamp = pc.field('timestamp')
+                conditions.append(getattr(timestamp, operator)(to_epoch_ms(value)) | timestamp.is_null())
+    condition = None
+    for c in conditions:
+        condition = c if condition is None else condition & c
+
+    # the row groups are filtered by their statistics before being read
+    scanner = dataset.scanner(columns=columns, filter=condition, batch_size=chunksize)
+    for batch in scanner.to_batches():
+        if not batch.num_rows:
+            continue
+        df = batch.to_pandas().rename(columns={id_column: 'action_id'})
+        if filter_time:
+            if has_timestamp:
+                unparsed = df['timestamp'].isna().to_numpy()
+                mask = ~unparsed
+                mask[unparsed] = get_time_mask(df['time'][unparsed], start, end)
+            else:
+                mask = get_time_mask(df['time'], start, end)
+            df = df.loc[mask]
+            if drop_time:
+                df = df.drop(columns=[c for c in ('time', 'timestamp') if c in df.columns])
+        if len(df):
+            yield df
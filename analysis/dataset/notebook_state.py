@@ -0,0 +1,121 @@
+import json
+from dataclasses import dataclass, asdict
+from enum import StrEnum
+
+import pandas as pd
+
+from analysis.dataset.cell_order import CellOrder
+
+
+@dataclass
+class Cell:
+    cell_index: str
+    cell_num: int
+    cell_source: str = None
+
+
+class ActionName(StrEnum):
+    EXECUTE = "execute"
+    RENDERED = "rendered"
+    CREATE = "create"
+    DELETE = "delete"
+    SAVE = "save_notebook"
+
+
+class NotebookState:
+    def __init__(self):
+        self.actions_mapping = {
+            ActionName.EXECUTE: self.execute_cell,
+            ActionName.RENDERED: self.execute_cell,
+            ActionName.CREATE: self.create_cell,
+            ActionName.DELETE: self.delete_cell,
+        }
+        self.index_order = CellOrder()
+        self.index_num_mapping = self.index_order.nums
+        self.index_source_mapping = {}
+        self.log = dict()
+        self.state_num = 0
+
+    def display_notebook(self, cell_separator: str = "[CELL_SEPARATOR]") -> None:
+        for cell in self.cells:
+            print(f"[CELL INDEX {cell.cell_index}]\n", cell.cell_source)
+            print(cell_separator)
+
+    @property
+    def cells(self):
+        return [
+            Cell(idx, num, self.index_source_mapping[idx])
+            for (idx, num) in self.index_order if
+            idx in self.index_source_mapping.keys()
+        ]
+
+    def to_dataframe(self) -> pd.DataFrame:
+        cells_dictionaries = [asdict(c) for c in self.cells]
+        df = pd.DataFrame(cells_dictionaries)
+        df['state_num'] = self.state_num
+
+        for key, value in self.log.items():
+            if key not in list(df):
+                df[key] = value
+        return df
+
+    def create_cell(self, cell: Cell) -> None:
+        current_index, current_num = cell.cell_index, cell.cell_num
+        if current_index in self.index_num_mapping:
+            return
+
+        self.index_order.shift(current_num + 1, 1)
+        self.index_order.insert(current_index, current_num + 1)
+
+    def delete_cell(self, cell: Cell) -> None:
+        current_index = cell.cell_index
+        current_num = (
+            self.index_num_mapping[current_index]
+            if current_index in self.index_num_mapping else cell.cell_num
+        )
+        if current_index in self.index_num_mapping:
+            del self.index_num_mapping[current_index]
+
+        if current_num is None:
+            return
+
+        self.index_order.shift(current_num, -1, inclusive=False)
+
+    def execute_cell(self, cell: Cell) -> None:
+        current_index, current_num = cell.cell_index, cell.cell_num
+        if (current_index, current_num) in self.index_order:
+            return
+
+        self.index_order.insert(current_index, current_num)
+
+    def initialize_indices(self, cells_json: str) -> None:
+        self.index_num_mapping.detach_all()
+        self.index_order.clear()
+        for num, cell_dict in enumerate(json.loads(cells_json)):
+            cell_index = cell_dict['id']
+            self.index_source_mapping[cell_index] = cell_dict['source']
+            self.index_order.insert(cell_index, num)
+
+    def update_state(self, log: pd.Series | dict) -> None:
+        self.log = log.to_dict() if isinstance(log, pd.Series) else dict(log)
+        action, cell_index, cell_num, cell_source = (
+            self.log['event'], self.log['cell_index'], self.log['cell_num'], self.log['cell_source']
+        )
+        cell_num = int(cell_num) if pd.notna(cell_num) else None
+        self.state_num += 1
+        if action == "save_notebook":
+            self.initialize_indices(cell_source)
+            return
+
+        if action != "error":
+            self.index_source_mapping[cell_index] = cell_source
+
+        cell = Cell(cell_index=cell_index, cell_num=cell_num)
+
+        if action in self.actions_mapping:
+            self.actions_mapping[action](cell)
+
+
+def delete_duplicates(state: NotebookState) -> NotebookState:
+    state.index_order.delete_duplicates()
+    return state
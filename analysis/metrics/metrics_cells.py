@@ -1,32 +1,29 @@
 import ast
+import os
 import re
-from collections import defaultdict
+from typing import Any, Callable, Optional
 
+import numpy as np
 import pandas as pd
-from radon.raw import analyze
-from radon.visitors import ComplexityVisitor
 from tqdm import tqdm
 
 from analysis.metrics.metrics_base import Metrics
+from analysis.metrics.utils.cell_analyzer import CellAnalyzer, ParsedCell, parse_source
+from analysis.metrics.utils.memo_cache import MemoCache, source_hash
 
 
 class CellsMetrics(Metrics):
 
-    def __init__(self):
-        self.cell_metrics_mapping = defaultdict(dict)
-        self.cell_metrics_mapping['execute'] = {
-            'objects': self.get_objects_number,
-            'sloc': self.get_sloc,
-            'ccn': self.get_cyclomatic_complexity,
-            'comments': self.get_comments
-        }
-        self.metrics_dataframes = defaultdict()
+    def __init__(
+            self, hooks: Optional[dict[str, Callable[[ParsedCell], Any]]] = None, hooks_version: str = '',
+            cache_path: Optional[str | os.PathLike] = None
+    ):
+        self.analyzer = CellAnalyzer(hooks, hooks_version)
+        self.analyzed_events = ('execute',)
+        self.cache = MemoCache(cache_path, self.analyzer.get_cache_namespace())
 
     def get_all_metrics(self):
-        return [
-            metric for metric_type in self.cell_metrics_mapping.keys()
-            for metric in self.cell_metrics_mapping[metric_type].keys()
-        ]
+        return self.analyzer.get_metric_names()
 
     def calculate_metrics(self, df: pd.DataFrame) -> pd.DataFrame:
         cell_metrics = self.calculate_cell_metrics(df)
@@ -34,13 +31,28 @@ class CellsMetrics(Metrics):
 
         return aggregated_metrics
 
+    def get_source_metrics(self, sources) -> pd.DataFrame:
+        # metrics are computed once per distinct source and kept in the cache for the next runs
+        self.cache.namespace = self.analyzer.get_cache_namespace()
+        keys = [source_hash(source) for source in sources]
+        cached = self.cache.get_many(set(keys))
+        computed = {}
+        for key, source in tqdm(zip(keys, sources), total=len(keys)):
+            if key not in cached and key not in computed:
+                computed[key] = self.analyzer.analyze(source).as_dict()
+        self.cache.set_many(computed)
+
+        cached.update(computed)
+        return pd.DataFrame([cached[key] for key in keys], columns=self.get_all_metrics())
+
     def calculate_cell_metrics(self, df: pd.DataFrame) -> pd.DataFrame:
-        calculated_metrics = [
-            {metric: fun(row.cell_source) for metric, fun
-             in self.cell_metrics_mapping[row.event].items()}
-            for _, row in tqdm(df.iterrows())
-        ]
-        metrics_df = pd.DataFrame(calculated_metrics)
+        is_analyzed = df.event.isin(self.analyzed_events).to_numpy()
+        codes, sources = pd.factorize(df.cell_source.to_numpy()[is_analyzed], use_na_sentinel=False)
+
+        # rows of other events get no metrics
+        positions = np.full(len(df), -1)
+        positions[is_analyzed] = codes
+        metrics_df = self.get_source_metrics(sources).reindex(positions)
         return pd.concat([
             df.reset_index(drop=True), metrics_df.reset_index(drop=True)
         ], axis=1)
@@ -48,49 +60,33 @@ class CellsMetrics(Metrics):
     def aggregate_cells_metrics(self, df_metrics) -> pd.DataFrame:
 
         agg_list = ['kernel_id'] + self.get_all_metrics()
-        df_metrics = df_metrics.loc[:, agg_list].groupby('kernel_id').agg(['mean', 'sum'])
+        df_metrics = df_metrics.loc[:, agg_list].groupby('kernel_id', observed=True).agg(['mean', 'sum'])
 
         return df_metrics
 
     def _get_ast(self, source: str | None) -> ast.AST:
-        try:
-            return ast.parse(source)
-        except SyntaxError as e:
-            code_string = source.splitlines()
-            del code_string[e.lineno - 1]
-            code_string = '\n'.join(code_string)
-            return self._get_ast(code_string)
+        return parse_source(source)
+
+    def get_source_analysis(self, source: str | None) -> dict[str, Any]:
+        # the metrics of calculate_cell_metrics for a single source, parsed once and cached for all of them
+        self.cache.namespace = self.analyzer.get_cache_namespace()
+        key = source_hash(source)
+        analysis = self.cache.get_many([key]).get(key)
+        if analysis is None:
+            analysis = self.analyzer.analyze(source).as_dict()
+            self.cache.set_many({key: analysis})
+        return analysis
 
     def get_objects_number(self, source: str | None) -> int:
-        if source is None:
-            return 0
-        source_ast, variables = self._get_ast(source), set()
-
-        for node in ast.walk(source_ast):
-            if isinstance(node, ast.Name) and isinstance(node.ctx, (ast.Load, ast.Store)):
-                variables.add(node.id)
-
-        return len(variables)
+        return self.get_source_analysis(source)['objects']
 
     def get_cyclomatic_complexity(self, source: str | None) -> int:
-        if source is None:
-            return 0
+        return self.get_source_analysis(source)['ccn']
 
-        source_ast = self._get_ast(source)
-        v = ComplexityVisitor.from_ast(source_ast)
-        return v.complexity
-
-    @staticmethod
-    def get_sloc(source: str | None) -> int:
-        if source is None:
-            return 0
-        try:
-            return analyze(source).sloc
-        except SyntaxError:
-            return len(source.splitlines())
+    def get_sloc(self, source: str | None) -> int:
+        return self.get_source_analysis(source)['sloc']
 
-    @staticmethod
-    def get_comments(source: str | None, loc: bool = True) -> int:
+    def get_comments(self, source: str | None, loc: bool = True) -> int:
         def get_comments_len(input_string: str) -> int:
             pattern = r'#(.*)'
             matches = re.findall(pattern, input_string, re.MULTILINE)
@@ -98,7 +94,6 @@ class CellsMetrics(Metrics):
 
         if source is None:
             return 0
-        try:
-            return analyze(source).comments if loc else get_comments_len(source)
-        except SyntaxError:
-            return len(source.splitlines())
+        if not loc:
+            return get_comments_len(source)
+        return self.get_source_analysis(source)['comments']
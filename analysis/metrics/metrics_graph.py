@@ -1,3 +1,4 @@
+from collections import defaultdict
 from typing import Optional
 
 import networkx as nx
@@ -5,7 +6,207 @@ import pandas as pd
 from tqdm import tqdm
 
 from analysis.metrics.metrics_base import Metrics
-from analysis.metrics.utils.graph_tools import graphviz2networkx, dataframe_to_graphviz
+from analysis.metrics.utils.graph_tools import dataframe_to_networkx
+
+
+def propagate_labels(neighbors: list[list[int]], degrees: list[int], nodes: list[int], labels: list[int]) -> list[int]:
+    # networkx.community.label_propagation_communities on the given nodes, the labels of the other nodes stay as they
+    # are: the nodes are colored greedily by decreasing degree, and the nodes of one color at a time take the most
+    # frequent label of their neighbours, the largest one on ties unless their own label is among them
+    colors, groups = {}, []
+    for node in sorted(nodes, key=degrees.__getitem__, reverse=True):
+        used = {colors.get(neighbor) for neighbor in neighbors[node]}
+        color = 0
+        while color in used:
+            color += 1
+        colors[node] = color
+        if color == len(groups):
+            groups.append([])
+        groups[color].append(node)
+
+    # networkx stops at the first complete labeling, where every node has one of the most frequent labels around it,
+    # and that is the labeling a whole round leaves unchanged
+    changed = True
+    while changed:
+        changed = False
+        for group in groups:
+            for node in group:
+                if len(neighbors[node]) == 1:
+                    label = labels[neighbors[node][0]]
+                elif neighbors[node]:
+                    counts = {}
+                    for neighbor in neighbors[node]:
+                        counts[labels[neighbor]] = counts.get(labels[neighbor], 0) + 1
+                    best = max(counts.values())
+                    high = [label for label, count in counts.items() if count == best]
+                    label = high[0] if len(high) == 1 else labels[node] if labels[node] in high else max(high)
+                else:
+                    continue
+                if label != labels[node]:
+                    labels[node] = label
+                    changed = True
+    return labels
+
+
+def get_partition_modularity(labels: list[int], edges: list[tuple[int, int]], degrees: list[int]) -> float:
+    # the same sum in the same order as networkx.community.modularity over the communities of the labels
+    links, community_degrees = defaultdict(int), {}
+    for node, label in enumerate(labels):
+        community_degrees[label] = community_degrees.get(label, 0) + degrees[node]
+    for u, v in edges:
+        if labels[u] == labels[v]:
+            links[labels[u]] += 1
+    degree_sum = sum(degrees)
+    m, norm = degree_sum / 2, 1 / degree_sum ** 2
+    return sum(links[label] / m - degree * degree * norm for label, degree in community_degrees.items())
+
+
+class IncrementalExecutionGraph:
+
+    def __init__(self, hash_string_num: int = 8, modularity_every: int = 1):
+        # the same graph as dataframe_to_networkx, grown one execution at a time
+        self.graph = nx.MultiDiGraph()
+        self.hash_string_num = hash_string_num
+        self.last_node = "0"
+        self.edges_count = 0
+
+        # the undirected simple graph the clustering and modularity are defined on, for the label propagation its
+        # nodes are also numbered in the order they were added
+        self.undirected = nx.Graph()
+        self.triangles = defaultdict(int)
+        self.clustering_sum = 0.0
+        self.node_numbers = {}
+        self.neighbors = []
+        self.degrees = []
+        self.undirected_edges = []
+
+        # the communities are the ones label propagation finds on the whole graph, searched again on every change of
+        # the graph, so the modularity is the same as GraphMetrics.get_graph_modularity. With modularity_every > 1
+        # they are kept for up to modularity_every states and only the modularity of the kept communities is updated,
+        # unless label propagation within the two communities a new edge links splits or merges them. That is a few
+        # times faster, but the whole graph can have quite different communities: the series deviates by up to 0.4
+        self.modularity_every = modularity_every
+        self.labels = []
+        self.community_links = defaultdict(int)
+        self.community_degrees = defaultdict(int)
+        self.modularity = None
+        self.communities_changed = True
+        self.states_since_communities = 0
+        self.edges_since_communities = 0
+
+    def get_clustering(self, node) -> float:
+        degree = len(self.undirected[node]) - (node in self.undirected[node])
+        return 2 * self.triangles[node] / (degree * (degree - 1)) if degree > 1 else 0.0
+
+    def _add_undirected_edge(self, u, v):
+        if u != v:
+            neighbors = [set(self.undirected[node]) - {node} if node in self.undirected else set() for node in (u, v)]
+            common = neighbors[0] & neighbors[1]
+            changed = {u, v} | common
+            self.clustering_sum -= sum(self.get_clustering(node) for node in changed if node in self.undirected)
+            self.undirected.add_edge(u, v)
+            for node in common:
+                self.triangles[node] += 1
+            self.triangles[u] += len(common)
+            self.triangles[v] += len(common)
+            self.clustering_sum += sum(self.get_clustering(node) for node in changed)
+        else:
+            self.undirected.add_edge(u, v)
+
+        for node in (u, v):
+            if node not in self.node_numbers:
+                self.node_numbers[node] = len(self.neighbors)
+                self.neighbors.append([])
+                self.degrees.append(0)
+        iu, iv = self.node_numbers[u], self.node_numbers[v]
+        self.neighbors[iu].append(iv)
+        if iu != iv:
+            self.neighbors[iv].append(iu)
+        self.degrees[iu] += 1
+        self.degrees[iv] += 1
+        self.undirected_edges.append((iu, iv))
+        self.edges_since_communities += 1
+
+        if self.communities_changed or self.modularity_every <= 1:
+            return
+        # a new node joins the community of the node it is linked to
+        if len(self.neighbors) == len(self.labels) + 1 and max(iu, iv) == len(self.labels):
+            self.labels.append(self.labels[min(iu, iv)])
+        if len(self.neighbors) != len(self.labels):
+            self.communities_changed = True
+            return
+
+        lu, lv = self.labels[iu], self.labels[iv]
+        if lu == lv:
+            self.community_links[lu] += 1
+        self.community_degrees[lu] += 1
+        self.community_degrees[lv] += 1
+        if lu != lv and not self._keeps_communities({lu, lv}):
+            self.communities_changed = True
+
+    def _keeps_communities(self, communities: set) -> bool:
+        # label propagation started afresh within the communities, with the labels around them fixed, finds them again
+        nodes = [node for node, label in enumerate(self.labels) if label in communities]
+        offset = len(self.labels)
+        labels = propagate_labels(
+            self.neighbors, self.degrees, nodes,
+            [offset + node if label in communities else label for node, label in enumerate(self.labels)]
+        )
+        before, after = defaultdict(set), defaultdict(set)
+        for node in nodes:
+            before[self.labels[node]].add(node)
+            after[labels[node]].add(node)
+        return sorted(map(sorted, before.values())) == sorted(map(sorted, after.values()))
+
+    def add_execution(self, cell_index: str):
+        node = cell_index[:self.hash_string_num]
+        u, v = self.last_node, node
+        self.graph.add_edge(u, v, label=f"{self.edges_count}", color="black")
+        self.edges_count += 1
+        self.last_node = node
+        if not self.undirected.has_edge(u, v):
+            self._add_undirected_edge(u, v)
+
+    def _update_communities(self):
+        self.labels = propagate_labels(
+            self.neighbors, self.degrees, list(range(len(self.neighbors))), list(range(len(self.neighbors)))
+        )
+        self.modularity = get_partition_modularity(self.labels, self.undirected_edges, self.degrees)
+        self.community_links, self.community_degrees = defaultdict(int), defaultdict(int)
+        for u, v in self.undirected_edges:
+            if self.labels[u] == self.labels[v]:
+                self.community_links[self.labels[u]] += 1
+        for node, degree in enumerate(self.degrees):
+            self.community_degrees[self.labels[node]] += degree
+        self.communities_changed = False
+        self.states_since_communities = 0
+        self.edges_since_communities = 0
+
+    def get_modularity(self) -> float:
+        # communities are searched again when the graph changed, or with modularity_every > 1 when a new edge does not
+        # fit in them or every modularity_every states
+        self.states_since_communities += 1
+        if not self.edges_since_communities:
+            return self.modularity
+        if self.communities_changed or self.states_since_communities >= self.modularity_every:
+            self._update_communities()
+            return self.modularity
+
+        edges = len(self.undirected_edges)
+        return sum(
+            self.community_links[community] / edges - (degree / (2 * edges)) ** 2
+            for community, degree in self.community_degrees.items()
+        )
+
+    def get_metrics(self) -> dict:
+        nodes, edges = self.graph.number_of_nodes(), self.edges_count
+        return {
+            'modularity': self.get_modularity(),
+            'average_degree': 2 * edges / nodes,
+            'average_clustering': self.clustering_sum / nodes,
+            'nodes_count': nodes,
+            'edges_count': edges,
+        }
 
 
 class GraphMetrics(Metrics):
@@ -20,7 +221,7 @@ class GraphMetrics(Metrics):
         }
 
     def calculate_metrics(self, df: pd.DataFrame, progress: bool = True) -> pd.DataFrame:
-        pbar = tqdm(df.groupby('kernel_id')) if progress else df.groupby('kernel_id')
+        pbar = tqdm(df.groupby('kernel_id', observed=True)) if progress else df.groupby('kernel_id', observed=True)
         return pd.concat([
             self.calculate_kernel_metrics(df_kernel, kernel_id)
             for (kernel_id, df_kernel) in pbar
@@ -30,8 +231,7 @@ class GraphMetrics(Metrics):
         if 'kernel_id' in list(df):
             kernel_id = df.kernel_id.iloc[0]
 
-        gv = dataframe_to_graphviz(df)
-        G = graphviz2networkx(gv)
+        G = dataframe_to_networkx(df)
 
         if not len(G.nodes):
             return pd.DataFrame(None, columns=list(self.graph_metrics_mapping.keys()))
@@ -43,6 +243,42 @@ class GraphMetrics(Metrics):
 
         return pd.DataFrame(calculated_metrics)
 
+    def calculate_evolution(
+            self, df: pd.DataFrame, step: int = 1, modularity_every: int = 1, progress: bool = True
+    ) -> pd.DataFrame:
+        groups = df.groupby('kernel_id', observed=True)
+        return pd.concat([
+            self.calculate_kernel_evolution(df_kernel, kernel_id, step, modularity_every)
+            for (kernel_id, df_kernel) in (tqdm(groups) if progress else groups)
+        ], ignore_index=True)
+
+    def calculate_kernel_evolution(
+            self, df: pd.DataFrame, kernel_id: Optional[str] = None, step: int = 1, modularity_every: int = 1
+    ) -> pd.DataFrame:
+        # the metrics of the graphs of the prefixes df.iloc[:i] for i in range(1, len(df), step)
+        if 'kernel_id' in list(df):
+            kernel_id = df.kernel_id.iloc[0]
+
+        evolution = IncrementalExecutionGraph(modularity_every=modularity_every)
+        is_execution, cell_indices = df.event.to_numpy() == "execute", df.cell_index.to_numpy()
+        calculated_metrics, added = [], 0
+        for i in range(1, len(df), step):
+            for position in range(added, i):
+                if is_execution[position]:
+                    evolution.add_execution(cell_indices[position])
+            added = i
+
+            if len(evolution.graph.nodes):
+                metrics = evolution.get_metrics()
+                calculated_metrics.append({'kernel_id': kernel_id, **{
+                    metric: metrics[metric] if metric in metrics else fun(evolution.graph)
+                    for metric, fun in self.graph_metrics_mapping.items()
+                }})
+
+        columns = ['state_num', 'kernel_id', *self.graph_metrics_mapping.keys()]
+        metrics_df = pd.DataFrame(calculated_metrics, columns=columns[1:])
+        return metrics_df.reset_index().rename({'index': 'state_num'}, axis=1)[columns]
+
     @staticmethod
     def get_graph_modularity(G: nx.Graph) -> float | None:
         if not len(G.nodes):
@@ -0,0 +1,171 @@
+import io
+import json
+import os
+import tempfile
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stderr
+from dataclasses import dataclass
+from typing import Optional
+
+import pandas as pd
+import pyarrow as pa
+from tqdm import tqdm
+
+from analysis.metrics.metrics_base import Metrics
+
+_worker_metrics: Optional[dict[str, Metrics]] = None
+
+
+@dataclass
+class KernelError:
+    kernel_id: str
+    metric: str
+    error: str
+    traceback: str
+
+
+def write_shard(df: pd.DataFrame, path: str) -> str:
+    # shards are Arrow IPC files that workers memory-map, columns Arrow cannot hold fall back to pickle
+    try:
+        table = pa.Table.from_pandas(df)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        path += '.pkl'
+        df.to_pickle(path)
+        return path
+
+    # object columns of numbers and None would come back as floats with NaN
+    object_columns = [
+        c for c in df.columns
+        if df[c].dtype == object and pd.api.types.infer_dtype(df[c], skipna=True) not in ('string', 'empty')
+    ]
+    table = table.replace_schema_metadata({
+        **table.schema.metadata, b'june_object_columns': json.dumps(object_columns).encode()
+    })
+
+    path += '.arrow'
+    with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    return path
+
+
+def read_shard(path: str) -> pd.DataFrame:
+    if path.endswith('.pkl'):
+        return pd.read_pickle(path)
+    with pa.memory_map(path) as source:
+        table = pa.ipc.open_file(source).read_all()
+    df = table.to_pandas()
+    for column in json.loads(table.schema.metadata[b'june_object_columns']):
+        df[column] = pd.Series(table.column(column).to_pylist(), index=df.index, dtype=object)
+    return df
+
+
+def _init_worker(metrics: dict[str, Metrics]):
+    global _worker_metrics
+    _worker_metrics = metrics
+
+
+def _run_kernel(metric: Metrics, df: pd.DataFrame) -> tuple[pd.DataFrame, dict[str, list]]:
+    # items that metrics collect in list attributes, like TimeMetrics.unexpected_finish, are sent back separately
+    collected = {name: len(value) for name, value in vars(metric).items() if isinstance(value, list)}
+    try:
+        # the progress bars of the metrics themselves would be one per kernel
+        with redirect_stderr(io.StringIO()):
+            result = metric.calculate_metrics(df)
+    finally:
+        for name, length in collected.items():
+            value = getattr(metric, name)
+            collected[name] = value[length:]
+            del value[length:]
+    return result, collected
+
+
+def _run_shard(path: str, metrics: Optional[dict[str, Metrics]] = None) -> list[tuple]:
+    metrics = _worker_metrics if metrics is None else metrics
+    shard = read_shard(path)
+    results = []
+    for kernel_id, kernel_df in shard.groupby('kernel_id', observed=True):
+        for name, metric in metrics.items():
+            try:
+                results.append((kernel_id, name, *_run_kernel(metric, kernel_df), None))
+            except Exception as e:
+                error = KernelError(kernel_id, name, repr(e), traceback.format_exc())
+                results.append((kernel_id, name, None, {}, error))
+    return results
+
+
+class MetricsRunner:
+
+    def __init__(
+            self, metrics: dict[str, Metrics] | list[Metrics], n_jobs: int = 1, kernels_per_shard: int = 8,
+            progress: bool = True
+    ):
+        if not isinstance(metrics, dict):
+            metrics = {type(metric).__name__: metric for metric in metrics}
+        self.metrics = metrics
+        self.n_jobs = n_jobs
+        self.kernels_per_shard = kernels_per_shard
+        self.progress = progress
+        self.errors: list[KernelError] = []
+
+    def get_shards(self, df: pd.DataFrame) -> list[pd.DataFrame]:
+        kernel_rows = list(df.groupby('kernel_id', observed=True).indices.values())
+        return [
+            df.iloc[sorted(i for rows in kernel_rows[start:start + self.kernels_per_shard] for i in rows)]
+            for start in range(0, len(kernel_rows), self.kernels_per_shard)
+        ]
+
+    def _report(self, shard_results: list[tuple], pbar) -> None:
+        if pbar is None:
+            return
+        for kernel_id, name, _, _, error in shard_results:
+            if error is not None:
+                pbar.write(f"{kernel_id}: {name} failed with {error.error}")
+        pbar.update(len({kernel_id for kernel_id, *_ in shard_results}))
+
+    def _collect(self, shard_results: list[tuple]) -> None:
+        for kernel_id, name, result, collected, error in shard_results:
+            for attribute, values in collected.items():
+                getattr(self.metrics[name], attribute).extend(values)
+            if error is not None:
+                self.errors.append(error)
+
+    def run(self, df: pd.DataFrame) -> dict[str, pd.DataFrame]:
+        # every kernel goes through all metrics in one pass, the results of the kernels are concatenated in
+        # kernel order and keep their own index
+        self.errors = []
+        shards = self.get_shards(df)
+        shard_results = [None] * len(shards)
+        pbar = tqdm(total=sum(shard.kernel_id.nunique() for shard in shards)) if self.progress else None
+
+        with tempfile.TemporaryDirectory() as shard_dir:
+            paths = [write_shard(shard, os.path.join(shard_dir, f"shard_{i}")) for i, shard in enumerate(shards)]
+            del shards
+
+            if self.n_jobs == 1:
+                for i, path in enumerate(paths):
+                    shard_results[i] = _run_shard(path, self.metrics)
+                    self._report(shard_results[i], pbar)
+            else:
+                with ProcessPoolExecutor(
+                        max_workers=None if self.n_jobs == -1 else self.n_jobs,
+                        initializer=_init_worker, initargs=(self.metrics,)
+                ) as executor:
+                    futures = {executor.submit(_run_shard, path): i for i, path in enumerate(paths)}
+                    for future in as_completed(futures):
+                        shard_results[futures[future]] = future.result()
+                        self._report(shard_results[futures[future]], pbar)
+
+        if pbar is not None:
+            pbar.close()
+
+        # collected items and errors are merged in kernel order, not in the order the shards finished
+        for results in shard_results:
+            self._collect(results)
+        return {
+            name: pd.concat([
+                result for results in shard_results for _, metric, result, _, _ in results
+                if metric == name and result is not None
+            ] or [pd.DataFrame()])
+            for name in self.metrics
+        }
@@ -1,7 +1,8 @@
-from ast import literal_eval
-
+import numpy as np
 import pandas as pd
 
+from analysis.dataset.event_pairing import match_queue, pair_last_openers, get_truthy_mask
+from analysis.dataset.loaders import get_output_types
 from .metrics_base import Metrics
 
 
@@ -13,14 +14,14 @@ class TimeMetrics(Metrics):
 
     def calculate_metrics(self, df) -> pd.DataFrame:
 
-        time_df = df.sort_values('time')
+        time_df = df.sort_values('time', kind='stable')
         time_df = time_df.loc[time_df.event.isin(['execute', 'create', 'finished_execute', 'delete']), :]
         time_df.time = pd.to_datetime(time_df.time)
 
-        execution_times = time_df.groupby('kernel_id').apply(self.match_executions)
+        execution_times = time_df.groupby('kernel_id', observed=True).apply(self.match_executions)
         time_df = time_df.merge(execution_times, on=['action_id', 'cell_index'], how="left")
 
-        time_df = time_df.groupby('kernel_id').apply(self.calculate_interruptions).reset_index(drop=True)
+        time_df = time_df.groupby('kernel_id', observed=True).apply(self.calculate_interruptions).reset_index(drop=True)
         time_df['src_len'] = time_df.cell_source.str.len()
         time_df['execution_time_sec'] = time_df.execution_time.dt.total_seconds()
 
@@ -33,11 +34,8 @@ class TimeMetrics(Metrics):
 
         df_tmp = metrics.loc[metrics.event.isin(['execute', 'create', 'delete']), :]
 
-        df_tmp = df_tmp.groupby('kernel_id').apply(lambda x: (x.time - x.time.shift(1)).shift(-1)) \
-            .reset_index(level=0) \
-            .drop(columns=['kernel_id'])
-        df_tmp.columns = ['next_action_time']
-        metrics = metrics.join(df_tmp)
+        next_action_time = df_tmp.groupby('kernel_id', observed=True).time.shift(-1) - df_tmp.time
+        metrics = metrics.join(next_action_time.rename('next_action_time'))
 
         # metrics.loc[metrics.event == 'execute', 'next_action_time'] = (
         #         metrics.loc[metrics.event == 'execute', 'next_action_time']
@@ -50,97 +48,65 @@ class TimeMetrics(Metrics):
 
     @staticmethod
     def calculate_interruptions(metric_df):
-
-        metric_df['interruptions'] = 0
-        for i, row in metric_df.iterrows():
-            if row.execution_start is not None:
-                metric_df.loc[i, 'interruptions'] = sum(metric_df.time.between(
-                    row.execution_start, row.execution_start + row.execution_time, inclusive='neither'))
+        # the number of events strictly inside every execution interval
+        times = metric_df.time.to_numpy()
+        times = np.sort(times[~pd.isna(times)])
+        starts = pd.to_datetime(metric_df.execution_start).to_numpy()
+        ends = starts + pd.to_timedelta(metric_df.execution_time).to_numpy()
+
+        valid = ~(pd.isna(starts) | pd.isna(ends))
+        interruptions = np.zeros(len(metric_df), dtype=np.int64)
+        interruptions[valid] = np.maximum(
+            np.searchsorted(times, ends[valid], side='left') - np.searchsorted(times, starts[valid], side='right'), 0
+        )
+        metric_df['interruptions'] = interruptions
 
         return metric_df
 
-    @staticmethod
-    def parse_result(raw_output):
-        result = '' if (raw_output is None) | (raw_output == '[]') else '' + literal_eval(raw_output)[0]['output_type']
-        return result
-
     def match_executions(self, kernel_df):
 
-        kernel_df = kernel_df.sort_values(by='time')
-        all_executions = []
-        execution_queue = []
-
-        for i, row in kernel_df.iterrows():
-            if row.event == 'execute':
-                # we collect queue of cells
-                if len(execution_queue) == 0:
-                    # we set starting execution time at the start of queue
-                    latest_time = row.time
-                # fill the queue
-
-                execution_queue.append((row.cell_index, row['action_id'], row.time, None, None))
-
-            if row.event == 'finished_execute':
-                result = self.parse_result(row.cell_output)
-                # if we encounter finish with empty queue do something
-                if len(execution_queue) == 0:
-                    self.unexpected_finish.append((row.cell_index, row['action_id'], row.time, result))
-
-                # if we encounter finish we check if it is in queue
-                if row.cell_index in [n[0] for n in execution_queue]:
-                    # we look for the latest encounter of cell in our queue
-                    latest = max(i for i, n in enumerate(execution_queue) if n[0] == row.cell_index)
-                    # we calculate execution time (current time - time of the last queue input)
-
-                    # TODO: normal fix?
-                    latest_time = (
-                        execution_queue[latest][2]
-                        if execution_queue[latest][2] > latest_time
-                        else latest_time
-                    )
-
-                    execution_time = row.time - latest_time
-                    # write all information
-
-                    register_execution = (execution_queue[latest][1], row.cell_index,
-                                          execution_time, latest_time, row.cell_label, result)
-                    all_executions.append(register_execution)
-                    # update latest time -- now we start next calculation in queue from this point
-                    latest_time = row.time
-                    # remove entry from queue
-                    del execution_queue[latest]
-                # finish cell and not in queue - do something
-                else:
-                    self.unexpected_finish.append((row.cell_index, row['action_id'], row.time, result))
-
-        if len(execution_queue) != 0:
-            self.unfinished.append(execution_queue)
-
-        return pd.DataFrame(all_executions, columns=['action_id', 'cell_index', 'execution_time',
-                                                     'execution_start', 'matched_label', 'result'])
+        kernel_df = kernel_df.sort_values(by='time', kind='stable')
+        event = kernel_df.event.to_numpy()
+        is_finish = event == 'finished_execute'
+        cell_index, action_id = kernel_df.cell_index.to_numpy(), kernel_df.action_id.to_numpy()
+        times = kernel_df.time.to_numpy()
+
+        results = np.full(len(kernel_df), None, dtype=object)
+        results[is_finish] = get_output_types(kernel_df[is_finish])
+
+        matches = match_queue(event == 'execute', is_finish, cell_index, times)
+
+        unexpected = matches.unexpected
+        self.unexpected_finish.extend(zip(
+            cell_index[unexpected], action_id[unexpected], pd.to_datetime(times[unexpected]), results[unexpected]
+        ))
+        if len(matches.unfinished):
+            unfinished = matches.unfinished
+            self.unfinished.append([
+                (c, a, t, None, None)
+                for c, a, t in zip(cell_index[unfinished], action_id[unfinished], pd.to_datetime(times[unfinished]))
+            ])
+
+        columns = ['action_id', 'cell_index', 'execution_time', 'execution_start', 'matched_label', 'result']
+        finishes = matches.closers
+        return pd.DataFrame({
+            'action_id': action_id[matches.openers],
+            'cell_index': cell_index[finishes],
+            'execution_time': times[finishes] - matches.starts,
+            'execution_start': matches.starts,
+            'matched_label': kernel_df.cell_label.to_numpy()[finishes],
+            'result': results[finishes],
+        }, columns=columns)
 
     @staticmethod
     def match_edits(cell_df):
-
-        edit_state = None
-        found = {
-            'edited': [],
-            'unedited': [],
-            'uncreated': [],
-        }
-
-        for i, row in cell_df.iterrows():
-            if ((row.event == 'finished_execute') or (row.event == 'create')):
-                edit_state = i
-            if row.event == 'execute':
-                if edit_state:
-                    found['edited'].append(tuple([edit_state, i]))
-                    edit_state = None
-                else:
-                    found['uncreated'].append(i)
-
-        cell_df['edited_time'] = None
-        for edited in found['edited']:
-            cell_df.loc[edited[0], 'edited_time'] = cell_df.loc[edited[1], 'time']
+        event = cell_df.event.to_numpy()
+        edits, executions, _ = pair_last_openers(
+            (event == 'finished_execute') | (event == 'create'), event == 'execute', get_truthy_mask(cell_df.index)
+        )
+
+        edited_time = np.full(len(cell_df), None, dtype=object)
+        edited_time[edits] = list(cell_df.time.iloc[executions])
+        cell_df['edited_time'] = pd.Series(edited_time, index=cell_df.index, dtype=object)
 
         return cell_df
@@ -0,0 +1,209 @@
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Iterable, Mapping, Optional
+
+import pandas as pd
+
+from analysis.dataset.loaders import get_output_type
+from .metrics_base import Metrics
+
+TIME_EVENTS = ('execute', 'create', 'finished_execute', 'delete')
+ACTION_EVENTS = ('execute', 'create', 'delete')
+
+
+@dataclass
+class TimeUpdate:
+    # 'execution', 'next_action', 'unexpected_finish' or 'unfinished'
+    kind: str
+    kernel_id: Any
+    action_id: Any
+    values: dict = field(default_factory=dict)
+
+
+class KernelTimeStream:
+
+    def __init__(self, kernel_id, max_queue: int = 1000, max_times: int = 100_000):
+        self.kernel_id = kernel_id
+        # the oldest executions are given up on as unfinished when more than max_queue wait for their finish, or when
+        # more than max_times events happened since they could have started, so the memory of a kernel stays bounded
+        self.max_queue = max_queue
+        self.max_times = max_times
+        self.reset()
+
+    def reset(self):
+        # executions waiting for their finish, by cell and in queue order
+        self.pending = {}
+        self.queue = OrderedDict()
+        self.queue_num = 0
+        self.start_time = None
+        # times of the events since the running execution could have started, in nanoseconds
+        self.times = []
+        self.times_offset = 0
+        self.last_action = None
+
+    def _update(self, kind: str, action_id, **values) -> TimeUpdate:
+        return TimeUpdate(kind, self.kernel_id, action_id, values)
+
+    def _prune_times(self):
+        # executions start from the latest finish or their own execute at the earliest, older events cannot
+        # interrupt them
+        if not self.queue:
+            self.times, self.times_offset = [], 0
+            return
+        oldest_time = next(iter(self.queue.values()))[2]
+        start_time = max(self.start_time, oldest_time)
+        self.times_offset = bisect_right(self.times, start_time.value, lo=self.times_offset)
+        if self.times_offset > len(self.times) // 2:
+            self.times, self.times_offset = self.times[self.times_offset:], 0
+
+    def _expire(self) -> list[TimeUpdate]:
+        expired = []
+        while self.queue and (len(self.queue) > self.max_queue or len(self.times) - self.times_offset > self.max_times):
+            queue_num, (cell_index, action_id, time) = self.queue.popitem(last=False)
+            self.pending[cell_index].remove(queue_num)
+            if not self.pending[cell_index]:
+                del self.pending[cell_index]
+            expired.append((cell_index, action_id, time, None, None))
+            self._prune_times()
+        return [self._update('unfinished', None, executions=expired)] if expired else []
+
+    def process(self, event: Mapping) -> list[TimeUpdate]:
+        name, time = event.get('event'), event.get('time')
+        if name not in TIME_EVENTS:
+            return []
+        time = pd.Timestamp(time)
+        if pd.notna(time):
+            insort(self.times, time.value, lo=self.times_offset)
+
+        updates = []
+        if name in ACTION_EVENTS:
+            if self.last_action is not None:
+                action_id, action_time = self.last_action
+                next_action_time = (time - action_time).total_seconds()
+                updates.append(self._update('next_action', action_id, next_action_time=next_action_time))
+            self.last_action = (event.get('action_id'), time)
+
+        cell_index, action_id = event.get('cell_index'), event.get('action_id')
+        if name == 'execute':
+            if not self.queue:
+                self.start_time = time
+            self.queue[self.queue_num] = (cell_index, action_id, time)
+            self.pending.setdefault(cell_index, []).append(self.queue_num)
+            self.queue_num += 1
+
+        elif name == 'finished_execute':
+            result = get_output_type(event)
+            unexpected = self._update('unexpected_finish', action_id, cell_index=cell_index, time=time, result=result)
+            if not self.queue:
+                updates.append(unexpected)
+
+            if self.pending.get(cell_index):
+                # the latest execution of the cell finishes, the next one in the queue starts from here
+                queue_num = self.pending[cell_index].pop()
+                if not self.pending[cell_index]:
+                    del self.pending[cell_index]
+                _, execution_id, execution_time = self.queue[queue_num]
+                start_time = max(execution_time, self.start_time)
+
+                lo = bisect_right(self.times, start_time.value, lo=self.times_offset)
+                hi = bisect_left(self.times, time.value, lo=self.times_offset)
+                updates.append(self._update(
+                    'execution', execution_id, cell_index=cell_index, execution_time=time - start_time,
+                    execution_start=start_time, matched_label=event.get('cell_label'), result=result,
+                    interruptions=max(hi - lo, 0)
+                ))
+
+                self.start_time = time
+                del self.queue[queue_num]
+            else:
+                updates.append(unexpected)
+
+        self._prune_times()
+        return updates + self._expire()
+
+    def close(self) -> list[TimeUpdate]:
+        updates = []
+        if self.last_action is not None:
+            updates.append(self._update('next_action', self.last_action[0], next_action_time=None))
+        if self.queue:
+            updates.append(self._update('unfinished', None, executions=[
+                (c, a, t, None, None) for c, a, t in self.queue.values()
+            ]))
+        self.reset()
+        return updates
+
+
+class StreamingTimeMetrics(Metrics):
+
+    def __init__(self, max_queue: int = 1000, max_times: int = 100_000):
+        self.max_queue = max_queue
+        self.max_times = max_times
+        self.kernels = {}
+        self.unexpected_finish = []
+        self.unfinished = []
+
+    def _collect(self, updates: list[TimeUpdate]) -> list[TimeUpdate]:
+        for update in updates:
+            if update.kind == 'unexpected_finish':
+                values = update.values
+                self.unexpected_finish.append(
+                    (values['cell_index'], update.action_id, values['time'], values['result'])
+                )
+            elif update.kind == 'unfinished':
+                self.unfinished.append(update.values['executions'])
+        return updates
+
+    def process(self, event: Mapping) -> list[TimeUpdate]:
+        kernel_id = event.get('kernel_id')
+        if kernel_id not in self.kernels:
+            self.kernels[kernel_id] = KernelTimeStream(kernel_id, self.max_queue, self.max_times)
+        return self._collect(self.kernels[kernel_id].process(event))
+
+    def process_batch(self, df: pd.DataFrame) -> list[TimeUpdate]:
+        # a micro-batch, e.g. the rows exported since the previous one
+        df = df.loc[df.event.isin(TIME_EVENTS), :].sort_values('time', kind='stable')
+        df = df.assign(time=pd.to_datetime(df.time))
+        return [update for event in df.to_dict('records') for update in self.process(event)]
+
+    def close_kernel(self, kernel_id) -> list[TimeUpdate]:
+        kernel = self.kernels.pop(kernel_id, None)
+        return self._collect(kernel.close()) if kernel is not None else []
+
+    def close(self, kernel_ids: Optional[Iterable] = None) -> list[TimeUpdate]:
+        kernel_ids = list(self.kernels) if kernel_ids is None else kernel_ids
+        return [update for kernel_id in kernel_ids for update in self.close_kernel(kernel_id)]
+
+    def calculate_metrics(self, df: pd.DataFrame) -> pd.DataFrame:
+        # replays the logs through the stream, the result is the same as TimeMetrics.calculate_metrics
+        time_df = df.sort_values('time', kind='stable')
+        time_df = time_df.loc[time_df.event.isin(TIME_EVENTS), :]
+        time_df.time = pd.to_datetime(time_df.time)
+
+        executions, next_action_times, interruptions = [], {}, {}
+        for kernel_id, kernel_df in time_df.groupby('kernel_id', observed=True):
+            updates = [update for event in kernel_df.to_dict('records') for update in self.process(event)]
+            for update in updates + self.close_kernel(kernel_id):
+                if update.kind == 'execution':
+                    executions.append({'action_id': update.action_id, **update.values})
+                    interruptions[update.action_id] = update.values['interruptions']
+                elif update.kind == 'next_action':
+                    next_action_times[update.action_id] = update.values['next_action_time']
+
+        columns = ['action_id', 'cell_index', 'execution_time', 'execution_start', 'matched_label', 'result']
+        execution_times = pd.DataFrame(executions, columns=columns)
+        execution_times['execution_time'] = pd.to_timedelta(execution_times.execution_time)
+        execution_times['execution_start'] = pd.to_datetime(execution_times.execution_start)
+        time_df = time_df.merge(execution_times, on=['action_id', 'cell_index'], how="left")
+        time_df = pd.concat([
+            kernel_df for _, kernel_df in time_df.groupby('kernel_id', observed=True)
+        ]).reset_index(drop=True)
+
+        has_start = time_df.execution_start.notna()
+        time_df['interruptions'] = time_df.action_id.map(interruptions).where(has_start, 0).fillna(0).astype('int64')
+        time_df['src_len'] = time_df.cell_source.str.len()
+        time_df['execution_time_sec'] = time_df.execution_time.dt.total_seconds()
+        is_action = time_df.event.isin(ACTION_EVENTS)
+        time_df['next_action_time'] = time_df.action_id.map(next_action_times).where(is_action).astype('float64')
+
+        return time_df
@@ -1,72 +1,265 @@
-from typing import List, Dict
+import os
+from typing import Optional, Sequence
 
-import code_diff as cd
+import numpy as np
 import pandas as pd
-from tqdm import tqdm
 
 from analysis.metrics.metrics_base import Metrics
+from analysis.metrics.utils.code_changes import CodeChanges
 
 
 class TransitionMetrics(Metrics):
+    def __init__(
+            self, code_changes: bool = False, cache_path: Optional[str | os.PathLike] = None, n_jobs: int = 1,
+            max_source_size: int = 20000, timeout: Optional[float] = 10, min_distance: int = 0
+    ):
+        # the AST edit scripts of the inner execution transitions, in the 'changes' column when enabled
+        self.code_changes = CodeChanges(
+            cache_path, n_jobs, max_source_size, timeout, min_distance
+        ) if code_changes else None
+
     def calculate_metrics(self, df):
         df_ex = self.get_execution_transitions(df)
         df_ev = self.get_event_transitions(df)
         return pd.concat([df_ex, df_ev])
 
+    def calculate_transitions(self, df: pd.DataFrame) -> dict[str, pd.DataFrame]:
+        # compact typed frames, sources are referenced by the df index of the rows, see attach_sources
+        return {
+            'execution': self.get_compact_execution_transitions(df),
+            'event': self.get_compact_event_transitions(df),
+        }
+
     @staticmethod
-    def _get_code_changes(prev: str | None, cur: str | None) -> List:
-        try:
-            output = cd.difference(prev, cur, lang="python")
-            return output.edit_script()
-        except ValueError:
-            return []
+    def _get_transition_positions(df: pd.DataFrame) -> tuple[np.ndarray, np.ndarray, pd.Categorical]:
+        # consecutive rows of each kernel, the rows are grouped by kernel like groupby('kernel_id') does
+        codes, kernels = pd.factorize(df.kernel_id, sort=True)
+        order = np.argsort(codes, kind='stable')
+        order = order[codes[order] >= 0]
+        same_kernel = codes[order[1:]] == codes[order[:-1]]
+        start, end = order[:-1][same_kernel], order[1:][same_kernel]
+        return start, end, pd.Categorical.from_codes(codes[start], categories=kernels)
 
-    def get_execution_transitions(self, df: pd.DataFrame) -> pd.DataFrame:
-        grouped = df.groupby('event').get_group('execute').groupby('kernel_id')
+    @staticmethod
+    def _take_categorical(values: np.ndarray, start: np.ndarray, end: np.ndarray) -> tuple[pd.Categorical, ...]:
+        # both ends of the transitions share the categories
+        codes, categories = pd.factorize(values)
+        return tuple(pd.Categorical.from_codes(codes[positions], categories=categories) for positions in (start, end))
+
+    @staticmethod
+    def _get_executions(df: pd.DataFrame) -> pd.DataFrame:
+        return df.loc[df.event.to_numpy() == 'execute']
+
+    def get_compact_execution_transitions(self, df: pd.DataFrame) -> pd.DataFrame:
+        executions = self._get_executions(df)
+        start, end, kernel_ids = self._get_transition_positions(executions)
+        cell_index, cell_num = executions.cell_index.to_numpy(), executions.cell_num.astype('Int64').array
+        cell_idx_from, cell_idx_to = self._take_categorical(cell_index, start, end)
+        cell_label_from, cell_label_to = self._take_categorical(executions.cell_label.to_numpy(), start, end)
+        source_codes = pd.factorize(executions.cell_source, use_na_sentinel=False)[0]
 
-        transitions = []
-        for kernel_id, g in tqdm(grouped):
-            transitions += self.get_kernel_transitions(kernel_id, g)
+        return pd.DataFrame({
+            'kernel_id': kernel_ids,
+            'row_from': executions.index.to_numpy()[start], 'row_to': executions.index.to_numpy()[end],
+            'cell_idx_from': cell_idx_from, 'cell_num_from': cell_num[start],
+            'cell_idx_to': cell_idx_to, 'cell_num_to': cell_num[end],
+            'cell_label_from': cell_label_from, 'cell_label_to': cell_label_to,
+            'inner_transition': (cell_index[start] == cell_index[end]).astype(bool),
+            'same_source': source_codes[start] == source_codes[end],
+            **self._get_changes(executions.cell_source.to_numpy(), start, end, cell_index[start] == cell_index[end]),
+        })
 
-        transitions_df = pd.DataFrame(transitions)
+    def get_compact_event_transitions(self, df: pd.DataFrame) -> pd.DataFrame:
+        start, end, kernel_ids = self._get_transition_positions(df)
+        event_from, event_to = self._take_categorical(df.event.to_numpy(), start, end)
 
-        return transitions_df
+        return pd.DataFrame({
+            'kernel_id': kernel_ids,
+            'row_from': df.index.to_numpy()[start], 'row_to': df.index.to_numpy()[end],
+            'event_from': event_from, 'event_to': event_to,
+        })
+
+    def _get_changes(self, sources: np.ndarray, start: np.ndarray, end: np.ndarray, inner: np.ndarray) -> dict:
+        # only the transitions inside one cell are diffed, the others get no changes
+        if self.code_changes is None:
+            return {}
+        inner = np.flatnonzero(inner.astype(bool))
+        changes = [[] for _ in range(len(start))]
+        for position, result in zip(inner, self.code_changes.calculate(sources[start[inner]], sources[end[inner]])):
+            changes[position] = result
+        return {'changes': changes}
 
     @staticmethod
-    def get_kernel_transitions(kernel_id: str, df: pd.DataFrame) -> List[Dict]:
-        transitions = []
-        cols = ['cell_index', 'cell_source', 'cell_num', 'cell_label']
-        executions_list = df[cols].to_numpy()
-
-        prev_idx, prev_source, prev_num, prev_label = executions_list[0]
-        for (idx, source, num, label) in executions_list[1:]:
-            # code_changes = self._get_code_changes(prev_source, source) if idx == prev_idx else []
-            transitions.append({
-                'kernel_id': kernel_id,
-                'cell_idx_from': prev_idx, 'cell_num_from': prev_num, 'cell_source_from': prev_source,
-                'cell_idx_to': idx, 'cell_num_to': num, 'cell_source_to': source,
-                'cell_label_from': prev_label, 'cell_label_to': label,
-                'inner_transition': idx == prev_idx,
-                # 'changes': code_changes,
-                'type': 'execution_transition'
-            })
-            prev_idx, prev_source, prev_num, prev_label = idx, source, num, label
-
-        return transitions
+    def attach_sources(transitions: pd.DataFrame, df: pd.DataFrame, column: str = 'cell_source') -> pd.DataFrame:
+        # only for the transitions that need the text, e.g. after filtering
+        values = df[column]
+        return transitions.assign(**{
+            f'{column}_from': values.loc[transitions.row_from].to_numpy(),
+            f'{column}_to': values.loc[transitions.row_to].to_numpy(),
+        })
+
+    def get_execution_transitions(self, df: pd.DataFrame) -> pd.DataFrame:
+        executions = self._get_executions(df)
+        start, end, kernel_ids = self._get_transition_positions(executions)
+        if not len(start):
+            return pd.DataFrame()
+
+        columns = {'idx': 'cell_index', 'num': 'cell_num', 'source': 'cell_source'}
+        values = {name: executions[column].to_numpy() for name, column in columns.items()}
+        labels = executions.cell_label.to_numpy()
+        return pd.DataFrame({
+            'kernel_id': np.asarray(kernel_ids, dtype=object).tolist(),
+            **{
+                f'cell_{name}_{side}': values[name][positions].tolist()
+                for side, positions in (('from', start), ('to', end)) for name in columns
+            },
+            'cell_label_from': labels[start].tolist(), 'cell_label_to': labels[end].tolist(),
+            'inner_transition': (values['idx'][start] == values['idx'][end]).astype(bool),
+            **self._get_changes(values['source'], start, end, values['idx'][start] == values['idx'][end]),
+            'type': 'execution_transition'
+        })
 
     @staticmethod
     def get_event_transitions(df: pd.DataFrame) -> pd.DataFrame:
-        grouped = df.groupby('kernel_id')
+        start, end, kernel_ids = TransitionMetrics._get_transition_positions(df)
+        if not len(start):
+            return pd.DataFrame()
+
+        events = df.event.to_numpy()
+        return pd.DataFrame({
+            'kernel_id': np.asarray(kernel_ids, dtype=object).tolist(),
+            'event_from': events[start].tolist(), 'event_to': events[end].tolist(),
+            'type': 'event_transition'
+        })
+
+
+class TransitionCounter:
+
+    def __init__(
+            self, column: str = 'event', order: int = 2, group_by: Sequence[str] = (),
+            events: Optional[Sequence[str]] = None, split_inner: bool = False
+    ):
+        # counts of the n-grams of consecutive values of column in each kernel, per group of group_by values,
+        # the logs can come in chunks, e.g. read_csv(chunksize=...), as long as the rows of a kernel keep their order
+        self.column = column
+        self.order = order
+        self.group_by = list(group_by)
+        self.events = events
+        # n-grams within one cell, with the same cell_index all along, are counted apart from the others
+        self.split_inner = split_inner
+
+        self.states, self.groups = {}, {}
+        self.counts = np.zeros((1, 2 if split_inner else 1, *(1,) * order), dtype=np.int64)
+        # the last order - 1 rows of every kernel seen, for the n-grams that continue in the next chunk
+        self.tails = {'kernel': np.empty(0, dtype=object), 'state': np.empty(0, dtype=np.int64),
+                      'group': np.empty(0, dtype=np.int64), 'cell': np.empty(0, dtype=object)}
+
+    @staticmethod
+    def _encode(values, vocabulary: dict) -> np.ndarray:
+        codes, uniques = pd.factorize(values, use_na_sentinel=False)
+        mapping = np.array([
+            vocabulary.setdefault(None if not isinstance(value, tuple) and pd.isna(value) else value, len(vocabulary))
+            for value in uniques
+        ], dtype=np.int64)
+        return mapping[codes] if len(codes) else np.empty(0, dtype=np.int64)
+
+    def _resize(self):
+        # the counts grow with the number of states and groups, capacity doubles to keep the copies rare
+        shape = self.counts.shape
+        groups, states = max(len(self.groups), 1), max(len(self.states), 1)
+        new_groups = shape[0] if groups <= shape[0] else max(groups, 2 * shape[0])
+        new_states = shape[2] if states <= shape[2] else max(states, 2 * shape[2])
+        if (new_groups, new_states) != (shape[0], shape[2]):
+            padding = [(0, new_groups - shape[0]), (0, 0)] + [(0, new_states - shape[2])] * self.order
+            self.counts = np.pad(self.counts, padding)
+
+    def update(self, df: pd.DataFrame) -> 'TransitionCounter':
+        if self.events is not None:
+            df = df.loc[df.event.isin(self.events).to_numpy()]
+        if not len(df):
+            return self
+
+        states = self._encode(df[self.column].to_numpy(), self.states)
+        groups = self._encode(
+            pd.MultiIndex.from_frame(df[self.group_by]) if self.group_by else np.zeros(len(df), dtype=np.int64),
+            self.groups
+        )
+        self._resize()
+
+        kernel, cell = df.kernel_id.to_numpy(dtype=object), df.cell_index.to_numpy(dtype=object)
+        in_chunk = np.isin(self.tails['kernel'], pd.unique(kernel))
+        kernel = np.concatenate([self.tails['kernel'][in_chunk], kernel])
+        states = np.concatenate([self.tails['state'][in_chunk], states])
+        groups = np.concatenate([self.tails['group'][in_chunk], groups])
+        cell = np.concatenate([self.tails['cell'][in_chunk], cell])
+
+        # the rows of each kernel one after another, the tails first
+        kernel_codes = pd.factorize(kernel)[0]
+        rows = np.argsort(kernel_codes, kind='stable')
+        kernel, kernel_codes, cell = kernel[rows], kernel_codes[rows], cell[rows]
+        states, groups = states[rows], groups[rows]
+
+        n = self.order
+        count = max(len(kernel_codes) - n + 1, 0)
+        starts = np.flatnonzero(kernel_codes[:count] == kernel_codes[n - 1:n - 1 + count])
+        inner = np.zeros(len(starts), dtype=np.int64)
+        if self.split_inner:
+            same_cell = np.append(False, cell[1:] == cell[:-1]).astype(bool)
+            inner = np.ones(len(starts), dtype=bool)
+            for k in range(1, n):
+                inner &= same_cell[starts + k]
+            inner = inner.astype(np.int64)
+
+        index = np.ravel_multi_index(
+            (groups[starts + n - 1], inner, *(states[starts + k] for k in range(n))), self.counts.shape
+        )
+        if len(index) * 8 >= self.counts.size:
+            self.counts += np.bincount(index, minlength=self.counts.size).reshape(self.counts.shape)
+        else:
+            # small chunks touch few cells of the counts
+            index, counts = np.unique(index, return_counts=True)
+            self.counts.reshape(-1)[index] += counts
+
+        # the tails of the kernels in the chunk are replaced by their last rows
+        from_end = np.empty(len(kernel_codes), dtype=np.int64)
+        if len(kernel_codes):
+            last = np.append(kernel_codes[1:] != kernel_codes[:-1], True)
+            ends = np.flatnonzero(last)
+            from_end = np.repeat(ends, np.diff(np.append(-1, ends))) - np.arange(len(kernel_codes))
+        tail = from_end < n - 1
+        self.tails = {
+            name: np.concatenate([self.tails[name][~in_chunk], values[tail]])
+            for name, values in (('kernel', kernel), ('state', states), ('group', groups), ('cell', cell))
+        }
+        return self
 
-        transitions = []
-        for kernel_id, g in tqdm(grouped):
-            events_list = g.event.to_numpy()
-            events_transitions = list(zip(events_list, events_list[1:]))
-            transitions += [
-                {"kernel_id": kernel_id, 'event_from': start, 'event_to': finish, 'type': 'event_transition'}
-                for (start, finish) in events_transitions
-            ]
+    def get_ngrams(self) -> pd.DataFrame:
+        states, groups = list(self.states), list(self.groups)
+        counts = self.counts[:max(len(groups), 1), :, *(slice(0, len(states)),) * self.order]
+        positions = np.nonzero(counts)
 
-        transitions_df = pd.DataFrame(transitions)
+        states = pd.Series(states, dtype=object).to_numpy()
+        ngrams = pd.DataFrame({f'{self.column}_{k + 1}': states[positions[2 + k]] for k in range(self.order)})
+        if self.group_by:
+            group_values = pd.MultiIndex.from_tuples(groups, names=self.group_by)[positions[0]]
+            ngrams = pd.concat([group_values.to_frame(index=False), ngrams], axis=1)
+        if self.split_inner:
+            ngrams.insert(len(self.group_by), 'inner_transition', positions[1].astype(bool))
+        ngrams['count'] = counts[positions]
+        return ngrams
 
-        return transitions_df
+    def get_matrix(self, group: Optional[tuple] = None, inner: Optional[bool] = None) -> pd.DataFrame:
+        # transition counts from the rows to the columns, summed over all groups when no group is given
+        if self.order != 2:
+            raise ValueError("transition matrices are for order 2")
+        states = list(self.states)
+        counts = self.counts[:, :, :len(states), :len(states)]
+        if group is not None:
+            group = group if isinstance(group, tuple) else (group,)
+            counts = counts[[self.groups[group]]] if group in self.groups else np.zeros_like(counts[:1])
+        if inner is not None:
+            counts = counts[:, [int(inner)]]
+        return pd.DataFrame(
+            counts.sum(axis=(0, 1)),
+            index=pd.Index(states, name=f'{self.column}_from'), columns=pd.Index(states, name=f'{self.column}_to')
+        )
@@ -0,0 +1,108 @@
+import ast
+from dataclasses import dataclass, field, fields
+from typing import Any, Callable, Optional
+
+from radon.raw import Module, analyze
+from radon.visitors import ComplexityVisitor
+
+# bump when the built-in metrics change, cached results of older versions are not used
+ANALYZER_VERSION = 1
+
+
+@dataclass
+class ParsedCell:
+    source: str
+    # the source with the lines that do not parse dropped one by one
+    tree: ast.Module
+    # radon raw metrics, None when the source does not tokenize
+    raw: Optional[Module]
+
+
+@dataclass
+class CellAnalysis:
+    objects: int = 0
+    sloc: int = 0
+    ccn: int = 0
+    comments: int = 0
+    extra: dict[str, Any] = field(default_factory=dict)
+
+    def as_dict(self) -> dict[str, Any]:
+        record = {f.name: getattr(self, f.name) for f in fields(self) if f.name != 'extra'}
+        record.update(self.extra)
+        return record
+
+
+CELL_METRICS = tuple(f.name for f in fields(CellAnalysis) if f.name != 'extra')
+
+
+def parse_source(source: str) -> ast.Module:
+    lines = None
+    while True:
+        try:
+            return ast.parse(source)
+        except SyntaxError as e:
+            lines = source.splitlines() if lines is None else lines
+            if not lines:
+                return ast.Module(body=[], type_ignores=[])
+            line = (e.lineno or 1) - 1
+            del lines[line if line < len(lines) else -1]
+            source = '\n'.join(lines)
+
+
+def parse_cell(source: Optional[str]) -> ParsedCell:
+    source = source if isinstance(source, str) else ''
+    try:
+        raw = analyze(source)
+    except SyntaxError:
+        raw = None
+    return ParsedCell(source, parse_source(source), raw)
+
+
+def count_objects(cell: ParsedCell) -> int:
+    return len({
+        node.id for node in ast.walk(cell.tree)
+        if isinstance(node, ast.Name) and isinstance(node.ctx, (ast.Load, ast.Store))
+    })
+
+
+def get_complexity(cell: ParsedCell) -> int:
+    return ComplexityVisitor.from_ast(cell.tree).complexity
+
+
+def get_sloc(cell: ParsedCell) -> int:
+    return cell.raw.sloc if cell.raw is not None else len(cell.source.splitlines())
+
+
+def get_comments(cell: ParsedCell) -> int:
+    return cell.raw.comments if cell.raw is not None else len(cell.source.splitlines())
+
+
+class CellAnalyzer:
+
+    def __init__(self, hooks: Optional[dict[str, Callable[[ParsedCell], Any]]] = None, version: str = ''):
+        # extra per-cell metrics computed from the already parsed cell, versioned together by version
+        self.hooks = dict(hooks or {})
+        self.version = version
+
+    def register(self, name: str, hook: Callable[[ParsedCell], Any]) -> None:
+        if name in CELL_METRICS:
+            raise ValueError(f"{name} is a built-in cell metric")
+        self.hooks[name] = hook
+
+    def get_metric_names(self) -> list[str]:
+        return list(CELL_METRICS) + list(self.hooks)
+
+    def get_cache_namespace(self) -> str:
+        return f"cells-v{ANALYZER_VERSION}-{self.version}:" + ",".join(self.get_metric_names())
+
+    def analyze(self, source: Optional[str]) -> CellAnalysis:
+        cell = parse_cell(source)
+        if not isinstance(source, str):
+            return CellAnalysis(extra={name: hook(cell) for name, hook in self.hooks.items()})
+        return CellAnalysis(
+            objects=count_objects(cell),
+            sloc=get_sloc(cell),
+            ccn=get_complexity(cell),
+            comments=get_comments(cell),
+            extra={name: hook(cell) for name, hook in self.hooks.items()}
+        )
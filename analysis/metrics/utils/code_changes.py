@@ -0,0 +1,135 @@
+import json
+import os
+import signal
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import code_diff as cd
+from code_diff.gumtree import json_serialize
+from Levenshtein import distance
+from tqdm import tqdm
+
+from analysis.metrics.utils.memo_cache import MemoCache, source_hash
+
+# bump when the stored edit scripts change, cached results of older versions are not used
+CODE_CHANGES_VERSION = 2
+
+
+class EditScriptTimeout(Exception):
+    pass
+
+
+def _raise_timeout(signum, frame):
+    raise EditScriptTimeout()
+
+
+def get_edit_script(source_from: str, source_to: str) -> Optional[list]:
+    # operations as in code_diff.gumtree.json_serialize, json_deserialize turns them back into an EditScript,
+    # None when the parser fails otherwise, e.g. on cells with IPython magics or shell escapes
+    try:
+        return json.loads(json_serialize(cd.difference(source_from, source_to, lang="python").edit_script()))
+    except ValueError:
+        return []
+    except EditScriptTimeout:
+        raise
+    except Exception:
+        return None
+
+
+def get_edit_script_with_timeout(source_from: str, source_to: str, timeout: Optional[float]) -> Optional[list]:
+    # the time limit needs SIGALRM, without it the pair is computed however long it takes
+    if not timeout or not hasattr(signal, 'setitimer') or threading.current_thread() is not threading.main_thread():
+        return get_edit_script(source_from, source_to)
+
+    previous = signal.signal(signal.SIGALRM, _raise_timeout)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return get_edit_script(source_from, source_to)
+    except EditScriptTimeout:
+        return None
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def _get_edit_scripts(pairs: list[tuple[str, str]], timeout: Optional[float]) -> list[Optional[list]]:
+    return [get_edit_script_with_timeout(source_from, source_to, timeout) for source_from, source_to in pairs]
+
+
+def get_significant_lines(source: str) -> list[str]:
+    # trailing spaces and blank lines do not change the AST
+    return [line.rstrip() for line in source.splitlines() if line.strip()]
+
+
+class CodeChanges:
+
+    def __init__(
+            self, cache_path: Optional[str | os.PathLike] = None, n_jobs: int = 1, max_source_size: int = 20000,
+            timeout: Optional[float] = 10, min_distance: int = 0, pairs_per_task: int = 64
+    ):
+        # pairs longer than max_source_size characters together, or that take longer than timeout seconds, get None,
+        # as do pairs less than min_distance edits apart
+        self.n_jobs = n_jobs
+        self.max_source_size = max_source_size
+        self.timeout = timeout
+        self.min_distance = min_distance
+        self.pairs_per_task = pairs_per_task
+        self.cache = MemoCache(cache_path, f"code-changes-v{CODE_CHANGES_VERSION}")
+
+    def prefilter(self, source_from, source_to) -> tuple[bool, Optional[list]]:
+        # whether the pair needs the AST diff, and the changes when it does not
+        if not isinstance(source_from, str) or not isinstance(source_to, str) or source_from == source_to:
+            return False, []
+        if get_significant_lines(source_from) == get_significant_lines(source_to):
+            return False, []
+        if self.max_source_size is not None and len(source_from) + len(source_to) > self.max_source_size:
+            return False, None
+        if self.min_distance and distance(source_from, source_to, score_cutoff=self.min_distance - 1) < self.min_distance:
+            return False, None
+        return True, None
+
+    def compute(self, pairs: dict[str, tuple[str, str]], progress: bool = True) -> dict[str, Optional[list]]:
+        keys = list(pairs)
+        chunks = [keys[start:start + self.pairs_per_task] for start in range(0, len(keys), self.pairs_per_task)]
+        pbar = tqdm(total=len(keys)) if progress else None
+
+        computed = {}
+        if self.n_jobs == 1:
+            results = (_get_edit_scripts([pairs[key] for key in chunk], self.timeout) for chunk in chunks)
+            self._gather(chunks, results, computed, pbar)
+        else:
+            with ProcessPoolExecutor(max_workers=None if self.n_jobs == -1 else self.n_jobs) as executor:
+                results = executor.map(
+                    _get_edit_scripts, [[pairs[key] for key in chunk] for chunk in chunks],
+                    [self.timeout] * len(chunks)
+                )
+                self._gather(chunks, results, computed, pbar)
+
+        if pbar is not None:
+            pbar.close()
+        return computed
+
+    def _gather(self, chunks, results, computed: dict, pbar) -> None:
+        # results are stored as they come, an interrupted run keeps what is done. None comes from a timeout or a
+        # parser failure that a later run may not hit, it is not stored
+        for chunk, scripts in zip(chunks, results):
+            chunk_results = dict(zip(chunk, scripts))
+            self.cache.set_many({key: script for key, script in chunk_results.items() if script is not None})
+            computed.update(chunk_results)
+            if pbar is not None:
+                pbar.update(len(chunk))
+
+    def calculate(self, sources_from, sources_to, progress: bool = True) -> list[Optional[list]]:
+        changes, keys, pairs = [], [], {}
+        for source_from, source_to in zip(sources_from, sources_to):
+            needs_diff, result = self.prefilter(source_from, source_to)
+            key = f"{source_hash(source_from)}:{source_hash(source_to)}" if needs_diff else None
+            if key is not None:
+                pairs.setdefault(key, (source_from, source_to))
+            changes.append(result)
+            keys.append(key)
+
+        found = self.cache.get_many(list(pairs))
+        found.update(self.compute({key: pair for key, pair in pairs.items() if key not in found}, progress))
+        return [found[key] if key is not None else result for key, result in zip(keys, changes)]
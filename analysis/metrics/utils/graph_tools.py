@@ -1,14 +1,15 @@
-from typing import Tuple, Any, Optional
+from typing import Tuple, Any, Optional, TYPE_CHECKING
 
-import graphviz
 import matplotlib
 import matplotlib.pyplot as plt
 import networkx as nx
 import pandas as pd
-import pydotplus
 
 from analysis.dataset.june_dataset import NotebookState
 
+if TYPE_CHECKING:
+    import graphviz
+
 
 def evolution_to_execution_path(
         evolution: list[NotebookState],
@@ -44,7 +45,9 @@ def evolution_to_graphviz(
         max_snap_num: int,
         min_snap_num: int = 1,
         hash_string_num: int = 8,
-) -> graphviz.Digraph:
+) -> 'graphviz.Digraph':
+    import graphviz
+
     graph = graphviz.Digraph()
 
     graph.attr(rankdir='LR', size='10,10')
@@ -81,36 +84,58 @@ def evolution_to_graphviz(
     return graph
 
 
+def get_edge_colors(size: int, cmap_name: str | None = None) -> list[str]:
+    if cmap_name is None:
+        return ["black"] * size
+    cmap = matplotlib.cm.get_cmap(cmap_name)
+    norm = matplotlib.colors.Normalize(vmin=10.0, vmax=size)
+    return [matplotlib.colors.to_hex(cmap(norm(i))) for i in range(size)]
+
+
+def dataframe_to_execution_path(
+        df: pd.DataFrame,
+        min_state_num: Optional[int] = None, max_state_num: Optional[int] = None,
+        hash_string_num: int = 8
+) -> list[tuple[str, str]]:
+    rows = df.iloc[min_state_num:max_state_num]
+    cell_indices = rows.cell_index.to_numpy()[rows.event.to_numpy() == "execute"]
+    nodes = ["0"] + [cell_index[:hash_string_num] for cell_index in cell_indices]
+    return list(zip(nodes[:-1], nodes[1:]))
+
+
 def dataframe_to_graphviz(
         df: pd.DataFrame,
-        graph: Optional[nx.Graph | nx.DiGraph] = None,
+        graph: Optional['graphviz.Digraph'] = None,
         min_state_num: Optional[int] = None, max_state_num: Optional[int] = None,
         hash_string_num: int = 8, cmap_name: str | None = None
-) -> graphviz.Digraph:
-    edges, prev_cell_index = [], "0"
-    graph = graphviz.Digraph() if graph is None else graph
+) -> 'graphviz.Digraph':
+    import graphviz
 
-    executions = df.iloc[min_state_num:max_state_num][df.event == "execute"]
+    graph = graphviz.Digraph() if graph is None else graph
+    edges = dataframe_to_execution_path(df, min_state_num, max_state_num, hash_string_num)
+    for i, (edge, color) in enumerate(zip(edges, get_edge_colors(len(edges), cmap_name))):
+        graph.edge(*edge, label=f"{i}", color=color)
+    return graph
 
-    colorful = cmap_name is not None
-    if colorful:
-        size = len(executions)
-        cmap = matplotlib.cm.get_cmap(cmap_name)
-        norm = matplotlib.colors.Normalize(vmin=10.0, vmax=size)
 
-    for i, (_, log_row) in enumerate(executions.iterrows()):
-        cell_index = log_row.cell_index
-        params = {
-            "label": f"{i}",
-            "color": matplotlib.colors.to_hex(cmap(norm(i))) if colorful else "black"
-        }
-        cur_cell_index = cell_index[:hash_string_num]
-        graph.edge(prev_cell_index, cur_cell_index, **params)
-        prev_cell_index = cur_cell_index
+def dataframe_to_networkx(
+        df: pd.DataFrame,
+        min_state_num: Optional[int] = None, max_state_num: Optional[int] = None,
+        hash_string_num: int = 8, cmap_name: str | None = None
+) -> nx.MultiDiGraph:
+    # the same graph as graphviz2networkx(dataframe_to_graphviz(...)) without going through DOT
+    graph = nx.MultiDiGraph()
+    edges = dataframe_to_execution_path(df, min_state_num, max_state_num, hash_string_num)
+    graph.add_edges_from(
+        (*edge, {"label": f"{i}", "color": color})
+        for i, (edge, color) in enumerate(zip(edges, get_edge_colors(len(edges), cmap_name)))
+    )
     return graph
 
 
 def graphviz2networkx(g):
+    import pydotplus
+
     dotplus = pydotplus.graph_from_dot_data(g.source)
     nx_graph = nx.nx_pydot.from_pydot(dotplus)
     return nx_graph
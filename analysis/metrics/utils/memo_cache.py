@@ -0,0 +1,77 @@
+import hashlib
+import json
+import os
+import sqlite3
+from collections import OrderedDict
+from contextlib import closing
+from typing import Any, Iterable, Optional
+
+SQLITE_MAX_VARIABLES = 500
+
+
+def source_hash(source: Optional[str]) -> str:
+    if not isinstance(source, str):
+        return 'none'
+    return hashlib.sha256(source.encode('utf-8', errors='surrogatepass')).hexdigest()
+
+
+class MemoCache:
+
+    def __init__(self, path: Optional[str | os.PathLike] = None, namespace: str = '', max_memory_items: int = 65536):
+        # recently used values stay in memory, all values are kept on disk when a path is given
+        self.path = path
+        self.namespace = namespace
+        self.max_memory_items = max_memory_items
+        self.memory = OrderedDict()
+        if path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with self._connect() as connection:
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS memo ("
+                    "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (namespace, key)"
+                    ") WITHOUT ROWID"
+                )
+
+    def _connect(self) -> closing:
+        # connections are not kept open, so that the cache can be pickled to worker processes
+        return closing(sqlite3.connect(self.path, timeout=60))
+
+    def _remember(self, key: str, value: Any) -> None:
+        key = (self.namespace, key)
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_items:
+            self.memory.popitem(last=False)
+
+    def get_many(self, keys: Iterable[str]) -> dict[str, Any]:
+        found, missing = {}, []
+        for key in keys:
+            if (self.namespace, key) in self.memory:
+                self.memory.move_to_end((self.namespace, key))
+                found[key] = self.memory[(self.namespace, key)]
+            else:
+                missing.append(key)
+
+        if missing and self.path is not None:
+            with self._connect() as connection:
+                for start in range(0, len(missing), SQLITE_MAX_VARIABLES):
+                    chunk = missing[start:start + SQLITE_MAX_VARIABLES]
+                    rows = connection.execute(
+                        f"SELECT key, value FROM memo WHERE namespace = ? AND key IN ({', '.join('?' * len(chunk))})",
+                        [self.namespace] + chunk
+                    )
+                    for key, value in rows:
+                        found[key] = json.loads(value)
+                        self._remember(key, found[key])
+
+        return found
+
+    def set_many(self, items: dict[str, Any]) -> None:
+        for key, value in items.items():
+            self._remember(key, value)
+        if items and self.path is not None:
+            with self._connect() as connection, connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO memo (namespace, key, value) VALUES (?, ?, ?)",
+                    [(self.namespace, key, json.dumps(value)) for key, value in items.items()]
+                )
@@ -0,0 +1,81 @@
+import ast
+import json
+import re
+from typing import Optional
+
+_TOKENS = re.compile(r"""[\[\]{}:,'"]""")
+_SUMMARY_KEYS = ('output_type', 'ename')
+
+
+def serialize_output(output) -> Optional[str]:
+    if not output:
+        return None
+    return output if isinstance(output, str) else json.dumps(output, ensure_ascii=False)
+
+
+def _skip_string(text: str, start: int) -> int:
+    # string literals of both JSON and Python reprs are skipped with find, whatever their size
+    quote = text[start]
+    end = text.find(quote, start + 1)
+    while end != -1:
+        escape = end - 1
+        while text[escape] == '\\':
+            escape -= 1
+        if (end - 1 - escape) % 2 == 0:
+            return end + 1
+        end = text.find(quote, end + 1)
+    return len(text)
+
+
+def _decode_string(token: str) -> str:
+    try:
+        return json.loads(token) if token[0] == '"' else ast.literal_eval(token)
+    except (ValueError, SyntaxError):
+        return token[1:-1]
+
+
+def summarize_output(output: Optional[str]) -> dict:
+    summary = {'output_type': None, 'output_count': 0, 'output_bytes': 0, 'error_name': None}
+    if not output:
+        return summary
+    summary['output_bytes'] = len(output.encode('utf-8', errors='surrogatepass'))
+
+    # outputs are a list of dicts, only the keys of the top-level dicts are looked at
+    depth, expect_key, key, element = 0, False, None, {}
+    position = 0
+    while match := _TOKENS.search(output, position):
+        token, position = match.group(), match.end()
+        if depth == 0 and token != '[':
+            break
+
+        if token in ('[', '{'):
+            if depth == 1:
+                summary['output_count'] += 1
+                element = {}
+            depth += 1
+            expect_key = depth == 2 and token == '{'
+        elif token in (']', '}'):
+            depth -= 1
+            if depth == 1:
+                if summary['output_type'] is None:
+                    summary['output_type'] = element.get('output_type')
+                if summary['error_name'] is None and element.get('output_type') == 'error':
+                    summary['error_name'] = element.get('ename')
+            elif depth == 0:
+                break
+        elif token == ',':
+            expect_key = depth == 2
+        elif token == ':':
+            expect_key = False
+        else:
+            position = _skip_string(output, match.start())
+            if depth == 1:
+                summary['output_count'] += 1
+            elif depth == 2 and expect_key:
+                name = output[match.start() + 1:position - 1]
+                key = name if name in _SUMMARY_KEYS else None
+            elif depth == 2 and key is not None:
+                element[key] = _decode_string(output[match.start():position])
+                key = None
+
+    return summary
@@ -1,3 +1,12 @@
+import os
 from pathlib import Path
 
+import yaml
+
 MAIN_FOLDER = Path(__file__).parent
+
+
+def get_database_path() -> Path:
+    with (MAIN_FOLDER / Path("app_config.yaml")).open("r") as stream:
+        config = yaml.safe_load(stream)
+    return MAIN_FOLDER / os.environ.get('LOGS_DATABASE_PATH', config['database_rel_path'])
@@ -1,13 +1,24 @@
+import atexit
 import os
+import signal
+import sys
 from pathlib import Path
 
 import yaml
-from flask import request, Flask, render_template
+from flask import request, Flask, Response, abort, stream_template, stream_with_context
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import insert, select, func
 
+from analysis.metrics.utils.outputs import serialize_output
 from server import MAIN_FOLDER
-from server.db_structures import UserLogs
+from server.db_structures import (
+    UserLogs, get_logs_columns, get_logs_from_clause, split_blobs, insert_blobs, add_derived_columns
+)
+from server.export import (
+    EXPORT_FORMATS, DEFAULT_CHUNK_SIZE, build_export_query, iter_log_chunks, iter_ndjson, iter_parquet
+)
+from server.ingest import WriteBehindQueue, QueueFullError, QueueClosedError
 
 with (MAIN_FOLDER / Path("app_config.yaml")).open("r") as stream:
     try:
@@ -16,9 +27,9 @@ with (MAIN_FOLDER / Path("app_config.yaml")).open("r") as stream:
         exit()
 
 basedir = os.path.abspath(os.path.dirname(__file__))
-db_name = config['database_rel_path']
+db_name = os.environ.get('LOGS_DATABASE_PATH', config['database_rel_path'])
 host = config['host']
-port = config['port']
+port = int(os.environ.get('LOGS_SERVER_PORT', config['port']))
 
 app = Flask(__name__)
 CORS(app)
@@ -27,33 +38,152 @@ app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(basedir, db_na
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = True
 db = SQLAlchemy(app)
 
+LOG_COLUMNS = tuple(c for c in get_logs_columns() if c != 'id')
+BROWSER_COLUMNS = (
+    "ip_address", "time", "session_id", "kernel_id",
+    "notebook_name", "cell_index", "cell_num",
+    "event", "cell_source", "cell_output"
+)
+TEXT_COLUMNS = ("cell_source", "cell_output")
+FILTER_COLUMNS = ("kernel_id", "notebook_name", "event")
+
+page_size = config.get('db_page_size', 100)
+max_page_size = config.get('db_max_page_size', 1000)
+preview_chars = config.get('db_preview_chars', 200)
+
+
+# last sequence number of every kernel, only the writer thread touches it
+kernel_sequences = {}
+
+
+def write_logs(events: list[dict]) -> None:
+    with app.app_context():
+        with db.engine.begin() as connection:
+            rows, blobs = split_blobs(add_derived_columns(connection, events, kernel_sequences))
+            insert_blobs(connection, blobs)
+            connection.execute(insert(UserLogs), rows)
+
+
+log_queue = WriteBehindQueue(
+    write_logs,
+    max_size=config.get('queue_max_size', 10000),
+    flush_size=config.get('flush_size', 500),
+    flush_interval=config.get('flush_interval_sec', 1.0),
+    max_retries=config.get('write_max_retries', 3),
+    dead_letter_path=os.path.join(basedir, config.get('dead_letter_rel_path', '../data/dead_letters.ndjson')),
+)
+log_queue.start()
+atexit.register(log_queue.close)
+
+
+def prepare_event(content: dict) -> dict:
+    content['cell_source'] = str(content['cell_source']) if content.get('cell_source') else None
+    content['cell_output'] = serialize_output(content.get('cell_output'))
+    return content
+
+
+def enqueue_events(events: list[dict]):
+    try:
+        log_queue.put([{c: event.get(c) for c in LOG_COLUMNS} for event in events])
+    except (QueueFullError, QueueClosedError) as e:
+        return {'error': str(e)}, 503, {'Retry-After': str(max(1, round(log_queue.flush_interval)))}
+    return None
+
+
+def build_logs_query(args, preview: int):
+    logs_columns = get_logs_columns()
+    columns = [UserLogs.id] + [
+        func.substr(logs_columns[c], 1, preview).label(c) if c in TEXT_COLUMNS else logs_columns[c]
+        for c in BROWSER_COLUMNS
+    ] + [func.length(logs_columns[c]).label(f"{c}_length") for c in TEXT_COLUMNS]
+    query = select(*columns).select_from(get_logs_from_clause())
+
+    for column in FILTER_COLUMNS:
+        if args.get(column):
+            query = query.where(getattr(UserLogs, column) == args[column])
+    if args.get('start'):
+        query = query.where(UserLogs.time >= args['start'])
+    if args.get('end'):
+        query = query.where(UserLogs.time < args['end'])
+
+    return query
+
 
 @app.route('/db')
 def render_logs_database():
-    data = db.session.query(UserLogs).all()
-    rows = [d.as_dict() for d in data]
-    columns = (
-        "ip_address", "time", "session_id", "kernel_id",
-        "notebook_name", "cell_index", "cell_num",
-        "event", "cell_source", "cell_output"
+    args = request.args
+    limit = args.get('limit', page_size, type=int)
+    # SQLite reads a negative LIMIT as no limit at all
+    limit = max(1, min(limit if limit > 0 else page_size, max_page_size))
+    descending = args.get('order', 'asc') == 'desc'
+    cursor = args.get('cursor', type=int)
+
+    query = build_logs_query(args, preview_chars)
+    if cursor is not None:
+        query = query.where(UserLogs.id < cursor if descending else UserLogs.id > cursor)
+    query = query.order_by(UserLogs.id.desc() if descending else UserLogs.id).limit(limit)
+
+    page_args = {k: v for k, v in args.items() if k != 'cursor'}
+    rows = db.session.execute(query).mappings()
+
+    return stream_template(
+        'db_template.html', rows=rows, columns=BROWSER_COLUMNS, text_columns=TEXT_COLUMNS,
+        filters=FILTER_COLUMNS, args=args, page_args=page_args, limit=limit, preview=preview_chars
+    )
+
+
+@app.route('/db/<int:log_id>/<column>')
+def render_log_field(log_id: int, column: str):
+    if column not in TEXT_COLUMNS:
+        abort(404)
+    value = db.session.execute(
+        select(get_logs_columns()[column]).select_from(get_logs_from_clause()).where(UserLogs.id == log_id)
+    ).scalar_one_or_none()
+    return value or "", {'Content-Type': 'text/plain; charset=utf-8'}
+
+
+@app.route('/export')
+def export_logs():
+    args = request.args
+    export_format = args.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+        return {'error': f"format must be one of {EXPORT_FORMATS}"}, 400
+
+    query = build_export_query(
+        args.get('since_id', type=int), args.get('start'), args.get('end'), args.getlist('kernel_id')
     )
+    chunk_size = args.get('chunk_size', DEFAULT_CHUNK_SIZE, type=int)
+
+    def generate():
+        with db.engine.connect() as connection:
+            chunks = iter_log_chunks(connection, query, chunk_size)
+            yield from iter_parquet(chunks) if export_format == 'parquet' else iter_ndjson(chunks)
 
-    return render_template('db_template.html', rows=rows, columns=columns)
+    mimetype = 'application/vnd.apache.parquet' if export_format == 'parquet' else 'application/x-ndjson'
+    return Response(stream_with_context(generate()), mimetype=mimetype)
 
 
 @app.route('/', methods=['GET', 'POST'])
 def add_message():
-    content = request.json
-    content['cell_source'] = str(content['cell_source']) if content['cell_source'] else None
-    content['cell_output'] = str(content['cell_output']) if content['cell_output'] else None
+    content = prepare_event(request.json)
+    return enqueue_events([content]) or content
 
-    user_log = UserLogs(**content)
-    db.session.add(user_log)
-    db.session.commit()
-    return content
+
+@app.route('/batch', methods=['POST'])
+def add_messages():
+    events = request.json
+    if not isinstance(events, list):
+        return {'error': 'expected a JSON array of events'}, 400
+    if not all(isinstance(content, dict) for content in events):
+        return {'error': 'expected every event to be a JSON object'}, 400
+
+    events = [prepare_event(content) for content in events]
+    return enqueue_events(events) or ({'accepted': len(events)}, 202)
 
 
 def run_server() -> None:
+    # turn SIGTERM into a normal exit so that the queue is flushed by atexit
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
     app.run(host=host, port=port)
 
 
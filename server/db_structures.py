@@ -1,17 +1,37 @@
+import hashlib
+from datetime import datetime, timezone
 from pathlib import Path
+from typing import Optional
 
-from sqlalchemy import Column, String, Integer, Text
-from sqlalchemy import create_engine
+from sqlalchemy import Column, String, Integer, BigInteger, Boolean, Text, ForeignKey, Index
+from sqlalchemy import create_engine, inspect, text, select, update, func, bindparam
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Connection
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import relationship
 from sqlalchemy_utils import database_exists, create_database
 
-from server import MAIN_FOLDER
+from analysis.metrics.utils.outputs import summarize_output
+from server import MAIN_FOLDER, get_database_path
 
 base = declarative_base()
 
+BLOB_COLUMNS = {'cell_source': 'cell_source_hash', 'cell_output': 'cell_output_hash'}
+
+
+class LogBlobs(base):
+    __tablename__ = 'log_blobs'
+
+    hash = Column(String(64), primary_key=True)
+    content = Column(Text)
+
 
 class UserLogs(base):
     __tablename__ = 'user_logs'
+    __table_args__ = (
+        Index('ix_user_logs_kernel_id_time', 'kernel_id', 'time'),
+        Index('ix_user_logs_notebook_name_event', 'notebook_name', 'event'),
+    )
 
     id = Column(Integer, primary_key=True)
     ip_address = Column(String(50))
@@ -23,8 +43,33 @@ class UserLogs(base):
     cell_index = Column(String(50))
     cell_num = Column(Integer)
     cell_type = Column(String(50))
-    cell_source = Column(Text)
-    cell_output = Column(Text)
+    # texts are stored once in log_blobs, these columns only hold rows written before deduplication
+    legacy_cell_source = Column('cell_source', Text)
+    legacy_cell_output = Column('cell_output', Text)
+    cell_source_hash = Column(String(64), ForeignKey('log_blobs.hash'), default=None)
+    cell_output_hash = Column(String(64), ForeignKey('log_blobs.hash'), default=None)
+    user_id = Column(String(50), default=None)
+    # derived at ingest: epoch milliseconds, position of the event in its kernel and the study groups
+    timestamp = Column(BigInteger)
+    seq_num = Column(Integer)
+    task = Column(String(50))
+    expert = Column(Boolean)
+    # derived at ingest from the output, so that analysis does not have to parse it
+    output_type = Column(String(50))
+    output_count = Column(Integer)
+    output_bytes = Column(BigInteger)
+    error_name = Column(String(100))
+
+    source_blob = relationship(LogBlobs, foreign_keys=[cell_source_hash])
+    output_blob = relationship(LogBlobs, foreign_keys=[cell_output_hash])
+
+    @property
+    def cell_source(self) -> Optional[str]:
+        return self.source_blob.content if self.source_blob is not None else self.legacy_cell_source
+
+    @property
+    def cell_output(self) -> Optional[str]:
+        return self.output_blob.content if self.output_blob is not None else self.legacy_cell_output
 
     def as_dict(self):
         return {
@@ -33,6 +78,125 @@ class UserLogs(base):
         }
 
 
+source_blobs = LogBlobs.__table__.alias('source_blobs')
+output_blobs = LogBlobs.__table__.alias('output_blobs')
+
+
+def get_logs_columns() -> dict:
+    logs = UserLogs.__table__
+    columns = {c.name: c for c in logs.columns if c.name not in BLOB_COLUMNS.values()}
+    columns['cell_source'] = func.coalesce(source_blobs.c.content, logs.c.cell_source)
+    columns['cell_output'] = func.coalesce(output_blobs.c.content, logs.c.cell_output)
+    return columns
+
+
+def get_logs_from_clause():
+    logs = UserLogs.__table__
+    return logs.outerjoin(
+        source_blobs, logs.c.cell_source_hash == source_blobs.c.hash
+    ).outerjoin(
+        output_blobs, logs.c.cell_output_hash == output_blobs.c.hash
+    )
+
+
+def content_hash(content: str) -> str:
+    return hashlib.sha256(content.encode('utf-8', errors='surrogatepass')).hexdigest()
+
+
+def split_blobs(events: list[dict]) -> tuple[list[dict], list[dict]]:
+    rows, blobs = [], {}
+    for event in events:
+        row = dict(event)
+        for column, hash_column in BLOB_COLUMNS.items():
+            content = row.pop(column, None)
+            if content is None:
+                row[hash_column] = None
+                continue
+            row[hash_column] = content_hash(content)
+            blobs[row[hash_column]] = content
+        rows.append(row)
+
+    return rows, [{'hash': h, 'content': c} for h, c in blobs.items()]
+
+
+def parse_timestamp(time: Optional[str]) -> Optional[int]:
+    if not time:
+        return None
+    try:
+        parsed = datetime.fromisoformat(time)
+    except (TypeError, ValueError):
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return round(parsed.timestamp() * 1000)
+
+
+def get_task(notebook_name: Optional[str]) -> Optional[str]:
+    if notebook_name is None:
+        return None
+    return 'task1' if 'task1' in notebook_name else 'task2'
+
+
+def add_derived_columns(connection: Connection, events: list[dict], sequences: dict[str, int]) -> list[dict]:
+    logs = UserLogs.__table__
+    for event in events:
+        kernel_id = event.get('kernel_id')
+        if kernel_id not in sequences:
+            last_seq_num = connection.execute(
+                select(func.max(logs.c.seq_num)).where(logs.c.kernel_id == kernel_id)
+            ).scalar()
+            sequences[kernel_id] = -1 if last_seq_num is None else last_seq_num
+
+        sequences[kernel_id] += 1
+        event['seq_num'] = sequences[kernel_id]
+        event['timestamp'] = parse_timestamp(event.get('time'))
+        event['task'] = get_task(event.get('notebook_name'))
+        event['expert'] = 'expert' in (event.get('user_id') or '')
+        event.update(summarize_output(event.get('cell_output')))
+
+    return events
+
+
+def insert_blobs(connection: Connection, blobs: list[dict]) -> None:
+    if blobs:
+        connection.execute(sqlite_insert(LogBlobs).on_conflict_do_nothing(index_elements=['hash']), blobs)
+
+
+DERIVED_COLUMNS_BACKFILL = (
+    """
+    UPDATE user_logs
+    SET timestamp = CAST(ROUND((julianday(time) - 2440587.5) * 86400000) AS INTEGER)
+    WHERE timestamp IS NULL AND time IS NOT NULL
+    """,
+    """
+    UPDATE user_logs
+    SET task = CASE WHEN instr(notebook_name, 'task1') > 0 THEN 'task1' ELSE 'task2' END
+    WHERE task IS NULL AND notebook_name IS NOT NULL
+    """,
+    """
+    UPDATE user_logs
+    SET expert = coalesce(instr(user_id, 'expert') > 0, 0)
+    WHERE expert IS NULL
+    """,
+    """
+    UPDATE user_logs
+    SET output_count = 0, output_bytes = 0
+    WHERE output_count IS NULL AND cell_output IS NULL AND cell_output_hash IS NULL
+    """,
+    # kernels with unnumbered events are renumbered as a whole, in arrival order
+    """
+    WITH numbered AS (
+        SELECT id, ROW_NUMBER() OVER (PARTITION BY kernel_id ORDER BY id) - 1 AS seq_num
+        FROM user_logs
+        WHERE kernel_id IN (SELECT DISTINCT kernel_id FROM user_logs WHERE seq_num IS NULL)
+    )
+    UPDATE user_logs
+    SET seq_num = (SELECT numbered.seq_num FROM numbered WHERE numbered.id = user_logs.id)
+    WHERE id IN (SELECT id FROM numbered)
+    """,
+)
+
+
 def create_db(db_path: Path):
     engine = create_engine(f"sqlite:///{str(db_path)}", echo=True)
     if not database_exists(engine.url):
@@ -42,5 +206,79 @@ def create_db(db_path: Path):
     base.metadata.create_all(engine)
 
 
+def migrate_db(db_path: Path, chunk_size: int = 5000) -> None:
+    engine = create_engine(f"sqlite:///{str(db_path)}")
+    base.metadata.create_all(engine)
+
+    existing_columns = {c['name'] for c in inspect(engine).get_columns(UserLogs.__tablename__)}
+    with engine.begin() as connection:
+        for column in UserLogs.__table__.columns:
+            if column.name not in existing_columns:
+                column_type = column.type.compile(engine.dialect)
+                connection.execute(text(f"ALTER TABLE {UserLogs.__tablename__} ADD COLUMN {column.name} {column_type}"))
+
+    for index in UserLogs.__table__.indexes:
+        index.create(engine, checkfirst=True)
+
+    with engine.begin() as connection:
+        for statement in DERIVED_COLUMNS_BACKFILL:
+            connection.execute(text(statement))
+
+    logs = UserLogs.__table__
+    legacy_rows = select(logs.c.id, logs.c.cell_source, logs.c.cell_output).where(
+        logs.c.cell_source.isnot(None) | logs.c.cell_output.isnot(None)
+    ).order_by(logs.c.id).limit(chunk_size)
+
+    # move the texts of old rows to log_blobs chunk by chunk
+    while True:
+        with engine.begin() as connection:
+            events = [dict(row) for row in connection.execute(legacy_rows).mappings()]
+            if not events:
+                break
+            rows, blobs = split_blobs(events)
+            insert_blobs(connection, blobs)
+            connection.execute(
+                update(logs).where(logs.c.id == bindparam('row_id')).values(
+                    cell_source=None, cell_output=None,
+                    cell_source_hash=bindparam('source_hash'), cell_output_hash=bindparam('output_hash')
+                ),
+                [
+                    {'row_id': row['id'], 'source_hash': row['cell_source_hash'],
+                     'output_hash': row['cell_output_hash']}
+                    for row in rows
+                ]
+            )
+
+    columns = get_logs_columns()
+    unsummarized_rows = select(logs.c.id, columns['cell_output']).select_from(get_logs_from_clause()).where(
+        logs.c.output_count.is_(None)
+    ).order_by(logs.c.id).limit(chunk_size)
+
+    # summarize the outputs of old rows, the outputs themselves are kept as they were written
+    while True:
+        with engine.begin() as connection:
+            events = connection.execute(unsummarized_rows).all()
+            if not events:
+                break
+            connection.execute(
+                update(logs).where(logs.c.id == bindparam('row_id')).values(
+                    output_type=bindparam('type'), output_count=bindparam('count'),
+                    output_bytes=bindparam('bytes'), error_name=bindparam('error')
+                ),
+                [
+                    {'row_id': row_id, 'type': summary['output_type'], 'count': summary['output_count'],
+                     'bytes': summary['output_bytes'], 'error': summary['error_name']}
+                    for row_id, summary in ((row_id, summarize_output(output)) for row_id, output in events)
+                ]
+            )
+
+    with engine.connect() as connection:
+        connection.execute(text("VACUUM"))
+
+
+def run_migration() -> None:
+    migrate_db(get_database_path())
+
+
 if __name__ == '__main__':
     create_db(MAIN_FOLDER / "../data/test_db.db")
@@ -0,0 +1,186 @@
+import argparse
+import json
+import os
+from pathlib import Path
+from typing import Iterable, Iterator, Optional, IO
+
+from sqlalchemy import select, create_engine, Integer, BigInteger, Boolean, Float, Select
+from sqlalchemy.engine import Connection
+
+from server import get_database_path
+from server.db_structures import UserLogs, get_logs_columns, get_logs_from_clause
+
+EXPORT_FORMATS = ("ndjson", "parquet")
+DEFAULT_CHUNK_SIZE = 5000
+
+
+def build_export_query(
+        since_id: Optional[int] = None,
+        start: Optional[str] = None, end: Optional[str] = None,
+        kernel_ids: Optional[Iterable[str]] = None
+) -> Select:
+    query = select(
+        *[column.label(name) for name, column in get_logs_columns().items()]
+    ).select_from(get_logs_from_clause()).order_by(UserLogs.id)
+
+    if since_id is not None:
+        query = query.where(UserLogs.id > since_id)
+    if start:
+        query = query.where(UserLogs.time >= start)
+    if end:
+        query = query.where(UserLogs.time < end)
+    if kernel_ids:
+        query = query.where(UserLogs.kernel_id.in_(list(kernel_ids)))
+
+    return query
+
+
+def iter_log_chunks(
+        connection: Connection, query: Select, chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> Iterator[list[dict]]:
+    result = connection.execution_options(stream_results=True, yield_per=chunk_size).execute(query)
+    for partition in result.mappings().partitions(chunk_size):
+        yield [dict(row) for row in partition]
+
+
+def iter_ndjson(chunks: Iterable[list[dict]]) -> Iterator[str]:
+    for chunk in chunks:
+        yield "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in chunk)
+
+
+def get_arrow_schema():
+    import pyarrow as pa
+
+    def arrow_type(column):
+        if isinstance(column.type, (Integer, BigInteger)):
+            return pa.int64()
+        if isinstance(column.type, Boolean):
+            return pa.bool_()
+        if isinstance(column.type, Float):
+            return pa.float64()
+        return pa.string()
+
+    columns = {c.name: c for c in UserLogs.__table__.columns}
+    return pa.schema([(name, arrow_type(columns[name])) for name in get_logs_columns()])
+
+
+class _StreamSink:
+    def __init__(self):
+        self.buffer = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self.buffer.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+    def pop(self) -> bytes:
+        data, self.buffer = b"".join(self.buffer), []
+        return data
+
+
+def write_parquet(chunks: Iterable[list[dict]], sink: str | os.PathLike | IO) -> int:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema, rows = get_arrow_schema(), 0
+    with pq.ParquetWriter(sink, schema) as writer:
+        for chunk in chunks:
+            writer.write_table(pa.Table.from_pylist(chunk, schema=schema))
+            rows += len(chunk)
+    return rows
+
+
+def iter_parquet(chunks: Iterable[list[dict]]) -> Iterator[bytes]:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema, sink = get_arrow_schema(), _StreamSink()
+    # every chunk becomes a row group that is sent as soon as it is written
+    writer = pq.ParquetWriter(sink, schema)
+    for chunk in chunks:
+        writer.write_table(pa.Table.from_pylist(chunk, schema=schema))
+        yield sink.pop()
+    writer.close()
+    yield sink.pop()
+
+
+def read_state(state_path: Path) -> Optional[int]:
+    if not state_path.exists():
+        return None
+    with state_path.open("r") as f:
+        return json.load(f).get("last_id")
+
+
+def write_state(state_path: Path, last_id: int) -> None:
+    with state_path.open("w") as f:
+        json.dump({"last_id": last_id}, f)
+
+
+def _track_last_id(chunks: Iterable[list[dict]], state: dict) -> Iterator[list[dict]]:
+    for chunk in chunks:
+        if chunk:
+            state['last_id'] = chunk[-1]['id']
+        yield chunk
+
+
+def export_logs(
+        database_path: Path, output_path: Path, export_format: str = "ndjson",
+        since_id: Optional[int] = None, state_path: Optional[Path] = None,
+        start: Optional[str] = None, end: Optional[str] = None,
+        kernel_ids: Optional[Iterable[str]] = None, chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> Optional[int]:
+    if since_id is None and state_path is not None:
+        since_id = read_state(state_path)
+
+    engine = create_engine(f"sqlite:///{database_path}")
+    query = build_export_query(since_id, start, end, kernel_ids)
+    state = {'last_id': None}
+
+    with engine.connect() as connection:
+        chunks = _track_last_id(iter_log_chunks(connection, query, chunk_size), state)
+        if export_format == "parquet":
+            write_parquet(chunks, str(output_path))
+        else:
+            with output_path.open("w", encoding="utf-8") as f:
+                f.writelines(iter_ndjson(chunks))
+
+    if state_path is not None and state['last_id'] is not None:
+        write_state(state_path, state['last_id'])
+    return state['last_id']
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Export user logs as NDJSON or Parquet")
+    parser.add_argument("output", type=Path)
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default="ndjson")
+    parser.add_argument("--database", type=Path, default=None)
+    parser.add_argument("--since-id", type=int, default=None)
+    parser.add_argument("--state-file", type=Path, default=None,
+                        help="stores the last exported id, so that the next run exports only new rows")
+    parser.add_argument("--start", default=None)
+    parser.add_argument("--end", default=None)
+    parser.add_argument("--kernel-id", action="append", dest="kernel_ids", default=None)
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    last_id = export_logs(
+        args.database or get_database_path(), args.output, args.format,
+        args.since_id, args.state_file, args.start, args.end, args.kernel_ids, args.chunk_size
+    )
+    print(f"Exported up to id {last_id}" if last_id is not None else "Nothing to export")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+import json
+import logging
+import os
+import threading
+from collections import deque
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class QueueClosedError(Exception):
+    pass
+
+
+class WriteBehindQueue:
+    def __init__(
+            self,
+            write_batch: Callable[[list[dict]], None],
+            max_size: int = 10000,
+            flush_size: int = 500,
+            flush_interval: float = 1.0,
+            max_retries: int = 3,
+            dead_letter_path: Optional[str | os.PathLike] = None,
+    ):
+        self.write_batch = write_batch
+        self.max_size = max_size
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        # accepted events that cannot be written are retried at the next flushes, then appended to the dead letter
+        # file as JSON lines, to be inspected and sent again
+        self.max_retries = max_retries
+        self.dead_letter_path = dead_letter_path
+
+        # (failed attempts, event)
+        self._events = deque()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._writer = threading.Thread(target=self._run, name="user-logs-writer", daemon=True)
+
+    def __len__(self) -> int:
+        with self._condition:
+            return len(self._events)
+
+    def start(self) -> None:
+        if not self._writer.is_alive():
+            self._writer.start()
+
+    def put(self, events: list[dict]) -> None:
+        with self._condition:
+            if self._closed:
+                raise QueueClosedError("queue is closed")
+            # a batch is accepted or rejected as a whole
+            if len(self._events) + len(events) > self.max_size:
+                raise QueueFullError(f"queue is full ({len(self._events)}/{self.max_size} events)")
+
+            self._events.extend((0, event) for event in events)
+            if len(self._events) >= self.flush_size:
+                self._condition.notify()
+
+    def close(self) -> None:
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify()
+
+        if self._writer.is_alive():
+            self._writer.join()
+        else:
+            # the writer was never started, flush whatever was queued in place
+            self._drain_all()
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: self._closed or len(self._events) >= self.flush_size,
+                    timeout=self.flush_interval
+                )
+                closed = self._closed
+
+            if closed:
+                self._drain_all()
+                return
+            self._drain()
+
+    def _drain_all(self) -> None:
+        # on close the retries are not put off, every event ends up written or in the dead letter file
+        while len(self):
+            self._drain()
+
+    def _drain(self) -> None:
+        failed = []
+        while True:
+            with self._condition:
+                batch = [
+                    self._events.popleft()
+                    for _ in range(min(self.flush_size, len(self._events)))
+                ]
+            if not batch:
+                break
+            failed += self._flush(batch)
+
+        if failed:
+            with self._condition:
+                self._events.extend(failed)
+
+    def _flush(self, batch: list[tuple[int, dict]]) -> list[tuple[int, dict]]:
+        try:
+            self.write_batch([event for _, event in batch])
+            return []
+        except Exception:
+            logger.exception(f"Failed to write a batch of {len(batch)} events, retrying one by one")
+
+        # a single broken event should not take the rest of the batch with it
+        failed, dead = [], []
+        for attempts, event in batch:
+            try:
+                self.write_batch([event])
+            except Exception:
+                if attempts + 1 < self.max_retries:
+                    logger.exception(f"Failed to write event {event}, it is retried at the next flush")
+                    failed.append((attempts + 1, event))
+                else:
+                    logger.exception(f"Failed to write event {event} {attempts + 1} times")
+                    dead.append(event)
+        self._write_dead_letters(dead)
+        return failed
+
+    def _write_dead_letters(self, events: list[dict]) -> None:
+        if not events:
+            return
+        if self.dead_letter_path is None:
+            logger.error(f"Dropping {len(events)} events without a dead letter file: {events}")
+            return
+        try:
+            with open(self.dead_letter_path, 'a', encoding='utf-8') as stream:
+                for event in events:
+                    stream.write(json.dumps(event, ensure_ascii=False, default=str) + '\n')
+        except OSError:
+            logger.exception(f"Dropping {len(events)} events, the dead letter file cannot be written: {events}")
@@ -0,0 +1,257 @@
+import argparse
+import base64
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterator, Optional
+from urllib.parse import urlparse
+
+from sqlalchemy import create_engine
+
+from server import MAIN_FOLDER
+from server.db_structures import base
+
+SOURCE_LINES = (
+    "import pandas as pd",
+    "df = pd.read_csv('data.csv')",
+    "df.head()",
+    "df = df.dropna()",
+    "X, y = df.drop(columns=['target']), df.target",
+    "model.fit(X_train, y_train)",
+    "for column in df.columns:",
+    "    print(column, df[column].nunique())",
+    "plt.plot(history['loss'])",
+    "# TODO: check the outliers",
+)
+
+
+class EventGenerator:
+    def __init__(self, seed: Optional[int] = None, image_probability: float = 0.05, error_probability: float = 0.05):
+        self.random = random.Random(seed)
+        self.image_probability = image_probability
+        self.error_probability = error_probability
+
+    def source(self) -> str:
+        lines = self.random.randint(1, 30)
+        return "\n".join(self.random.choice(SOURCE_LINES) for _ in range(lines))
+
+    def output(self) -> list[dict]:
+        p = self.random.random()
+        if p < self.error_probability:
+            return [{'output_type': 'error', 'ename': 'NameError', 'evalue': "name 'df' is not defined",
+                     'traceback': ["-" * 75] * self.random.randint(3, 20)}]
+        if p < self.error_probability + self.image_probability:
+            image = base64.b64encode(self.random.randbytes(self.random.randint(10_000, 200_000))).decode()
+            return [{'output_type': 'display_data', 'data': {'image/png': image, 'text/plain': '<Figure>'},
+                     'metadata': {}}]
+        if p < 0.5:
+            return []
+        text = "\n".join(self.random.choice(SOURCE_LINES) for _ in range(self.random.randint(1, 200)))
+        return [{'output_type': 'stream', 'name': 'stdout', 'text': text}]
+
+    def session(self, notebook_name: str, n_events: Optional[int] = None) -> Iterator[dict]:
+        kernel_id, session_id = str(uuid.uuid4()), str(uuid.uuid4())
+        cells = [[uuid.uuid4().hex, self.source()] for _ in range(self.random.randint(3, 30))]
+
+        def event(name: str, cell_num: Optional[int] = None, **kwargs) -> dict:
+            cell = cells[cell_num] if cell_num is not None else [None, None]
+            return {
+                'ip_address': '127.0.0.1',
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime()),
+                'session_id': session_id, 'kernel_id': kernel_id, 'notebook_name': notebook_name,
+                'event': name, 'cell_index': cell[0], 'cell_num': cell_num, 'cell_type': 'code',
+                'cell_source': cell[1], 'cell_output': None, **kwargs
+            }
+
+        def save() -> dict:
+            notebook = json.dumps([{'id': idx, 'source': source} for idx, source in cells])
+            return event('save_notebook', cell_source=notebook)
+
+        sent = 0
+        yield save()
+        while n_events is None or sent < n_events:
+            p = self.random.random()
+            if p < 0.1 or not cells:
+                num = self.random.randint(0, len(cells))
+                cells.insert(num, [uuid.uuid4().hex, ""])
+                events = [event('create', num)]
+            elif p < 0.15:
+                num = self.random.randrange(len(cells))
+                events = [event('delete', num)]
+                del cells[num]
+            elif p < 0.2:
+                events = [save()]
+            else:
+                num = self.random.randrange(len(cells))
+                if self.random.random() < 0.3:
+                    cells[num][1] = self.source()
+                events = [event('execute', num), event('finished_execute', num, cell_output=self.output())]
+
+            for e in events:
+                yield e
+            sent += len(events)
+
+
+@dataclass
+class LoadTestResult:
+    latencies: list = field(default_factory=list)
+    statuses: Counter = field(default_factory=Counter)
+    events: int = 0
+    errors: int = 0
+    duration: float = 0.0
+
+    def percentile(self, q: float) -> float:
+        if not self.latencies:
+            return float('nan')
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+    def report(self) -> dict:
+        requests = len(self.latencies)
+        return {
+            'requests': requests,
+            'events': self.events,
+            'duration_sec': round(self.duration, 3),
+            'requests_per_sec': round(requests / self.duration, 2) if self.duration else None,
+            'events_per_sec': round(self.events / self.duration, 2) if self.duration else None,
+            'latency_ms': {f"p{q}": round(self.percentile(q) * 1000, 2) for q in (50, 95, 99)},
+            'error_rate': round(self.errors / requests, 4) if requests else None,
+            'statuses': dict(self.statuses),
+        }
+
+
+class LoadTest:
+    def __init__(
+            self, url: str, concurrency: int = 10, rate: float = 5.0,
+            duration: float = 30.0, batch_size: int = 1, seed: Optional[int] = None
+    ):
+        self.url = urlparse(url)
+        self.concurrency = concurrency
+        self.rate = rate
+        self.duration = duration
+        self.batch_size = batch_size
+        self.seed = seed
+
+        self.result = LoadTestResult()
+        self._lock = threading.Lock()
+
+    def _post(self, connection: http.client.HTTPConnection, events: list[dict]) -> tuple[Optional[int], float]:
+        path = '/batch' if self.batch_size > 1 else '/'
+        body = json.dumps(events if self.batch_size > 1 else events[0])
+        start = time.perf_counter()
+        try:
+            connection.request('POST', path, body=body, headers={'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            status = None
+        return status, time.perf_counter() - start
+
+    def _run_notebook(self, worker_id: int, deadline: float) -> None:
+        seed = None if self.seed is None else self.seed + worker_id
+        generator = EventGenerator(seed)
+        events = generator.session(f"task{worker_id % 2 + 1}.ipynb")
+        connection = http.client.HTTPConnection(self.url.hostname, self.url.port or 80, timeout=30)
+        # every notebook sends rate events per second on average, with exponential think times
+        pace = self.batch_size / self.rate if self.rate else 0.0
+
+        while time.perf_counter() < deadline:
+            batch = [next(events) for _ in range(self.batch_size)]
+            status, latency = self._post(connection, batch)
+            with self._lock:
+                self.result.latencies.append(latency)
+                self.result.statuses[status or 'connection_error'] += 1
+                self.result.events += len(batch)
+                if status is None or status >= 400:
+                    self.result.errors += 1
+            if pace:
+                time.sleep(max(0.0, generator.random.expovariate(1 / pace) - latency))
+
+        connection.close()
+
+    def run(self) -> LoadTestResult:
+        start = time.perf_counter()
+        deadline = start + self.duration
+        workers = [
+            threading.Thread(target=self._run_notebook, args=(i, deadline), daemon=True)
+            for i in range(self.concurrency)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.result.duration = time.perf_counter() - start
+        return self.result
+
+
+def start_local_server(database_path: Path, port: int, timeout: float = 30.0) -> subprocess.Popen:
+    base.metadata.create_all(create_engine(f"sqlite:///{database_path}"))
+    env = {**os.environ, 'LOGS_DATABASE_PATH': str(database_path), 'LOGS_SERVER_PORT': str(port)}
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'server.app'], cwd=MAIN_FOLDER.parent, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/db?limit=1')
+            connection.getresponse().read()
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"server did not start on port {port} in {timeout} seconds")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Replay synthetic notebook sessions against the logs server")
+    parser.add_argument("--url", default=None, help="server to test, by default a local server is started")
+    parser.add_argument("--port", type=int, default=9998, help="port of the started local server")
+    parser.add_argument("--database", type=Path, default=None,
+                        help="database of the started local server, a temporary one by default")
+    parser.add_argument("--concurrency", type=int, default=10, help="number of simulated notebooks")
+    parser.add_argument("--rate", type=float, default=5.0, help="events per second sent by every notebook")
+    parser.add_argument("--duration", type=float, default=30.0, help="test duration in seconds")
+    parser.add_argument("--batch-size", type=int, default=1, help="events per request, > 1 uses /batch")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--report", type=Path, default=None, help="write the report as JSON")
+    args = parser.parse_args()
+
+    process, url = None, args.url
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if url is None:
+            database_path = args.database or Path(tmp_dir) / "load_test.db"
+            process = start_local_server(database_path, args.port)
+            url = f"http://127.0.0.1:{args.port}"
+
+        try:
+            result = LoadTest(url, args.concurrency, args.rate, args.duration, args.batch_size, args.seed).run()
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait()
+
+    report = result.report()
+    print(json.dumps(report, indent=2))
+    if args.report is not None:
+        with args.report.open("w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
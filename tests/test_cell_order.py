@@ -0,0 +1,164 @@
+import random
+
+import pytest
+
+from analysis.dataset.cell_order import CellOrder
+
+
+class ListOrder:
+    # the same order kept as a plain list of [cell_index, num] sorted by number
+
+    def __init__(self):
+        self.cells = []
+
+    def insert(self, cell_index, num):
+        self.remove(cell_index)
+        position = sum(1 for _, n in self.cells if n <= num)
+        self.cells.insert(position, [cell_index, num])
+
+    def remove(self, cell_index):
+        self.cells = [cell for cell in self.cells if cell[0] != cell_index]
+
+    def shift(self, num, delta, inclusive=True):
+        for cell in self.cells:
+            if cell[1] > num or (inclusive and cell[1] == num):
+                cell[1] += delta
+
+    def delete_duplicates(self):
+        duplicates = [self.cells[i][0] for i in range(1, len(self.cells)) if self.cells[i][1] == self.cells[i - 1][1]]
+        self.remove_all(duplicates)
+        return duplicates
+
+    def remove_all(self, cell_indices):
+        self.cells = [cell for cell in self.cells if cell[0] not in set(cell_indices)]
+
+    def position(self, cell_index):
+        return [c for c, _ in self.cells].index(cell_index)
+
+
+def assert_same(order: CellOrder, expected: ListOrder):
+    cells = [tuple(cell) for cell in expected.cells]
+    assert list(order) == cells
+    assert len(order) == len(cells)
+    for position, (cell_index, num) in enumerate(cells):
+        assert order[position] == (cell_index, num)
+        assert order[position - len(cells)] == (cell_index, num)
+        assert order.position(cell_index) == position
+        assert order.get_num(cell_index) == num
+        assert (cell_index, num) in order
+
+
+def make_order(cells):
+    order = CellOrder()
+    for cell_index, num in cells:
+        order.insert(cell_index, num)
+    return order
+
+
+def test_insert_at_both_ends():
+    order = make_order([('b', 1), ('c', 2)])
+    order.insert('a', 0)
+    order.insert('d', 3)
+    assert list(order) == [('a', 0), ('b', 1), ('c', 2), ('d', 3)]
+    assert order[0] == ('a', 0) and order[-1] == ('d', 3)
+    assert order.position('a') == 0 and order.position('d') == 3
+
+
+def test_insert_keeps_equal_numbers_in_insertion_order():
+    order = make_order([('a', 1), ('b', 1), ('c', 1)])
+    assert [cell_index for cell_index, _ in order] == ['a', 'b', 'c']
+
+
+def test_insert_existing_cell_moves_it():
+    order = make_order([('a', 0), ('b', 1), ('c', 2)])
+    order.insert('a', 5)
+    assert list(order) == [('b', 1), ('c', 2), ('a', 5)]
+    order.insert('a', -1)
+    assert list(order) == [('a', -1), ('b', 1), ('c', 2)]
+    assert len(order) == 3
+
+
+def test_remove_at_both_ends():
+    order = make_order([('a', 0), ('b', 1), ('c', 2), ('d', 3)])
+    order.remove('a')
+    order.remove('d')
+    assert list(order) == [('b', 1), ('c', 2)]
+    assert order.position('b') == 0 and order.position('c') == 1
+    assert not order.has_cell('a') and not order.has_cell('d')
+    order.remove('b')
+    order.remove('c')
+    assert list(order) == [] and len(order) == 0
+
+
+def test_shift_at_both_ends():
+    order = make_order([('a', 0), ('b', 1), ('c', 2)])
+    order.shift(0, 1)
+    assert list(order) == [('a', 1), ('b', 2), ('c', 3)]
+    order.shift(3, 1)
+    assert list(order) == [('a', 1), ('b', 2), ('c', 4)]
+    order.shift(2, -1, inclusive=False)
+    assert list(order) == [('a', 1), ('b', 2), ('c', 3)]
+    order.shift(4, 1)
+    assert list(order) == [('a', 1), ('b', 2), ('c', 3)]
+
+
+def test_delete_duplicates_keeps_first():
+    order = make_order([('a', 0), ('b', 1), ('c', 2)])
+    order.insert('d', 0)
+    order.insert('e', 2)
+    assert sorted(order.delete_duplicates()) == ['d', 'e']
+    assert list(order) == [('a', 0), ('b', 1), ('c', 2)]
+    assert order.delete_duplicates() == []
+
+
+def test_position_out_of_range():
+    order = make_order([('a', 0)])
+    with pytest.raises(IndexError):
+        order[1]
+    with pytest.raises(IndexError):
+        order[-2]
+    with pytest.raises(KeyError):
+        order.position('b')
+
+
+def test_nums_keep_detached_cells():
+    order = make_order([('a', 0), ('b', 1)])
+    order.nums.detach_all()
+    order.remove('a')
+    assert order.nums['a'] == 0 and order.nums['b'] == 1
+    order.nums['a'] = 2
+    assert order.nums.detached['a'] == 2 and not order.has_cell('a')
+    order.insert('a', 3)
+    assert 'a' not in order.nums.detached and order.nums['a'] == 3
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_random_operations_match_list(seed):
+    rng = random.Random(seed)
+    order, expected = CellOrder(seed=seed), ListOrder()
+    cell_indices = [f"cell{i}" for i in range(30)]
+
+    for _ in range(300):
+        operation = rng.random()
+        present = [cell_index for cell_index, _ in expected.cells]
+        if operation < 0.45 or not present:
+            cell_index, num = rng.choice(cell_indices), rng.randint(-3, 25)
+            order.insert(cell_index, num)
+            expected.insert(cell_index, num)
+        elif operation < 0.7:
+            cell_index = rng.choice(present)
+            order.remove(cell_index)
+            expected.remove(cell_index)
+        elif operation < 0.9:
+            nums = [num for _, num in expected.cells]
+            num, inclusive = rng.randint(min(nums) - 1, max(nums) + 1), rng.random() < 0.5
+            # moving cells down never goes past the cells before them, the order stays sorted by number
+            before = [n for n in nums if n < num or (not inclusive and n == num)]
+            moved = [n for n in nums if n not in before]
+            lowest = -(min(moved) - max(before)) if before and moved else -3
+            delta = rng.randint(lowest, 3)
+            order.shift(num, delta, inclusive)
+            expected.shift(num, delta, inclusive)
+        else:
+            assert sorted(order.delete_duplicates()) == sorted(expected.delete_duplicates())
+        assert_same(order, expected)
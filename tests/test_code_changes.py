@@ -0,0 +1,120 @@
+import time
+
+import pytest
+
+from analysis.metrics.utils import code_changes
+from analysis.metrics.utils.code_changes import (
+    CodeChanges, EditScriptTimeout, get_edit_script, get_edit_script_with_timeout
+)
+
+SCRIPT = [['update', 'identifier:x', 'y']]
+
+
+class FakeEditScripts:
+    # stands in for the AST diff, returns the scripts given for the pairs and counts the calls
+
+    def __init__(self, scripts=None):
+        self.scripts = scripts or {}
+        self.calls = []
+
+    def __call__(self, source_from, source_to):
+        self.calls.append((source_from, source_to))
+        return self.scripts.get((source_from, source_to), SCRIPT)
+
+
+@pytest.fixture
+def fake_scripts(monkeypatch):
+    fake = FakeEditScripts()
+    monkeypatch.setattr(code_changes, 'get_edit_script', fake)
+    return fake
+
+
+@pytest.mark.parametrize('source_from, source_to, expected', [
+    ('x = 1', 'x = 1', (False, [])),
+    (None, 'x = 1', (False, [])),
+    ('x = 1', None, (False, [])),
+    ('x = 1\n', 'x = 1   \n\n\n', (False, [])),
+    ('x = 1\n\ny = 2', 'x = 1\ny = 2  ', (False, [])),
+    ('x = 1', 'x = 2', (True, None)),
+])
+def test_prefilter(source_from, source_to, expected):
+    assert CodeChanges().prefilter(source_from, source_to) == expected
+
+
+def test_prefilter_size_cap():
+    changes = CodeChanges(max_source_size=10)
+    assert changes.prefilter('x = 1', 'x = 22') == (False, None)
+    assert changes.prefilter('x = 1', 'x = 2') == (True, None)
+    assert CodeChanges(max_source_size=None).prefilter('x = 1' * 100, 'x = 2' * 100) == (True, None)
+
+
+def test_prefilter_min_distance():
+    changes = CodeChanges(min_distance=3)
+    assert changes.prefilter('x = 1', 'x = 2') == (False, None)
+    assert changes.prefilter('x = 1', 'y = 234') == (True, None)
+
+
+def test_calculate_uses_prefilter_and_deduplicates(fake_scripts):
+    changes = CodeChanges()
+    sources_from = ['x = 1', 'x = 1', 'a = 1', None, 'x = 1']
+    sources_to = ['x = 2', 'x = 2', 'a = 1', 'b = 1', 'x = 2']
+    assert changes.calculate(sources_from, sources_to, progress=False) == [SCRIPT, SCRIPT, [], [], SCRIPT]
+    assert fake_scripts.calls == [('x = 1', 'x = 2')]
+
+
+def test_cache_round_trip(tmp_path, fake_scripts):
+    cache_path = tmp_path / 'code_changes.sqlite'
+    fake_scripts.scripts[('a = 1', 'a = 2')] = []
+    pairs = (['x = 1', 'a = 1'], ['x = 2', 'a = 2'])
+    assert CodeChanges(cache_path).calculate(*pairs, progress=False) == [SCRIPT, []]
+    assert len(fake_scripts.calls) == 2
+
+    # a new instance reads them back from the file, whatever its timeout
+    assert CodeChanges(cache_path, timeout=1).calculate(*pairs, progress=False) == [SCRIPT, []]
+    assert len(fake_scripts.calls) == 2
+
+
+def test_failures_are_not_cached(tmp_path, fake_scripts):
+    cache_path = tmp_path / 'code_changes.sqlite'
+    fake_scripts.scripts[('x = 1', 'x = 2')] = None
+    assert CodeChanges(cache_path).calculate(['x = 1'], ['x = 2'], progress=False) == [None]
+
+    del fake_scripts.scripts[('x = 1', 'x = 2')]
+    assert CodeChanges(cache_path).calculate(['x = 1'], ['x = 2'], progress=False) == [SCRIPT]
+    assert len(fake_scripts.calls) == 2
+
+
+def test_parser_errors_give_none(monkeypatch):
+    def fail(*args, **kwargs):
+        raise RuntimeError("cannot parse %matplotlib inline")
+
+    monkeypatch.setattr(code_changes.cd, 'difference', fail)
+    assert get_edit_script('%matplotlib inline\nx = 1', '%matplotlib inline\nx = 2') is None
+
+
+def test_value_errors_give_no_changes(monkeypatch):
+    def fail(*args, **kwargs):
+        raise ValueError("nothing to diff")
+
+    monkeypatch.setattr(code_changes.cd, 'difference', fail)
+    assert get_edit_script('x = 1', 'x = 2') == []
+
+
+def test_timeouts_are_not_parser_errors(monkeypatch):
+    def interrupted(*args, **kwargs):
+        raise EditScriptTimeout()
+
+    monkeypatch.setattr(code_changes.cd, 'difference', interrupted)
+    with pytest.raises(EditScriptTimeout):
+        get_edit_script('x = 1', 'x = 2')
+
+
+def test_timeout_gives_none(monkeypatch):
+    def slow(*args, **kwargs):
+        time.sleep(2)
+        return SCRIPT
+
+    monkeypatch.setattr(code_changes, 'get_edit_script', slow)
+    assert get_edit_script_with_timeout('x = 1', 'x = 2', 0.05) is None
+    monkeypatch.setattr(code_changes, 'get_edit_script', lambda *args: SCRIPT)
+    assert get_edit_script_with_timeout('x = 1', 'x = 2', 0.05) == SCRIPT
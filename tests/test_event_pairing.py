@@ -0,0 +1,156 @@
+import random
+
+import numpy as np
+import pytest
+
+from analysis.dataset.event_pairing import get_truthy_mask, match_queue, pair_last_openers
+
+
+def last_openers_loop(is_opener, is_closer, labels):
+    # the loop of match_executions and match_edits the pairing replaced, on positions instead of index labels
+    looking_for = False
+    pairs, unmatched = [], []
+    for position, label in enumerate(labels):
+        if is_opener[position]:
+            looking_for = (position, label)
+        if is_closer[position]:
+            if looking_for and looking_for[1]:
+                pairs.append((looking_for[0], position))
+                looking_for = None
+            else:
+                unmatched.append(position)
+    return pairs, unmatched
+
+
+def queue_loop(events, keys, times):
+    # the loop of TimeMetrics.match_executions the queue matching replaced
+    queue, matches, unexpected = [], [], []
+    latest_time = None
+    for position, (event, key, time) in enumerate(zip(events, keys, times)):
+        if event == 'execute':
+            if not queue:
+                latest_time = time
+            queue.append((key, position, time))
+        if event == 'finished_execute':
+            if not queue:
+                unexpected.append(position)
+            if key in [k for k, _, _ in queue]:
+                latest = max(i for i, n in enumerate(queue) if n[0] == key)
+                latest_time = queue[latest][2] if queue[latest][2] > latest_time else latest_time
+                matches.append((queue[latest][1], position, latest_time))
+                latest_time = time
+                del queue[latest]
+            else:
+                unexpected.append(position)
+    return matches, unexpected, [position for _, position, _ in queue]
+
+
+def check_last_openers(events, labels=None):
+    events = np.array(events, dtype=object)
+    labels = list(range(1, len(events) + 1)) if labels is None else labels
+    is_opener, is_closer = events == 'execute', events == 'finished_execute'
+
+    openers, closers, unmatched = pair_last_openers(is_opener, is_closer, get_truthy_mask(labels))
+    pairs, expected_unmatched = last_openers_loop(is_opener, is_closer, labels)
+    assert list(zip(openers, closers)) == pairs
+    assert list(unmatched) == expected_unmatched
+
+
+def check_queue(events, keys, times=None):
+    events = np.array(events, dtype=object)
+    times = np.arange(len(events)) * 10 if times is None else np.asarray(times)
+
+    matches = match_queue(events == 'execute', events == 'finished_execute', np.array(keys, dtype=object), times)
+    expected, unexpected, unfinished = queue_loop(events, keys, times)
+    assert list(zip(matches.openers, matches.closers, matches.starts)) == expected
+    assert list(matches.unexpected) == unexpected
+    assert list(matches.unfinished) == unfinished
+
+
+@pytest.mark.parametrize('events', [
+    ['execute', 'execute', 'execute'],
+    ['execute', 'finished_execute', 'execute'],
+    ['finished_execute', 'execute', 'finished_execute'],
+    ['finished_execute', 'finished_execute'],
+    ['execute', 'finished_execute', 'finished_execute'],
+    ['execute', 'execute', 'finished_execute', 'finished_execute'],
+    ['execute', 'create', 'finished_execute', 'rendered', 'execute', 'finished_execute'],
+    [],
+])
+def test_last_openers_edge_cases(events):
+    check_last_openers(events)
+
+
+def test_last_openers_falsy_label():
+    # the loop took an opener labelled 0 for no opener at all
+    check_last_openers(['execute', 'finished_execute', 'execute', 'finished_execute'], [0, 1, 2, 3])
+    check_last_openers(['execute', 'execute', 'finished_execute'], [1, 0, 2])
+
+
+def test_last_openers_edits():
+    events = np.array(['create', 'execute', 'execute', 'finished_execute', 'execute', 'finished_execute'])
+    is_opener, is_closer = (events == 'finished_execute') | (events == 'create'), events == 'execute'
+    edits, executions, unmatched = pair_last_openers(is_opener, is_closer)
+    assert list(zip(edits, executions)) == [(0, 1), (3, 4)]
+    assert list(unmatched) == [2]
+
+
+QUEUE_CASES = [
+    # unmatched openers
+    (['execute', 'execute', 'finished_execute'], ['a', 'b', 'b']),
+    (['execute', 'execute', 'execute'], ['a', 'b', 'a']),
+    # a closer before any opener
+    (['finished_execute', 'execute', 'finished_execute'], ['a', 'a', 'a']),
+    (['finished_execute', 'finished_execute', 'execute'], ['a', 'b', 'a']),
+    # a closer of another cell than the queued ones
+    (['execute', 'finished_execute', 'finished_execute'], ['a', 'b', 'a']),
+    # repeated cell ids take the latest queued execution of the cell
+    (['execute', 'execute', 'execute', 'finished_execute', 'finished_execute'], ['a', 'b', 'a', 'a', 'a']),
+    (['execute', 'execute', 'finished_execute', 'finished_execute', 'finished_execute'], ['a', 'a', 'a', 'a', 'a']),
+    # cells finishing out of queue order
+    (['execute', 'execute', 'finished_execute', 'finished_execute'], ['a', 'b', 'b', 'a']),
+    ([], []),
+]
+
+
+@pytest.mark.parametrize('events, keys', QUEUE_CASES)
+def test_queue_edge_cases(events, keys):
+    check_queue(events, keys)
+
+
+def test_queue_waiting_executions_start_at_previous_finish():
+    events = ['execute', 'execute', 'finished_execute', 'finished_execute']
+    matches = match_queue(np.array(events) == 'execute', np.array(events) == 'finished_execute',
+                          np.array(['a', 'b', 'a', 'b']), np.array([0, 1, 5, 9]))
+    assert list(matches.starts) == [0, 5]
+    check_queue(events, ['a', 'b', 'a', 'b'], [0, 1, 5, 9])
+
+
+def test_queue_datetimes():
+    times = np.array(['2023-01-01T00:00:00', '2023-01-01T00:00:01', '2023-01-01T00:00:03'], dtype='datetime64[ns]')
+    check_queue(['execute', 'execute', 'finished_execute'], ['a', 'b', 'a'], times)
+
+
+def random_events(rng, n, cells):
+    events = rng.choices(['execute', 'finished_execute', 'create', 'rendered'], weights=[4, 4, 1, 1], k=n)
+    keys = [rng.choice(cells) for _ in range(n)]
+    kernels = [rng.choice(['k1', 'k2', 'k3']) for _ in range(n)]
+    times = np.cumsum([rng.randint(0, 3) for _ in range(n)])
+    return np.array(events, dtype=object), np.array(keys, dtype=object), np.array(kernels, dtype=object), times
+
+
+@pytest.mark.parametrize('seed', range(30))
+def test_interleaved_kernels_match_loop(seed):
+    # kernels and cells are matched separately, their events interleave in the log
+    rng = random.Random(seed)
+    events, keys, kernels, times = random_events(rng, 200, ['a', 'b', 'c', 'd'])
+
+    for kernel in np.unique(kernels):
+        in_kernel = np.flatnonzero(kernels == kernel)
+        check_queue(events[in_kernel], list(keys[in_kernel]), times[in_kernel])
+
+        for key in np.unique(keys[in_kernel]):
+            in_cell = in_kernel[keys[in_kernel] == key]
+            labels = [rng.choice([0, int(position)]) if rng.random() < 0.1 else int(position) + 1
+                      for position in in_cell]
+            check_last_openers(events[in_cell], labels)
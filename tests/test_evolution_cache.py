@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+
+from analysis.dataset.evolution_cache import read_evolution_cache, write_evolution_cache
+
+
+def make_states(n: int = 40) -> pd.DataFrame:
+    # shaped like an evolution frame, the categorical columns come over from the logs
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        'kernel_id': [f"kernel{i % 3}" for i in range(n)],
+        'state_num': np.arange(n),
+        'event': pd.Categorical(
+            rng.choice(['execute', 'create', 'delete'], n), categories=['create', 'delete', 'execute', 'save']
+        ),
+        'notebook_name': pd.Categorical(rng.choice(['task1.ipynb', None], n)),
+        'cell_source': [None if i % 7 == 0 else f"x = {i % 5}" for i in range(n)],
+        'time': pd.date_range('2023-05-06', periods=n, freq='s'),
+        'cell_num': rng.integers(0, 10, n).astype('float64'),
+        'stage': pd.Categorical(rng.choice([1, 2, 3], n), categories=[3, 2, 1], ordered=True),
+        'started': pd.Categorical(pd.date_range('2023-05-06', periods=n, freq='h', tz='UTC')[rng.integers(0, 3, n)]),
+    }, index=np.arange(n) * 2)
+
+
+def assert_same_frame(fresh: pd.DataFrame, cached: pd.DataFrame):
+    pd.testing.assert_frame_equal(fresh, cached)
+    for column in fresh.columns:
+        assert fresh[column].dtype == cached[column].dtype, column
+    assert fresh.memory_usage(deep=True).equals(cached.memory_usage(deep=True))
+
+
+def test_cached_frame_keeps_dtypes(tmp_path):
+    fresh = make_states()
+    write_evolution_cache(fresh, tmp_path / 'states.parquet')
+    assert_same_frame(fresh, read_evolution_cache(tmp_path / 'states.parquet'))
+
+
+@pytest.mark.parametrize('categorical', [
+    pd.Categorical([None, None]),
+    pd.Categorical([None, None], categories=['a', 'b']),
+    pd.Categorical(['b', 'a'], categories=['c', 'b', 'a'], ordered=True),
+    pd.Categorical([2, 1], categories=[3, 2, 1], ordered=True),
+    pd.Categorical([1.5, np.nan], categories=[0.5, 1.5]),
+    pd.Categorical([True, False]),
+    pd.Categorical(pd.to_datetime(['2023-01-01', None]).tz_localize('UTC')),
+])
+def test_categories_survive_without_pandas_metadata(tmp_path, categorical):
+    path = tmp_path / 'states.parquet'
+    fresh = pd.DataFrame({'column': categorical})
+    write_evolution_cache(fresh, path)
+
+    # a file rewritten by another tool keeps the schema metadata of its own but not the one of pandas
+    table = pq.read_table(path)
+    metadata = {k: v for k, v in table.schema.metadata.items() if k != b'pandas'}
+    pq.write_table(table.replace_schema_metadata(metadata), path)
+
+    cached = read_evolution_cache(path)
+    assert cached['column'].dtype == fresh['column'].dtype
+    pd.testing.assert_series_equal(cached['column'], fresh['column'])
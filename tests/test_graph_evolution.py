@@ -0,0 +1,52 @@
+import random
+
+import pandas as pd
+import pytest
+
+from analysis.metrics.metrics_graph import GraphMetrics
+
+
+def make_logs(seed: int, n: int = 250) -> pd.DataFrame:
+    # a few cells executed over and over, now and then a new one, events of other kinds in between
+    rng = random.Random(seed)
+    rows, cells = [], [f"{i:08x}-cell" for i in range(3)]
+    for _ in range(n):
+        kernel_id = rng.choice(['kernel1', 'kernel2'])
+        if rng.random() < 0.05:
+            cells.append(f"{len(cells):08x}-cell")
+        rows.append({
+            'kernel_id': kernel_id,
+            'event': rng.choice(['execute', 'execute', 'execute', 'finished_execute', 'create']),
+            'cell_index': rng.choice(cells[-8:]) if rng.random() < 0.7 else rng.choice(cells),
+        })
+    return pd.DataFrame(rows)
+
+
+def get_prefix_metrics(df: pd.DataFrame, step: int) -> pd.DataFrame:
+    # the series as it was computed before, from scratch for every prefix
+    metrics = GraphMetrics()
+    return pd.concat([
+        pd.concat([
+            metrics.calculate_metrics(kernel_df.iloc[:i], progress=False) for i in range(1, len(kernel_df), step)
+        ], ignore_index=True).reset_index().rename({'index': 'state_num'}, axis=1)
+        for _, kernel_df in df.groupby('kernel_id', observed=True)
+    ], ignore_index=True)
+
+
+@pytest.mark.parametrize('seed', range(4))
+@pytest.mark.parametrize('step', [1, 3])
+def test_evolution_matches_every_prefix(seed, step):
+    df = make_logs(seed)
+    expected = get_prefix_metrics(df, step)
+    evolution = GraphMetrics().calculate_evolution(df, step=step, progress=False)
+    pd.testing.assert_frame_equal(evolution, expected[evolution.columns], check_dtype=False)
+
+
+@pytest.mark.parametrize('modularity_every', [5, 100])
+def test_kept_communities_give_the_other_metrics_exactly(modularity_every):
+    df = make_logs(0)
+    expected = get_prefix_metrics(df, 1)
+    evolution = GraphMetrics().calculate_evolution(df, modularity_every=modularity_every, progress=False)
+    columns = ['state_num', 'kernel_id', 'average_degree', 'average_clustering', 'nodes_count', 'edges_count']
+    pd.testing.assert_frame_equal(evolution[columns], expected[columns], check_dtype=False)
+    assert evolution.modularity.between(-0.5, 1).all()
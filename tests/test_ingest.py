@@ -0,0 +1,59 @@
+import json
+
+from server.ingest import WriteBehindQueue
+
+
+class FlakyWriter:
+    # fails on the events in broken, and on everything for the first failures calls
+
+    def __init__(self, failures: int = 0, broken=()):
+        self.failures = failures
+        self.broken = set(broken)
+        self.written = []
+
+    def __call__(self, events):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("database is locked")
+        if any(event['id'] in self.broken for event in events):
+            raise ValueError("broken event")
+        self.written += [event['id'] for event in events]
+
+
+def test_failed_events_are_retried(tmp_path):
+    writer = FlakyWriter(failures=4)
+    queue = WriteBehindQueue(writer, flush_size=2, dead_letter_path=tmp_path / 'dead.ndjson')
+    queue.put([{'id': 1}, {'id': 2}, {'id': 3}])
+    queue._drain()
+    assert len(queue) > 0
+    queue.close()
+
+    assert sorted(writer.written) == [1, 2, 3]
+    assert not (tmp_path / 'dead.ndjson').exists()
+
+
+def test_events_failing_too_often_go_to_dead_letters(tmp_path):
+    writer = FlakyWriter(broken={2})
+    dead_letter_path = tmp_path / 'dead.ndjson'
+    queue = WriteBehindQueue(writer, flush_size=10, max_retries=3, dead_letter_path=dead_letter_path)
+    queue.put([{'id': 1}, {'id': 2, 'time': 'now'}, {'id': 3}])
+
+    queue._drain()
+    queue._drain()
+    assert writer.written == [1, 3] and len(queue) == 1
+    queue._drain()
+    assert len(queue) == 0
+
+    assert [json.loads(line) for line in dead_letter_path.read_text().splitlines()] == [{'id': 2, 'time': 'now'}]
+
+
+def test_close_writes_or_keeps_every_event(tmp_path):
+    writer = FlakyWriter(broken={1})
+    dead_letter_path = tmp_path / 'dead.ndjson'
+    queue = WriteBehindQueue(writer, flush_size=1, dead_letter_path=dead_letter_path)
+    queue.start()
+    queue.put([{'id': 1}, {'id': 2}])
+    queue.close()
+
+    assert writer.written == [2] and len(queue) == 0
+    assert dead_letter_path.read_text().splitlines() == ['{"id": 1}']
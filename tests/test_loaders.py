@@ -0,0 +1,58 @@
+import sqlite3
+from contextlib import closing
+
+import pandas as pd
+import pytest
+
+from analysis.dataset.loaders import iter_parquet_chunks, iter_sqlite_chunks
+
+START, END = '2023-05-06T10:00:03Z', '2023-05-06T10:00:07Z'
+
+
+def make_logs(n: int = 10) -> pd.DataFrame:
+    # every other row was written before the timestamp column existed and is not backfilled yet
+    time = pd.date_range('2023-05-06 10:00:00', periods=n, freq='s', tz='UTC')
+    return pd.DataFrame({
+        'id': range(1, n + 1),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S.%f').str[:-3] + 'Z',
+        'kernel_id': 'kernel1',
+        'event': 'execute',
+        'timestamp': pd.array([t.value // 1_000_000 if i % 2 else None for i, t in enumerate(time)], dtype='Int64'),
+    })
+
+
+def expected_ids(df: pd.DataFrame) -> list[int]:
+    time = pd.to_datetime(df.time, utc=True)
+    return df.id[(time >= pd.Timestamp(START)) & (time < pd.Timestamp(END))].tolist()
+
+
+@pytest.fixture
+def database(tmp_path):
+    path = tmp_path / 'logs.db'
+    with closing(sqlite3.connect(path)) as connection:
+        connection.execute(
+            "CREATE TABLE user_logs (id INTEGER PRIMARY KEY, time VARCHAR, kernel_id VARCHAR, event VARCHAR,"
+            " timestamp BIGINT)"
+        )
+        connection.executemany(
+            "INSERT INTO user_logs VALUES (?, ?, ?, ?, ?)",
+            [(*row[:-1], None if pd.isna(row[-1]) else int(row[-1])) for row in make_logs().itertuples(index=False)]
+        )
+        connection.commit()
+    return path
+
+
+@pytest.mark.parametrize('columns', [None, ['event']])
+def test_sqlite_time_filter_keeps_rows_without_timestamp(database, columns):
+    df = pd.concat(iter_sqlite_chunks(database, columns, start=START, end=END))
+    assert df.action_id.tolist() == expected_ids(make_logs())
+    assert columns is not None or df.timestamp.isna().any()
+
+
+@pytest.mark.parametrize('columns', [None, ['event']])
+def test_parquet_time_filter_keeps_rows_without_timestamp(tmp_path, columns):
+    path = tmp_path / 'logs.parquet'
+    make_logs().to_parquet(path, index=False)
+    df = pd.concat(iter_parquet_chunks(path, columns, start=START, end=END))
+    assert df.action_id.tolist() == expected_ids(make_logs())
+    assert ('time' in df.columns) == (columns is None)
@@ -0,0 +1,127 @@
+import json
+import random
+
+import pandas as pd
+import pytest
+
+from analysis.metrics.metrics_time import TimeMetrics
+from analysis.metrics.metrics_time_stream import ACTION_EVENTS, KernelTimeStream, StreamingTimeMetrics
+from test_event_pairing import QUEUE_CASES
+
+OUTPUTS = [None, '[]', json.dumps([{'output_type': 'stream', 'text': 'x'}]),
+           json.dumps([{'output_type': 'error', 'ename': 'ValueError'}]), "[{'output_type': 'execute_result'}]"]
+
+
+def make_logs(events, cells, kernels, seconds) -> pd.DataFrame:
+    return pd.DataFrame({
+        'action_id': range(1, len(events) + 1),
+        'time': pd.Timestamp('2023-05-01 10:00') + pd.to_timedelta(seconds, unit='s'),
+        'kernel_id': kernels,
+        'event': events,
+        'cell_index': cells,
+        'cell_source': ['x = 1'] * len(events),
+        'cell_output': [OUTPUTS[i % len(OUTPUTS)] if event == 'finished_execute' else None
+                        for i, event in enumerate(events)],
+        'cell_label': ['label'] * len(events),
+    })
+
+
+def make_random_logs(seed: int, n: int = 300) -> pd.DataFrame:
+    rng = random.Random(seed)
+    events = rng.choices(['execute', 'finished_execute', 'create', 'delete', 'rendered'], weights=[4, 4, 1, 1, 1], k=n)
+    seconds = [0]
+    for _ in range(n - 1):
+        seconds.append(seconds[-1] + rng.randint(0, 3))
+    return make_logs(
+        events, [rng.choice('abcd') for _ in range(n)], [rng.choice(['k1', 'k2', 'k3']) for _ in range(n)], seconds
+    )
+
+
+def replay(df: pd.DataFrame, batch_size: int) -> tuple[StreamingTimeMetrics, dict, dict]:
+    stream, updates = StreamingTimeMetrics(), []
+    df = df.sort_values('time', kind='stable')
+    for start in range(0, len(df), batch_size):
+        updates += stream.process_batch(df.iloc[start:start + batch_size])
+    updates += stream.close()
+
+    executions, next_action_times = {}, {}
+    for update in updates:
+        if update.kind == 'execution':
+            values = update.values
+            executions[update.action_id] = (
+                values['execution_time'], values['execution_start'], values['interruptions'], values['result']
+            )
+        elif update.kind == 'next_action':
+            next_action_times[update.action_id] = update.values['next_action_time']
+    return stream, executions, next_action_times
+
+
+def check_replay(df: pd.DataFrame, batch_size: int):
+    batch = TimeMetrics()
+    metrics = batch.calculate_metrics(df)
+    stream, executions, next_action_times = replay(df, batch_size)
+
+    executed = metrics[metrics.execution_time.notna()]
+    assert executions == {
+        row.action_id: (row.execution_time, row.execution_start, row.interruptions, row.result)
+        for row in executed.itertuples()
+    }
+    actions = metrics[metrics.event.isin(ACTION_EVENTS)]
+    assert next_action_times == {
+        row.action_id: None if pd.isna(row.next_action_time) else row.next_action_time for row in actions.itertuples()
+    }
+    assert sorted(stream.unexpected_finish, key=str) == sorted(batch.unexpected_finish, key=str)
+    assert sorted(sum(stream.unfinished, []), key=str) == sorted(sum(batch.unfinished, []), key=str)
+
+
+@pytest.mark.parametrize('events, cells', [case for case in QUEUE_CASES if case[0]])
+def test_replay_edge_cases(events, cells):
+    check_replay(make_logs(events, cells, ['k1'] * len(events), range(0, 10 * len(events), 10)), 1)
+
+
+@pytest.mark.parametrize('seed', range(10))
+@pytest.mark.parametrize('batch_size', [1, 17, 1000])
+def test_replay_matches_time_metrics(seed, batch_size):
+    check_replay(make_random_logs(seed), batch_size)
+
+
+def event(name, cell_index, action_id, second):
+    return {'event': name, 'cell_index': cell_index, 'action_id': action_id,
+            'time': pd.Timestamp('2023-05-01 10:00') + pd.Timedelta(seconds=second)}
+
+
+def test_queue_is_capped():
+    kernel = KernelTimeStream('k1', max_queue=2)
+    assert kernel.process(event('execute', 'a', 1, 0)) == []
+    kernel.process(event('execute', 'b', 2, 1))
+    updates = kernel.process(event('execute', 'c', 3, 2))
+    assert [(update.kind, update.values['executions']) for update in updates if update.kind == 'unfinished'] == [
+        ('unfinished', [('a', 1, pd.Timestamp('2023-05-01 10:00'), None, None)])
+    ]
+    assert len(kernel.queue) == 2 and 'a' not in kernel.pending
+
+    # the finish of the given up execution is not matched any more
+    kinds = [update.kind for update in kernel.process(event('finished_execute', 'a', 4, 3))]
+    assert kinds == ['unexpected_finish']
+    kinds = [update.kind for update in kernel.process(event('finished_execute', 'c', 5, 4))]
+    assert kinds == ['execution']
+
+
+def test_times_are_capped():
+    kernel = KernelTimeStream('k1', max_times=10)
+    kernel.process(event('execute', 'a', 0, 0))
+    for i in range(1, 50):
+        kernel.process(event('create', f'cell{i}', i, i))
+        assert len(kernel.times) - kernel.times_offset <= 10
+    assert not kernel.queue and not kernel.pending
+
+
+def test_times_are_pruned_to_the_running_execution():
+    kernel = KernelTimeStream('k1')
+    kernel.process(event('execute', 'a', 0, 0))
+    kernel.process(event('execute', 'b', 1, 1))
+    for i in range(2, 20):
+        kernel.process(event('create', f'cell{i}', i, i))
+    kernel.process(event('finished_execute', 'a', 20, 20))
+    kernel.process(event('create', 'cell', 21, 21))
+    assert kernel.times[kernel.times_offset:] == [pd.Timestamp('2023-05-01 10:00:21').value]
@@ -0,0 +1,95 @@
+import random
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from analysis.metrics.metrics_transtions import TransitionCounter
+
+
+def make_logs(seed: int, n: int = 300) -> pd.DataFrame:
+    # the later rows use events, labels and kernels the first ones do not, so the vocabulary grows along the log
+    rng = random.Random(seed)
+    rows = []
+    for i in range(n):
+        stage = 1 + 3 * i // n
+        rows.append({
+            'kernel_id': f"kernel{rng.randrange(2 * stage)}",
+            'cell_index': f"cell{rng.randrange(3)}",
+            'event': rng.choice(['execute', 'finished_execute', 'create', 'delete', 'save', 'rendered'][:2 * stage]),
+            'cell_label': rng.choice([None, 'load', 'plot', 'model', 'train', 'evaluate', 'export'][:2 * stage + 1]),
+            'task': rng.choice(['task1', 'task2']),
+        })
+    return pd.DataFrame(rows)
+
+
+def naive_ngrams(df, column, order, group_by=(), events=None, split_inner=False) -> Counter:
+    counts = Counter()
+    for _, kernel_df in df.groupby('kernel_id', sort=False):
+        if events is not None:
+            kernel_df = kernel_df[kernel_df.event.isin(events)]
+        values = [None if pd.isna(value) else value for value in kernel_df[column]]
+        cells, groups = list(kernel_df.cell_index), kernel_df[list(group_by)].to_numpy()
+        for i in range(len(values) - order + 1):
+            inner = (all(cells[i + k] == cells[i] for k in range(order)),) if split_inner else ()
+            counts[tuple(groups[i + order - 1]) + inner + tuple(values[i:i + order])] += 1
+    return counts
+
+
+def to_counter(ngrams: pd.DataFrame) -> Counter:
+    return Counter({tuple(row[:-1]): row[-1] for row in ngrams.itertuples(index=False)})
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('column, order, group_by, events, split_inner', [
+    ('event', 1, (), None, False),
+    ('event', 2, (), None, False),
+    ('event', 3, ('kernel_id',), None, False),
+    ('cell_label', 2, ('task',), ('execute', 'create'), True),
+    ('cell_label', 4, ('kernel_id', 'task'), None, True),
+])
+@pytest.mark.parametrize('chunksize', [1, 7, 64])
+def test_chunks_match_one_pass(seed, column, order, group_by, events, split_inner, chunksize):
+    df = make_logs(seed)
+    expected = naive_ngrams(df, column, order, group_by, events, split_inner)
+
+    one_pass = TransitionCounter(column, order, group_by, events, split_inner).update(df)
+    chunked = TransitionCounter(column, order, group_by, events, split_inner)
+    shapes = set()
+    for start in range(0, len(df), chunksize):
+        chunked.update(df.iloc[start:start + chunksize])
+        shapes.add(chunked.counts.shape)
+
+    # the counts were resized while the chunks came
+    assert len(shapes) > 1
+    assert to_counter(one_pass.get_ngrams()) == expected
+    assert to_counter(chunked.get_ngrams()) == expected
+
+
+def test_matrix_of_chunks():
+    df = make_logs(0)
+    one_pass = TransitionCounter('event', group_by=('kernel_id',)).update(df)
+    chunked = TransitionCounter('event', group_by=('kernel_id',))
+    for start in range(0, len(df), 10):
+        chunked.update(df.iloc[start:start + 10])
+
+    pd.testing.assert_frame_equal(chunked.get_matrix().sort_index().sort_index(axis=1),
+                                  one_pass.get_matrix().sort_index().sort_index(axis=1))
+    kernel_id = df.kernel_id.iloc[0]
+    matrix = chunked.get_matrix((kernel_id,))
+    expected = naive_ngrams(df[df.kernel_id == kernel_id], 'event', 2)
+    assert {(a, b): matrix.loc[a, b] for a, b in expected} == dict(expected)
+    assert matrix.to_numpy().sum() == sum(expected.values())
+
+
+def test_empty_chunks():
+    df = make_logs(1)
+    counter = TransitionCounter('event', 2, events=('execute',))
+    counter.update(df.iloc[:0]).update(df[df.event != 'execute']).update(df)
+    assert to_counter(counter.get_ngrams()) == naive_ngrams(df, 'event', 2, events=('execute',))
+
+
+def test_matrix_needs_order_two():
+    with pytest.raises(ValueError):
+        TransitionCounter('event', 3).update(make_logs(0)).get_matrix()